@@ -18,94 +18,264 @@ import logging
 import os
 import re
 
-from google.cloud import bigquery
-import pydata_google_auth
 import pandas as pd
 from pathlib import Path
-from typing import Union, List, Optional
+from typing import Union, List, Optional, Mapping
 from types import ModuleType
 from process.walker import Walker
-from process.normalise import normalise, fix_years
-from process.combine import load_files, calculate_percentage
-from process.bigquery import make_json
+from process.store import store_ingested, store_writer, read_pool, StoreCatalog, join_normalised, \
+    write_normalised, read_normalised, read_partitions, NORMALISED_INDEX, atomic_path, mark_complete, is_complete, \
+    clear_markers
+from process.normalise import normalise_partitions, fix_years
+from process.filter_cache import load_compiled_filters
+from process.cube import CountCube, cube_stems
+from process.query import build_query_store
+from process.id_index import map_ids
+from process.combine import load_files, iter_normalised, calculate_percentage
+from process.bigquery import export_shards
+from process.memory import resolve_budget, reported_stage, memory_report, frame_bytes, split_frame, within_budget, \
+    parquet_bytes
 
 
+@reported_stage('ingest')
 def process_input_files(input_directory: Union[Path, str],
                         source_modules: Union[List[str], List[ModuleType]],
                         output_directory: Union[Path, str],
-                        skip_processed: bool = True) -> None:
+                        skip_processed: bool = True,
+                        resume: bool = False,
+                        memory_budget: Optional[Union[str, int]] = None,
+                        scan_workers: Optional[int] = None) -> None:
+    """Ingest every raw data file into the {source}_{year}.hd5 store for its source and year
+
+    The files are ingested a store at a time. Their tables are written to a working copy of the store, see
+    process.store.StoreWriter, that replaces it once the store's last table is written, and completion markers are
+    then written for them. With resume, tables marked complete by an earlier, interrupted, run are skipped, otherwise
+    the markers are cleared at the start of the run.
+
+    With a memory_budget, see process.memory, tables larger than the budget are stored as chunk parts so later
+    stages read them a part at a time.
+
+    With scan_workers the input directory is listed by that many threads, see process.walker.Walker.
+    """
+
     input_directory = Path(input_directory)
     output_directory = Path(output_directory)
+    budget = resolve_budget(memory_budget)
 
     w = Walker(input_directory,
-               source_modules)
+               source_modules,
+               scan_workers=scan_workers)
+    catalog = StoreCatalog(output_directory)
+    if not resume:
+        clear_markers(output_directory)
+
+    def committed(filepath: Path, tables: List) -> None:
+        catalog.record_tables(filepath.name, {table: entries for table, entries, _ in tables})
+        for table, _, datafile in tables:
+            mark_complete(output_directory, f'{filepath.name}__{table}', source=datafile.source,
+                          input=datafile.filename)
+            logging.info(f'Ingested file {datafile.filename} stored in {filepath.name} with key {table}')
 
+    # The stores are written one at a time, so the files are listed first and grouped by the store they go into
+    stores = dict()
     for datafile in w.walk():
-        logging.info('Processing Input Files:')
-        logging.info(f'Loading {datafile.filename}')
-        logging.info(f'Source: {datafile.source} Table: {datafile.table}, Year: {datafile.year}')
-        filename = Path(f'{datafile.source}_{datafile.year}.hd5')
-        with pd.HDFStore(output_directory / filename) as store:
-            if skip_processed and (f'/{datafile.table}' in store.keys()):
-                logging.info(f'...file already processed. Skipping. Set skip_processed to False to re-ingest')
-                continue
-
-            ingestor = w.mapping.get(datafile.source)['ingestor']
-            logging.info(f'...ingesting file using ingestor for {datafile.source}')
-            ingested = ingestor.ingest(datafile)
-            if ingested is not None:
-                store[datafile.table] = ingested
-                logging.info(
-                    f'Ingested file stored in {datafile.source}_{datafile.year}.hd5 with key {datafile.table}')
+        stores.setdefault(Path(f'{datafile.source}_{datafile.year}.hd5'), []).append(datafile)
 
+    with store_writer(committed) as writer:
+        for filename, datafiles in stores.items():
+            for datafile in datafiles:
+                logging.info('Processing Input Files:')
+                logging.info(f'Loading {datafile.filename}')
+                logging.info(f'Source: {datafile.source} Table: {datafile.table}, Year: {datafile.year}')
+                marker = f'{filename}__{datafile.table}'
+                if resume and is_complete(output_directory, marker):
+                    logging.info(f'...completed earlier in this run. Skipping')
+                    continue
+                if skip_processed and catalog.is_processed(filename, datafile.table):
+                    logging.info(f'...file already processed. Skipping. Set skip_processed to False to re-ingest')
+                    continue
 
+                ingestor = w.mapping.get(datafile.source)['ingestor']
+                logging.info(f'...ingesting file using ingestor for {datafile.source}')
+                ingested = ingestor.ingest(datafile)
+                if budget is not None and isinstance(ingested, pd.DataFrame) and frame_bytes(ingested) > budget:
+                    ingested = split_frame(ingested, budget)
+                    logging.info(f'...{datafile.table} is larger than the memory budget, storing it in '
+                                 f'{len(ingested)} parts')
+                if ingested is not None:
+                    entries = store_ingested(writer.open(output_directory / filename), datafile.table, ingested)
+                    writer.add(output_directory / filename, (datafile.table, entries, datafile))
+            # Once its last table of the run is written the store replaces the original and its tables are marked
+            # complete, so an interrupted run only ingests the tables of the store it stopped in again
+            writer.commit(output_directory / filename)
+
+
+def prepare_ingested(ingested: pd.DataFrame,
+                     id_map: Mapping) -> Optional[pd.DataFrame]:
+    ingested = fix_years(ingested)
+    if ingested is None:
+        return None
+    ingested['id'] = map_ids(ingested.source_institution_id, id_map)
+    return ingested
+
+
+@reported_stage('normalise')
 def normalise_ingested_files(ingested_directory: Union[Path, str],
                              output_directory: Union[Path, str],
                              source_modules: Union[List[str], List[ModuleType]],
-                             skip_processed: bool = False) -> None:
+                             skip_processed: bool = False,
+                             out_of_core: bool = False,
+                             resume: bool = False,
+                             memory_budget: Optional[Union[str, int]] = None) -> None:
+    """Normalise every ingested store to the COKI categories defined by the filter_list of its source
+
+    With out_of_core the tables, and the chunk parts of chunked tables, of each store are read and normalised one at
+    a time and their partial sums combined, so memory is bounded by the largest part rather than the whole store.
+    The results are the same as in memory, where all the tables of a store are concatenated first. With a
+    memory_budget, see process.memory, tables are instead coalesced, or split, into partitions that fit the budget.
+
+    Each output is written to a temporary file that is renamed into place and then marked complete. With resume,
+    stores whose output was marked complete by an earlier, interrupted, run are skipped.
+
+    Each source's filters are compiled once and cached on disk, see process.filter_cache.
+    """
+
     ingested_directory = Path(ingested_directory)
     output_directory = Path(output_directory)
+    budget = resolve_budget(memory_budget)
 
     logging.info('Starting normalisation run \n\n')
 
     w = Walker(ingested_directory,
                source_modules=source_modules)
+    if not resume:
+        clear_markers(output_directory)
 
     for ingested_file in w.walk(stage='ingested'):
 
-        filename = Path(f'{ingested_file.source}_{ingested_file.year}.csv')
+        filename = Path(f'{ingested_file.source}_{ingested_file.year}.parquet')
         logging.info(f'Loading file: {filename}')
         filepath = output_directory / filename
+        if resume and is_complete(output_directory, filename.name):
+            logging.info(f'...{filename} completed earlier in this run. Skipping')
+            continue
         if filepath.is_file() and skip_processed:
-            out_df = pd.read_csv(filepath)
+            previous = read_normalised(filepath, index=True)
             logging.info(f'...{filename} has been previously processed')
         else:
-            out_df = pd.DataFrame()
+            previous = pd.DataFrame()
             logging.info(f'...{filename} was not previously processed')
-        temp_df = pd.DataFrame()
-        filter_list = w.mapping.get(ingested_file.source)['filter_list']
+        filter_list = load_compiled_filters(ingested_file.source)
+        id_map = w.mapping.get(ingested_file.source)['id_map']
+
+        if len(read_pool.get(ingested_file.filepath).keys()) == 0:
+            continue
+
+        partitions = (prepare_ingested(ingested, id_map) for ingested in read_partitions(ingested_file.filepath))
+        if budget is not None and not out_of_core:
+            partitions = within_budget(partitions, budget)
+        elif not out_of_core:
+            partitions = [p for p in partitions if p is not None]
+            partitions = [pd.concat(partitions, ignore_index=True)] if partitions else []
+
+        filter_list = [filters for filters in filter_list if filters.name not in previous.columns]
+        logging.info(f'...running {[filters.name for filters in filter_list]}')
+        out_df = join_normalised(normalise_partitions(partitions, filter_list))
+        if len(previous.columns) > 0:
+            out_df = previous.join(out_df, how='outer')
+        write_normalised(out_df, filepath)
+        mark_complete(output_directory, filename.name, source=ingested_file.source)
+
+
+@reported_stage('cube')
+def cube_ingested_files(ingested_directory: Union[Path, str],
+                        cube_directory: Union[Path, str],
+                        source_modules: Union[List[str], List[ModuleType]],
+                        resume: bool = False) -> None:
+    """Build the CountCube of every ingested store, see process.cube
+
+    Each table, or chunk part, of a store is reduced to a cube in turn and the cubes merged, so memory is bounded by
+    the largest part. The cube files are written through temporary files and marked complete. With resume, cubes
+    marked complete by an earlier, interrupted, run are not rebuilt.
+    """
+
+    ingested_directory = Path(ingested_directory)
+    cube_directory = Path(cube_directory)
+    cube_directory.mkdir(parents=True, exist_ok=True)
+
+    w = Walker(ingested_directory,
+               source_modules=source_modules)
+    if not resume:
+        clear_markers(cube_directory)
+
+    for ingested_file in w.walk(stage='ingested'):
+        stem = f'{ingested_file.source}_{ingested_file.year}'
+        if resume and is_complete(cube_directory, stem):
+            logging.info(f'...cube of {stem} completed earlier in this run. Skipping')
+            continue
         id_map = w.mapping.get(ingested_file.source)['id_map']
+        partitions = (prepare_ingested(ingested, id_map) for ingested in read_partitions(ingested_file.filepath))
+        cube = CountCube.merge(CountCube.from_frame(p) for p in partitions if p is not None)
+        logging.info(f'Built cube of {stem}: {len(cube)} cells, {len(cube.combinations)} combinations')
+        cube.save(cube_directory, stem)
+        mark_complete(cube_directory, stem, source=ingested_file.source)
 
-        with pd.HDFStore(ingested_file.filepath) as store:
-            if len(store.keys()) == 0:
-                continue
-            for table in store.keys():
-                ingested = store[table]
-                ingested = fix_years(ingested)
-                ingested['id'] = ingested.source_institution_id.map(id_map)
-                temp_df = temp_df.append(ingested)
-            for filters in filter_list:
-                if filters.name not in out_df.columns:
-                    logging.info(f'...running {filters.name}')
-                    out_df[filters.name] = normalise(temp_df, filters=filters)
 
-        out_df.to_csv(filepath)
+@reported_stage('normalise_from_cubes')
+def normalise_from_cubes(cube_directory: Union[Path, str],
+                         output_directory: Union[Path, str],
+                         source_modules: Union[List[str], List[ModuleType]],
+                         skip_processed: bool = True) -> None:
+    """Normalise from the cubes built by cube_ingested_files rather than the ingested stores
 
+    The output is the same as normalise_ingested_files. With skip_processed only the filters that are not yet
+    columns of an existing normalised file are run and joined to it, so adding a CategoryFilter to a source's
+    filter_list only costs the new filter, evaluated over the cube.
+    """
 
+    cube_directory = Path(cube_directory)
+    output_directory = Path(output_directory)
+    for stem in cube_stems(cube_directory):
+        matching = [source for source in source_modules if stem.startswith(f'{source}_')]
+        if not matching:
+            continue
+        source = max(matching, key=len)
+        filepath = output_directory / f'{stem}.parquet'
+        if filepath.is_file() and skip_processed:
+            previous = read_normalised(filepath, index=True)
+        else:
+            previous = pd.DataFrame()
+        filter_list = [filters for filters in load_compiled_filters(source) if filters.name not in previous.columns]
+        if not filter_list:
+            logging.info(f'...{stem} has every filter. Skipping')
+            continue
+
+        logging.info(f'Normalising {stem} from its cube: {[filters.name for filters in filter_list]}')
+        out_df = join_normalised(CountCube.load(cube_directory, stem).normalise_list(filter_list))
+        if len(previous.columns) > 0:
+            out_df = previous.join(out_df, how='outer')
+        write_normalised(out_df, filepath)
+
+
+@reported_stage('combine')
 def combine_files(normalised_directory: Union[str, Path],
                   output_directory: Union[str, Path],
                   filename: Union[str, Path],
-                  skip_processed: Optional[bool] = False):
+                  skip_processed: Optional[bool] = False,
+                  out_of_core: bool = False,
+                  resume: bool = False,
+                  query_directory: Optional[Union[str, Path]] = None,
+                  memory_budget: Optional[Union[str, int]] = None):
+    """Combine the normalised files of every source and calculate percentages of the academic total
+
+    With out_of_core each source and year is read, converted to percentages and appended to the output csv in turn
+    rather than loading every country at once. The output is the same as in memory. In both cases the csv is
+    written to a temporary file that is renamed into place when complete. With resume, an output marked complete by
+    an earlier run is not rebuilt. Given a query_directory, the output is also written as a query store there, see
+    process.query. With a memory_budget, see process.memory, the files are combined out of core whenever their
+    Parquet metadata shows they would not fit in the budget.
+    """
+
     logging.info(f'Combining files in {normalised_directory}')
     normalised_directory = Path(normalised_directory)
     output_directory = Path(output_directory)
@@ -113,16 +283,43 @@ def combine_files(normalised_directory: Union[str, Path],
     outpath = output_directory / filename
     if outpath.is_file() and skip_processed:
         return
+    if resume and is_complete(output_directory, filename.name):
+        return
 
-    df = load_files(normalised_directory)
-    pdf = calculate_percentage(df,
-                         numerators=['academic_women_count',
-                                     'academic_indigenous_count',
-                                     'academic_white_count',
-                                     'academic_indigenous_women_count'],
-                         denominator='academic_total_count')
+    numerators = ['academic_women_count',
+                  'academic_indigenous_count',
+                  'academic_white_count',
+                  'academic_indigenous_women_count']
+    denominator = 'academic_total_count'
+    columns = NORMALISED_INDEX + numerators + [denominator]
+    budget = resolve_budget(memory_budget)
+    if budget is not None and not out_of_core:
+        out_of_core = parquet_bytes(normalised_directory.glob('*.parquet')) > budget
+        if out_of_core:
+            logging.info(f'...normalised files are larger than the memory budget, combining out of core')
 
-    pdf.to_csv(output_directory / filename)
+    with atomic_path(outpath) as temp_path:
+        if not out_of_core:
+            df = load_files(normalised_directory, columns=numerators + [denominator])
+            pdf = calculate_percentage(df.reindex(columns=columns),
+                                       numerators=numerators,
+                                       denominator=denominator)
+            pdf.to_csv(temp_path)
+        else:
+            offset = 0
+            header = True
+            for df in iter_normalised(normalised_directory, columns=numerators + [denominator]):
+                df = df.reindex(columns=columns)
+                df.index = pd.RangeIndex(offset, offset + len(df))
+                offset += len(df)
+                pdf = calculate_percentage(df,
+                                           numerators=numerators,
+                                           denominator=denominator)
+                pdf.to_csv(temp_path, mode='w' if header else 'a', header=header)
+                header = False
+    mark_complete(output_directory, filename.name)
+    if query_directory is not None:
+        build_query_store(outpath, query_directory)
 
 
 if __name__ == '__main__':
@@ -144,9 +341,7 @@ if __name__ == '__main__':
     #               filename='combined.csv',
     #               skip_processed=False)
 
-    make_json('../data/ingested',
-              suffix='.hd5',
-              outpath='../data/bq_json/bq_json.json',
-              source_modules=source_modules,
-              write_local=True,
-              write_gbq=False)
+    export_shards('../data/ingested',
+                  output_directory='../data/bq_json',
+                  source_modules=source_modules)
+    memory_report.write_report('../logs/memory_report.json')
@@ -0,0 +1,42 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+"""
+Execution Backend Switch
+
+normalise, filter_df, load_files and calculate_percentage run on pandas by default. Setting the backend to 'polars',
+either with set_backend or the COKI_DIVERSITY_BACKEND environment variable, runs them as lazy, multi-threaded Polars
+queries instead (see polars_backend). Inputs and outputs remain pandas objects in both cases, so the ingestors and
+the rest of the pipeline are unaffected. Polars is an optional dependency and is only imported when selected.
+"""
+
+import os
+
+BACKENDS = ['pandas', 'polars']
+BACKEND_ENVIRONMENT_VARIABLE = 'COKI_DIVERSITY_BACKEND'
+
+_backend = os.environ.get(BACKEND_ENVIRONMENT_VARIABLE, 'pandas')
+
+
+def get_backend() -> str:
+    return _backend
+
+
+def set_backend(backend: str) -> None:
+    global _backend
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown backend {backend}, expected one of {BACKENDS}')
+    _backend = backend
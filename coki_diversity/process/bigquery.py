@@ -1,34 +1,315 @@
+import hashlib
 import logging
 import json
+import re
+import shutil
+import threading
+import time
 import pandas as pd
+from pandas.api.types import is_integer_dtype, is_float_dtype
+from concurrent.futures import Executor, ProcessPoolExecutor
 from pathlib import Path
+from typing import Union, List, Dict, Optional, Type, Mapping, Iterator
 
-from google.cloud import bigquery
-
+from coki_diversity.process.id_index import id_map_hash, map_ids
+from coki_diversity.process.memory import reported_stage, resolve_budget, frame_bytes, spill_frame, unspill
 from coki_diversity.process.normalise import fix_years
+from coki_diversity.process.pipeline import run_pipeline, Stage, QUEUE_SIZE
+from coki_diversity.process.schema import ColumnarRecords, SchemaError, SchemaField, EXPORT_SCHEMA, \
+    validate_records
+from coki_diversity.process.store import read_pool, read_key, atomic_path, mark_complete, is_complete, file_stat
+from coki_diversity.process.shards import write_shards, shard_extension, SHARD_PATTERN, MAX_SHARD_BYTES, \
+    MAX_SHARD_ROWS
 from coki_diversity.process.walker import Walker
 
+MANIFEST_FILENAME = 'manifest.json'
+EXPORT_VERSION = 3
+
+# Tables are converted and their shards written concurrently. export_table is picklable so the work is spread over
+# processes, as json serialisation holds the GIL. A ThreadPoolExecutor may be substituted.
+EXPORT_EXECUTOR: Type[Executor] = ProcessPoolExecutor
+EXPORT_MAX_WORKERS: Optional[int] = None
+
+TABLE_ID = 'coki-scratch-space.staff_demographics.demographics'
+# Rows per streaming insert request, BigQuery recommends at most 500
+INSERT_BATCH_ROWS = 500
+
+
+def export_records(df: pd.DataFrame,
+                   id_map: Mapping,
+                   schema: List[SchemaField] = EXPORT_SCHEMA) -> ColumnarRecords:
+    """The BigQuery records of an ingested frame, rows whose institution has no id in the id_map are dropped
+
+    Rows missing any other non-repeated field of the schema are also dropped, as are rows with fractional values, eg
+    FTE counts, for an INTEGER field, which are logged. The records are conformed to the schema, see validate_records
+    for any values that could not be.
+    """
+
+    df = df.copy()
+    df['id'] = map_ids(df.source_institution_id, id_map)
+    df = fix_years(df)
+    scalar_fields = [field.name for field in schema if not field.repeated and field.name in df.columns]
+    df = df.dropna(subset=scalar_fields)
+    for field in schema:
+        if field.type == 'INTEGER' and field.name in scalar_fields:
+            fractional = (pd.to_numeric(df[field.name], errors='coerce') % 1).fillna(0) != 0
+            if fractional.any():
+                logging.warning(f'...dropping {int(fractional.sum())} rows with fractional {field.name}, '
+                                f'an INTEGER in the export schema')
+                df = df[~fractional]
+    return ColumnarRecords.from_frame(df, schema)
+
+
+def check_records(records: ColumnarRecords,
+                  description: str) -> None:
+    issues = validate_records(records)
+    if issues:
+        logging.error(f'{description} does not match the export schema: {issues}')
+        raise SchemaError(issues)
+
+
+def frame_fingerprint(df: pd.DataFrame,
+                      digest=None):
+    """Add the rows of a frame to a sha256 digest, in order
+
+    Each row is hashed across its columns, so the keys of a table chunked in the store add the same bytes as the
+    table would whole. Column names are left to the caller, see table_fingerprint. Numbers are hashed at full width,
+    so the narrower types ingestors now store leave fingerprints unchanged.
+    """
+
+    digest = digest or hashlib.sha256()
+    columns = dict()
+    for col in df.columns:
+        values = df[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype(object)
+        elif is_integer_dtype(values.dtype):
+            values = values.astype('int64')
+        elif is_float_dtype(values.dtype):
+            values = values.astype('float64')
+        if values.dtype == object:
+            values = values.map(repr)
+        columns[col] = values.to_numpy()
+    rows = pd.DataFrame(columns, index=pd.RangeIndex(len(df)))
+    digest.update(pd.util.hash_pandas_object(rows, index=False).to_numpy().tobytes())
+    return digest
+
+
+def table_fingerprint(store: pd.HDFStore,
+                      keys: List[str],
+                      settings: str) -> str:
+    """A fingerprint of the content of a table's keys in a store and the export settings it is exported with"""
+
+    digest = hashlib.sha256(settings.encode())
+    columns = []
+    for key in keys:
+        df = read_key(store, key)
+        frame_fingerprint(df, digest)
+        columns.extend(col for col in df.columns if col not in columns)
+    digest.update(json.dumps([str(col) for col in columns]).encode())
+    return digest.hexdigest()
+
+
+def export_settings(id_map: Mapping,
+                    shard_options: Dict) -> str:
+    """A hash of everything other than a table's content that its shards depend on"""
+
+    return hashlib.sha256(f'{EXPORT_VERSION} {id_map_fingerprint(id_map)} '
+                          f'{json.dumps(shard_options, sort_keys=True)}'.encode()).hexdigest()
 
-def map_categories(row):
-    return [{'source_category_type': type, 'source_category_value': value}
-            for type, value in zip(row.source_category_type, row.source_category_value)]
 
+def id_map_fingerprint(id_map: Mapping) -> str:
+    return id_map_hash(id_map)
 
-def struct_records(df):
-    assert 'source_category_type' in df.columns
-    assert 'source_category_value' in df.columns
 
-    df['source_categories'] = df.apply(map_categories, axis='columns')
-    out_df = df[['year',
-                 'id',
-                 'source',
-                 'source_institution_id',
-                 'source_institution_name',
-                 'source_categories',
-                 'counts']]
-    return out_df
+def shard_base_name(source: str,
+                    year: str,
+                    table: str,
+                    fingerprint: str) -> str:
+    table = re.sub(r'[^A-Za-z0-9_-]+', '_', table)
+    return f'{source}_{year}_{table}-{fingerprint[:16]}'
 
 
+def load_manifest(output_directory: Union[str, Path]) -> Dict:
+    manifest_path = Path(output_directory) / MANIFEST_FILENAME
+    if not manifest_path.is_file():
+        return dict(export_version=EXPORT_VERSION, shards=[])
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def export_table(filepath: Path,
+                 keys: List[str],
+                 id_map: Mapping,
+                 output_directory: Path,
+                 base_name: str,
+                 **shard_options) -> List[Dict]:
+    """Convert the keys of a table in an ingested store and write them as shards
+
+    Runs in the export worker pool, the store is read through the worker's own read-only handle. The whole table is
+    validated against the export schema before any shard is written, raising a SchemaError if it does not conform.
+    """
+
+    store = read_pool.get(filepath)
+    records = ColumnarRecords.concat([export_records(read_key(store, key), id_map) for key in keys])
+    check_records(records, f'{filepath.name} {base_name}')
+    return write_shards(records, output_directory, base_name, **shard_options)
+
+
+@reported_stage('export')
+def export_shards(dir: Union[str, Path],
+                  output_directory: Union[str, Path],
+                  source_modules: List[str],
+                  suffix: str = '.hd5',
+                  id_map_path: Union[str, Path] = '../data/id_mappings',
+                  format: str = 'jsonl',
+                  compression: Optional[str] = None,
+                  max_shard_bytes: int = MAX_SHARD_BYTES,
+                  max_shard_rows: int = MAX_SHARD_ROWS,
+                  executor: Type[Executor] = EXPORT_EXECUTOR,
+                  max_workers: Optional[int] = EXPORT_MAX_WORKERS,
+                  prune: bool = True) -> Dict:
+    """Export the ingested stores in dir as shards for each source, year and table
+
+    Shards are JSON-lines, optionally gzip or zstd compressed, Parquet or Avro, and capped in size, see shards. The
+    conversion, serialisation and compression of each table runs in a worker pool.
+
+    The shards of a table are named by a fingerprint of its input: the content of the table's keys in the store, the
+    source's id map, the export format version and the format options. Shards whose fingerprint is already in the
+    manifest hold exactly the records their input would produce, so they are not exported again and re-running the
+    export only writes the tables that changed. Shards are written through a temporary file and renamed into place.
+    The manifest also records the size and modification time of the store each table was read from, and while those
+    and the settings are unchanged its shards are kept without reading the table to fingerprint it.
+
+    The manifest, manifest.json in output_directory, lists the current shards with their source, year, table, row
+    count, size, fingerprint and store. It is replaced in a single rename after every shard is written, so loading the
+    shards it lists, eg as a single BigQuery load job that truncates the table, is idempotent. With prune, shards no
+    longer listed in the manifest are then removed.
+    """
+
+    dir = Path(dir)
+    output_directory = Path(output_directory)
+    output_directory.mkdir(parents=True, exist_ok=True)
+    shard_options = dict(format=format,
+                         compression=compression,
+                         max_shard_bytes=max_shard_bytes,
+                         max_shard_rows=max_shard_rows)
+    shard_extension(format, compression)
+
+    previous = dict()
+    previous_tables = dict()
+    for shard in load_manifest(output_directory)['shards']:
+        previous.setdefault(shard['fingerprint'], []).append(shard)
+        previous_tables.setdefault((shard['source'], shard['year'], shard['table']), []).append(shard)
+
+    w = Walker(dir,
+               source_modules,
+               id_map_path=id_map_path)
+
+    shards = []
+    futures = []
+    with executor(max_workers=max_workers) as pool:
+        for f in w.walk(stage='ingested'):
+            if f.filepath.suffix != suffix:
+                continue
+
+            id_map = w.mapping.get(f.source)['id_map']
+            store = read_pool.get(f.filepath)
+            tables = dict()
+            for key in store.keys():
+                tables.setdefault(key.split('/')[1], []).append(key)
+
+            settings = export_settings(id_map, shard_options)
+            stat = file_stat(f.filepath)
+            for table, keys in tables.items():
+                # Shards exported from this same store file with the same settings are current without reading it
+                reuse = previous_tables.get((f.source, str(f.year), table), [])
+                if reuse and all(shard.get('store') == stat and shard.get('settings') == settings
+                                 and (output_directory / shard['name']).is_file() for shard in reuse):
+                    logging.info(f'...{f.source} {f.year} {table} is unchanged, keeping {len(reuse)} shards')
+                    shards.extend(reuse)
+                    continue
+
+                fingerprint = table_fingerprint(store, keys, settings)
+                reuse = previous.get(fingerprint, [])
+                if reuse and all((output_directory / shard['name']).is_file() for shard in reuse):
+                    logging.info(f'...{f.source} {f.year} {table} is unchanged, keeping {len(reuse)} shards')
+                    shards.extend(dict(shard, store=stat, settings=settings) for shard in reuse)
+                    continue
+
+                logging.info(f'Exporting {f.source} {f.year} {table}')
+                table_info = dict(source=f.source, year=str(f.year), table=table, fingerprint=fingerprint,
+                                  format=format, compression=compression, store=stat, settings=settings)
+                future = pool.submit(export_table, f.filepath, keys, id_map, output_directory,
+                                     shard_base_name(f.source, f.year, table, fingerprint), **shard_options)
+                futures.append((future, table_info))
+
+        for future, table_info in futures:
+            shards.extend(dict(**shard, **table_info) for shard in future.result())
+
+    manifest = dict(export_version=EXPORT_VERSION, shards=shards)
+    with atomic_path(output_directory / MANIFEST_FILENAME) as temp_path:
+        with open(temp_path, 'w') as mf:
+            json.dump(manifest, mf, indent=1)
+
+    if prune:
+        current = {shard['name'] for shard in shards}
+        for shard_path in output_directory.iterdir():
+            if SHARD_PATTERN.search(shard_path.name) and shard_path.name not in current:
+                logging.info(f'...removing stale shard {shard_path.name}')
+                shard_path.unlink()
+
+    return manifest
+
+
+class InsertError(RuntimeError):
+    """Rows of a key were rejected by a streaming insert, the rows inserted before the failing request are kept"""
+
+    def __init__(self,
+                 description: str,
+                 inserted: int,
+                 errors: List):
+        super().__init__(f'Inserting {description} failed after {inserted} rows: {errors}')
+        self.inserted = inserted
+        self.errors = errors
+
+
+class LocalClient:
+    """A stand in for the BigQuery client that keeps inserted rows in memory, optionally after a simulated delay
+
+    Anything with insert_rows_json(table_id, json_rows, row_ids=...) returning a list of errors, as
+    google.cloud.bigquery.Client does, can be passed to make_json as its client.
+    """
+
+    def __init__(self,
+                 latency: float = 0.0):
+        self.latency = latency
+        self.rows = dict()
+        self._lock = threading.Lock()
+
+    def insert_rows_json(self,
+                         table_id: str,
+                         json_rows: List[Dict],
+                         row_ids: Optional[List] = None) -> List:
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.rows.setdefault(table_id, []).extend(json_rows)
+        return []
+
+
+def insert_batches(records: ColumnarRecords,
+                   batch_rows: int = INSERT_BATCH_ROWS) -> Iterator[List[Dict]]:
+    """Records as the rows of each streaming insert request, batch_rows at a time
+
+    Each batch is only converted to dicts as it is requested, so the rows of one request are held at a time.
+    """
+
+    for start in range(0, len(records), batch_rows):
+        yield records.slice(start, start + batch_rows).to_dicts()
+
+
+@reported_stage('make_json')
 def make_json(dir,
               suffix,
               outpath,
@@ -36,50 +317,131 @@ def make_json(dir,
               mode='a',
               client=None,
               write_local=True,
-              write_gbq=False):
+              write_gbq=False,
+              resume=False,
+              table_id=TABLE_ID,
+              id_map_path='../data/id_mappings',
+              transform_workers=1,
+              upload_workers=1,
+              queue_size=QUEUE_SIZE,
+              memory_budget=None):
+    """Convert the ingested stores in dir to JSON-nl for BigQuery
+
+    Each key of each store is written to its own part file under {outpath}.parts, through a temporary file that is
+    renamed into place and then marked complete. The parts are then assembled into outpath, which is replaced in a
+    single rename so an interrupted run never leaves it truncated or with duplicated records. With mode 'a' the
+    records already in outpath are kept ahead of the new ones. With resume, parts completed by an earlier,
+    interrupted, run are reused rather than converted again.
+
+    Keys pass through a pipeline of read, transform, write and upload stages, see pipeline, so one key is read while
+    the previous one is converted and the one before that is written and, with write_gbq, inserted into table_id
+    through client, in batches of INSERT_BATCH_ROWS rows using upload_workers concurrent requests. Any client with
+    the insert_rows_json method of the BigQuery client may be passed, eg a LocalClient, otherwise a BigQuery client
+    is created. Returns the time spent in each stage. If any insert request returns errors, the upload of that key
+    stops and make_json raises an InsertError, leaving its part incomplete so a resumed run uploads it again.
+
+    With a memory_budget, see process.memory, frames too large for their share of the budget are spilled to
+    temporary files while they wait for the transform stage, so only the frames being read or converted are held in
+    memory. Insert requests are built a batch at a time in any case.
+    """
+
     dir = Path(dir)
     outpath = Path(outpath)
     logging.info(f'Loading files for conversion to JSON-nl {dir}')
 
     w = Walker(dir,
                source_modules,
-               id_map_path='../data/id_mappings')
+               id_map_path=id_map_path)
+
+    if write_gbq and client is None:
+        # Deferred so that local only exports do not need the google cloud libraries installed
+        from google.cloud import bigquery
+        client = bigquery.Client()
+
+    parts_directory = outpath.parent / f'{outpath.name}.parts'
+    if not resume and parts_directory.is_dir():
+        shutil.rmtree(parts_directory)
+    parts_directory.mkdir(exist_ok=True)
 
-    if ~outpath.is_file() and mode == 'a':
-        outpath.touch()
-    with open(outpath, mode=mode) as outfile:
+    parts = []
+    budget = resolve_budget(memory_budget)
+    # A frame may be held by the read stage, the queue to the transform stage or each transform worker
+    spill_bytes = budget // (queue_size + transform_workers + 1) if budget is not None else None
+    # PyTables handles are not safe to share between threads, the key listing and the read stage take turns
+    store_lock = threading.Lock()
+
+    def keys():
         for f in w.walk(stage='ingested'):
             if f.filepath.suffix != suffix:
                 continue
 
             id_map = w.mapping.get(f.source)['id_map']
-            with pd.HDFStore(f.filepath) as store:
-                for key in store.keys():
-                    df = store[key]
-                    logging.info(f'Converting {key} from {f.source} to json-nl')
-                    df['id'] = df.source_institution_id.map(id_map)
-                    df = fix_years(df)
-                    out_df = struct_records(df)
-                    out_df.dropna(inplace=True)
-
-                    if write_local:
-                        j = out_df.to_dict(orient='records')
-                        if len(j) > 10:
-                            [outfile.write(f'{json.dumps(r)}\n') for r in j]
-
-                    if write_gbq and (len(out_df) > 0):
-                        rows_to_insert = out_df.to_dict(orient='records')[0:100]
-                        table_id = 'coki-scratch-space.staff_demographics.demographics'
-
-                        errors = client.insert_rows_json(
-                            table_id, rows_to_insert, row_ids=[None] * len(rows_to_insert)
-                        )  # Make an API request.
-                        if errors == []:
-                            print(f"New rows have been added for {f.source} {f.year}")
-                        else:
-                            print("Encountered errors while inserting rows: {}".format(errors))
+            with store_lock:
+                store_keys = read_pool.get(f.filepath).keys()
+            for key in store_keys:
+                part = f'{f.filepath.stem}{key.replace("/", "_")}.json'
+                parts.append(part)
+                if resume and is_complete(parts_directory, part):
+                    logging.info(f'...{key} from {f.source} converted earlier in this run')
+                    continue
+                yield f, key, part, id_map
+
+    def read(item):
+        f, key, part, id_map = item
+        with store_lock:
+            df = read_key(read_pool.get(f.filepath), key)
+        if spill_bytes is not None and frame_bytes(df) > spill_bytes:
+            df = spill_frame(df, parts_directory)
+        return f, key, part, id_map, df
+
+    def transform(item):
+        f, key, part, id_map, df = item
+        logging.info(f'Converting {key} from {f.source} to json-nl')
+        df = unspill(df)
+        records = export_records(df, id_map)
+        check_records(records, f'{key} from {f.source}')
+        return (f, key, part,
+                records.json_lines() if write_local else [],
+                insert_batches(records) if write_gbq else None)
+
+    def write(item):
+        f, key, part, lines, batches = item
+        with atomic_path(parts_directory / part) as temp_path:
+            with open(temp_path, 'wb') as partfile:
+                partfile.writelines(lines)
+        return item
+
+    def upload(item):
+        f, key, part, lines, batches = item
+        inserted = 0
+        for rows in batches or []:
+            errors = client.insert_rows_json(table_id, rows, row_ids=[None] * len(rows))
+            if errors:
+                logging.error(f'Encountered errors while inserting rows for {f.source} {key}: {errors}')
+                raise InsertError(f'{key} from {f.source}', inserted, errors)
+            inserted += len(rows)
+        if inserted:
+            logging.info(f'New rows have been added for {f.source} {f.year}')
+
+        # A part is complete once it is written and uploaded, a resumed run does neither again
+        mark_complete(parts_directory, part, source=f.source, key=key)
 
+    stats = run_pipeline(keys(),
+                         [Stage('read', read),
+                          Stage('transform', transform, workers=transform_workers),
+                          Stage('write', write),
+                          Stage('upload', upload, workers=upload_workers)],
+                         queue_size=queue_size)
+    logging.info(f'Converted to JSON-nl: {stats}')
 
+    if write_local:
+        with atomic_path(outpath, copy_existing=(mode == 'a')) as temp_path:
+            with open(temp_path, mode='ab') as outfile:
+                for part in parts:
+                    with open(parts_directory / part, 'rb') as partfile:
+                        shutil.copyfileobj(partfile, outfile)
+    shutil.rmtree(parts_directory)
+    return stats
 
 
 if __name__ == '__main__':
@@ -0,0 +1,170 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+"""
+Category Dictionaries and Filter Validation
+
+The FileFilters in sources/*/filters.py refer to category types and values as plain strings. A typo in one of them
+silently produces zero counts. This module builds, from the ingested stores, a per source and year index of the
+(category type, category value) pairs and count types that the ingestors actually emit, persists it as JSON, and
+validates every FileFilter's reqs against it without running normalisation.
+
+The same pairs define a CategoryDictionary (see normalise), which gives each (type, value) pair an integer code so
+that filters are evaluated as integer comparisons on the exploded pairs of each row rather than string matching row
+by row. CategoryDictionary.from_index builds one from a saved index.
+
+Usage: python categories.py ../../data/ingested ../../data/category_index.json au_det us_ipeds ...
+"""
+
+import argparse
+import json
+import logging
+from pathlib import Path
+from typing import Union, List, Dict, NamedTuple
+
+import pandas as pd
+
+from coki_diversity.process.normalise import fix_years, explode_categories
+from coki_diversity.process.store import read_pool, read_key
+from coki_diversity.process.walker import Walker
+
+
+def observed_categories(df: pd.DataFrame) -> Dict:
+    """The category pairs and count types observed in an ingested frame for each year"""
+
+    row_index, types, values = explode_categories(df)
+    pairs = pd.DataFrame(dict(year=df.year.to_numpy()[row_index], type=types, value=values)).drop_duplicates()
+    if 'source_count_type' in df.columns:
+        count_types = df.groupby('year').source_count_type.unique()
+    else:
+        count_types = pd.Series(dtype=object)
+
+    observed = dict()
+    for year, year_pairs in pairs.groupby('year'):
+        observed[int(year)] = dict(count_types=[c for c in count_types.get(year, []) if isinstance(c, str)],
+                                   categories={typ: sorted(set(v), key=str) for typ, v in
+                                               year_pairs.groupby('type').value})
+    return observed
+
+
+def merge_observed(into: Dict, observed: Dict) -> Dict:
+    for year, year_observed in observed.items():
+        existing = into.setdefault(year, dict(count_types=[], categories=dict()))
+        existing['count_types'] = sorted(set(existing['count_types']).union(year_observed['count_types']))
+        for typ, values in year_observed['categories'].items():
+            existing['categories'][typ] = sorted(set(existing['categories'].get(typ, [])).union(values), key=str)
+    return into
+
+
+def build_category_index(ingested_directory: Union[str, Path],
+                         source_modules: List[str],
+                         id_map_path: Union[str, Path] = '../data/id_mappings') -> Dict:
+    """Index the category pairs and count types in every ingested store by source and year"""
+
+    w = Walker(ingested_directory, source_modules, id_map_path=id_map_path)
+    index = dict()
+    for f in w.walk(stage='ingested'):
+        store = read_pool.get(f.filepath)
+        for key in store.keys():
+            logging.info(f'Indexing categories in {f.filename} {key}')
+            df = fix_years(read_key(store, key))
+            if df is None or len(df) == 0:
+                continue
+            merge_observed(index.setdefault(f.source, dict()), observed_categories(df))
+    return index
+
+
+def save_index(index: Dict, filepath: Union[str, Path]) -> None:
+    with open(filepath, 'w') as f:
+        json.dump({source: {str(year): observed for year, observed in years.items()}
+                   for source, years in index.items()}, f, indent=1, ensure_ascii=False)
+
+
+def load_index(filepath: Union[str, Path]) -> Dict:
+    with open(filepath) as f:
+        index = json.load(f)
+    return {source: {int(year): observed for year, observed in years.items()} for source, years in index.items()}
+
+
+class FilterIssue(NamedTuple):
+    source: str
+    filter_name: str
+    years: List[int]
+    message: str
+
+    def __repr__(self):
+        return f'{self.source} {self.filter_name} {self.years}: {self.message}'
+
+
+def validate_filters(filter_list: List,
+                     index: Dict) -> List[FilterIssue]:
+    """Check every FileFilter of a filter_list against the categories observed in the ingested data
+
+    For the years of each FileFilter that have ingested data, reports requirement types or values, and count types,
+    that do not occur in some of those years, and FileFilters with no ingested data in any of their years.
+    """
+
+    issues = []
+    for category_filter in filter_list:
+        for filefilter in category_filter.filefilters:
+            observed = index.get(filefilter.source, dict())
+            years = sorted(year for year in filefilter.years if year in observed)
+            if not years:
+                issues.append(FilterIssue(filefilter.source, category_filter.name, list(filefilter.years),
+                                          'no ingested data for any year of the filter'))
+                continue
+
+            if filefilter.count_type is not None:
+                missing = [y for y in years if filefilter.count_type not in observed[y]['count_types']]
+                if missing:
+                    issues.append(FilterIssue(filefilter.source, category_filter.name, missing,
+                                              f'count type {filefilter.count_type!r} not found'))
+
+            for category_type, values in filefilter.reqs.items():
+                values = [values] if isinstance(values, str) else values
+                missing = [y for y in years if category_type not in observed[y]['categories']]
+                if missing:
+                    issues.append(FilterIssue(filefilter.source, category_filter.name, missing,
+                                              f'category type {category_type!r} not found'))
+                for value in values:
+                    missing_value = [y for y in years if y not in missing and
+                                     value not in observed[y]['categories'][category_type]]
+                    if missing_value:
+                        issues.append(FilterIssue(filefilter.source, category_filter.name, missing_value,
+                                                  f'value {value!r} not found for category type {category_type!r}'))
+    return issues
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index the categories of ingested data and validate source filters')
+    parser.add_argument('ingested_directory')
+    parser.add_argument('index_path')
+    parser.add_argument('sources', nargs='+')
+    parser.add_argument('--id-map-path', default='../../data/id_mappings')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild the index even if index_path exists')
+    args = parser.parse_args()
+
+    index_path = Path(args.index_path)
+    if index_path.is_file() and not args.rebuild:
+        category_index = load_index(index_path)
+    else:
+        category_index = build_category_index(args.ingested_directory, args.sources, id_map_path=args.id_map_path)
+        save_index(category_index, index_path)
+
+    w = Walker(args.ingested_directory, args.sources, id_map_path=args.id_map_path)
+    for source in args.sources:
+        for issue in validate_filters(w.mapping[source]['filter_list'], category_index):
+            print(issue)
@@ -17,41 +17,91 @@
 import logging
 import pandas as pd
 import numpy as np
-from typing import Union, Tuple, List, Dict, NamedTuple, Optional
+from typing import Union, Tuple, List, Dict, NamedTuple, Optional, Iterator
 from pathlib import Path
 
+from coki_diversity.process.store import read_normalised, NORMALISED_INDEX
+from coki_diversity.process.backend import get_backend
 
-def load_files(dir: Union[str, Path]) -> pd.DataFrame:
-    dir = Path(dir)
 
-    df = pd.DataFrame()
-    audf = pd.read_csv(dir / 'au_det__all_.csv')
-    au_ind = pd.DataFrame()
-    for f in dir.glob('au_indigenous*.csv'):
-        au_ind = au_ind.append(pd.read_csv(f), ignore_index=True)
+AU_INDIGENOUS_COLUMNS = ['academic_indigenous_count', 'academic_indigenous_women_count']
+
+
+def iter_normalised(dir: Union[str, Path],
+                    columns: Optional[List[str]] = None) -> Iterator[pd.DataFrame]:
+    """Read the normalised Parquet files one source and year at a time
+
+    Only the metric columns given in columns, along with the index columns, are read. The au_indigenous counts are
+    merged onto the au_det rows for the same institution and year, and those are yielded last.
 
-    audf = audf.merge(au_ind[['id', 'year', 'academic_indigenous_count', 'academic_indigenous_women_count']],
-                      on=['id', 'year'],
-                      how='outer')
+    Normalised CSV files written before normalised outputs were Parquet are not read, a warning lists any that have
+    no Parquet file alongside them.
+    """
 
-    for f in dir.glob('*.csv'):
+    dir = Path(dir)
+    stale = sorted(f.name for f in dir.glob('*.csv') if not f.with_suffix('.parquet').is_file())
+    if stale:
+        logging.warning(f'{dir} holds normalised CSV files from an earlier version, which are not read. Re-run '
+                        f'normalise_ingested_files to write them as Parquet: {stale}')
+
+    audf = read_normalised(dir / 'au_det__all_.parquet', columns=columns)
+    indigenous_columns = [c for c in AU_INDIGENOUS_COLUMNS if columns is None or c in columns]
+    au_ind_files = sorted(dir.glob('au_indigenous*.parquet'))
+    if indigenous_columns and au_ind_files:
+        au_ind = pd.concat([read_normalised(f, columns=indigenous_columns) for f in au_ind_files],
+                           ignore_index=True)
+        audf = audf.merge(au_ind[['id', 'year'] + [c for c in indigenous_columns if c in au_ind.columns]],
+                          on=['id', 'year'],
+                          how='outer')
+
+    for f in dir.glob('*.parquet'):
         logging.debug(f'Loading file {f}')
         if f.name.startswith('au'):
             continue
         else:
-            df = df.append(pd.read_csv(f), ignore_index=True)
+            yield read_normalised(f, columns=columns)
+
+    yield audf
 
-    df = df.append(audf)
 
+def categorical_index_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Make the string index columns of loaded normalised data categoricals with sorted categories
+
+    read_normalised returns them as categoricals, but concatenating and merging frames only keeps a categorical where
+    every frame has the same categories, so the types of the loaded columns would depend on which files were read.
+    Both backends set them here.
+    """
+
+    for col in NORMALISED_INDEX:
+        if col in df.columns and not pd.api.types.is_numeric_dtype(df[col]):
+            df[col] = df[col].astype(object).astype('category')
     return df
 
 
+def load_files(dir: Union[str, Path],
+               columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Load the normalised Parquet files of every source into a single frame, see iter_normalised
+
+    The string index columns are categoricals, see categorical_index_columns.
+    """
+
+    if get_backend() == 'polars':
+        from coki_diversity.process import polars_backend
+        return polars_backend.load_files(dir, columns=columns)
+
+    return categorical_index_columns(pd.concat(list(iter_normalised(dir, columns=columns)), ignore_index=True))
+
+
 def calculate_percentage(df: pd.DataFrame,
                          numerators: Union[str, List[str]],
                          denominator: str,
                          colname_modifier: 'str' = '_pc_totac',
                          decimals: Optional[int] = 2,
                          inplace: bool = False) -> Union[pd.DataFrame, None]:
+    if get_backend() == 'polars':
+        from coki_diversity.process import polars_backend
+        return polars_backend.calculate_percentage(df, numerators, denominator, colname_modifier=colname_modifier,
+                                                   decimals=decimals, inplace=inplace)
     idf = df.copy(deep=True)
     zeros = np.isin(idf.academic_total_count, 0)
     idf = idf.iloc[~zeros]
@@ -0,0 +1,87 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+"""
+Compiled Filter Cache
+
+A source's filter_list is compiled once, see normalise.compile_filter_list, and the compiled filters are pickled to
+a cache directory under a name holding a hash of the source's filters module and the generic filter classes. Any
+later run, or worker process, with the same filter definitions loads the pickle instead of importing the filters
+module and compiling it again. Editing a filters module changes its hash, so its filters are recompiled on next use
+and the stale pickle is removed. Compiled filters are also kept in memory for the life of the process, so forked
+workers inherit them.
+
+The cache directory defaults to ../data/filter_cache and may be set with the COKI_DIVERSITY_FILTER_CACHE
+environment variable.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+from importlib.util import find_spec
+from pathlib import Path
+from typing import Union, Tuple, Dict
+
+from coki_diversity.process.normalise import CompiledCategoryFilter, compile_filter_list
+from coki_diversity.process.store import atomic_path
+from coki_diversity.sources import available_sources, load_source
+
+COMPILED_FILTERS_VERSION = 1
+FILTER_CACHE_ENVIRONMENT_VARIABLE = 'COKI_DIVERSITY_FILTER_CACHE'
+FILTER_CACHE_DIRECTORY = os.environ.get(FILTER_CACHE_ENVIRONMENT_VARIABLE, '../data/filter_cache')
+
+_compiled: Dict[Tuple[str, str], Tuple[CompiledCategoryFilter, ...]] = dict()
+
+
+def filter_module_hash(source: str) -> str:
+    """sha256 of the source files that define a source's filters, found without importing its filters module"""
+
+    module_path = available_sources()[source]
+    digest = hashlib.sha256(f'{COMPILED_FILTERS_VERSION}'.encode())
+    for name in [f'{module_path}.filters', 'coki_diversity.sources.generic.classes']:
+        with open(find_spec(name).origin, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def load_compiled_filters(source: str,
+                          cache_directory: Union[str, Path] = FILTER_CACHE_DIRECTORY
+                          ) -> Tuple[CompiledCategoryFilter, ...]:
+    """The compiled filter_list of a source, from memory, the cache directory or compiled and then cached"""
+
+    module_hash = filter_module_hash(source)
+    if (source, module_hash) in _compiled:
+        return _compiled[(source, module_hash)]
+
+    cache_directory = Path(cache_directory)
+    cache_path = cache_directory / f'{source}-{module_hash[:16]}.pickle'
+    if cache_path.is_file():
+        with open(cache_path, 'rb') as f:
+            compiled = pickle.load(f)
+    else:
+        logging.info(f'Compiling the filters of {source}')
+        compiled = compile_filter_list(load_source(source).filter_list)
+        cache_directory.mkdir(parents=True, exist_ok=True)
+        with atomic_path(cache_path) as temp_path:
+            with open(temp_path, 'wb') as f:
+                pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+        for stale in cache_directory.glob(f'{source}-*.pickle'):
+            if stale != cache_path:
+                stale.unlink()
+
+    _compiled[(source, module_hash)] = compiled
+    return compiled
@@ -0,0 +1,170 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+"""
+Binary ID Map Index
+
+utils/build_id_maps.py writes each ID map both as {prefix}_id_map.json and as {prefix}_id_map.idx, a binary index
+that IdIndex memory maps. Opening an index only reads its header, lookups binary search the sorted keys in the
+mapped file, so loading an ID map no longer means parsing the whole JSON file.
+
+The index is a header followed by the byte offsets of each key and value and then the keys, UTF-8 encoded and in
+byte order, and the values, each JSON encoded so nulls survive. The header holds the number of entries, a
+fingerprint of the inputs the map was built from, used to skip unchanged rebuilds, and the id_map_hash of its
+content, used by the export to fingerprint shards without reading every entry.
+"""
+
+import hashlib
+import json
+import mmap
+import struct
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Union, Dict
+
+import numpy as np
+import pandas as pd
+
+from coki_diversity.process.store import atomic_path
+
+MAGIC = b'COKIIDX1'
+HEADER = struct.Struct('<8sQ64s64s')
+
+_MISSING = object()
+
+
+def id_map_hash(id_map: Mapping) -> str:
+    """sha256 of the content of an ID map, independent of its order or storage"""
+
+    content_hash = getattr(id_map, 'content_hash', None)
+    if content_hash is not None:
+        return content_hash
+    return hashlib.sha256(json.dumps(sorted((str(k), str(v)) for k, v in id_map.items())).encode()).hexdigest()
+
+
+def write_id_index(id_map: Dict[str, object],
+                   filepath: Union[str, Path],
+                   input_fingerprint: str = '') -> None:
+    """Write an ID map, with string keys as read from its JSON file, as a binary index"""
+
+    items = sorted((str(key).encode(), json.dumps(value).encode()) for key, value in id_map.items())
+    keys = [key for key, _ in items]
+    values = [value for _, value in items]
+    key_offsets = np.concatenate([[0], np.cumsum([len(key) for key in keys], dtype=np.uint64)]).astype(np.uint64)
+    value_offsets = np.concatenate([[0], np.cumsum([len(value) for value in values], dtype=np.uint64)]
+                                   ).astype(np.uint64)
+
+    with atomic_path(filepath) as temp_path:
+        with open(temp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(items), input_fingerprint.encode().ljust(64),
+                                id_map_hash(id_map).encode()))
+            f.write(key_offsets.tobytes())
+            f.write(value_offsets.tobytes())
+            f.write(b''.join(keys))
+            f.write(b''.join(values))
+
+
+class IdIndex(Mapping):
+    """A read only mapping over a binary ID map index, see module docstring
+
+    Pickles as its path, so passing one to a worker process reopens the index rather than copying its entries.
+    """
+
+    def __init__(self,
+                 filepath: Union[str, Path]):
+        self.filepath = Path(filepath)
+        with open(self.filepath, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._size, input_fingerprint, content_hash = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{self.filepath} is not an ID map index')
+        self.input_fingerprint = input_fingerprint.decode().strip()
+        self.content_hash = content_hash.decode()
+
+        offset = HEADER.size
+        self._key_offsets = np.frombuffer(self._mm, dtype=np.uint64, count=self._size + 1, offset=offset)
+        offset += self._key_offsets.nbytes
+        self._value_offsets = np.frombuffer(self._mm, dtype=np.uint64, count=self._size + 1, offset=offset)
+        self._keys_start = offset + self._value_offsets.nbytes
+        self._values_start = self._keys_start + int(self._key_offsets[-1])
+
+    def __reduce__(self):
+        return IdIndex, (self.filepath,)
+
+    def __len__(self):
+        return self._size
+
+    def _key(self,
+             position: int) -> bytes:
+        return self._mm[self._keys_start + int(self._key_offsets[position]):
+                        self._keys_start + int(self._key_offsets[position + 1])]
+
+    def _value(self,
+               position: int):
+        return json.loads(self._mm[self._values_start + int(self._value_offsets[position]):
+                                   self._values_start + int(self._value_offsets[position + 1])])
+
+    def _find(self,
+              key) -> int:
+        if not isinstance(key, str):
+            return -1
+        target = key.encode()
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self._size and self._key(lo) == target else -1
+
+    def __getitem__(self, key):
+        position = self._find(key)
+        if position < 0:
+            raise KeyError(key)
+        return self._value(position)
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __iter__(self):
+        for position in range(self._size):
+            yield self._key(position).decode()
+
+    def items(self):
+        return ((self._key(position).decode(), self._value(position)) for position in range(self._size))
+
+
+def map_ids(values: pd.Series,
+            id_map: Mapping) -> pd.Series:
+    """Series.map with an ID map, an IdIndex is only asked for the distinct values of the series
+
+    Mapping a categorical series returns a categorical, its categories are sorted so that grouping by the ids orders
+    them as it would ids of strings.
+    """
+
+    if isinstance(id_map, dict):
+        mapped = values.map(id_map)
+    else:
+        found = dict()
+        for value in pd.unique(values):
+            mapped = id_map.get(value, _MISSING)
+            if mapped is not _MISSING:
+                found[value] = mapped
+        mapped = values.map(found)
+    if isinstance(mapped.dtype, pd.CategoricalDtype):
+        mapped = mapped.cat.reorder_categories(mapped.cat.categories.sort_values())
+    return mapped
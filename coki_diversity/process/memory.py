@@ -0,0 +1,269 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+"""
+Memory Budget and Peak Memory Report
+
+A memory budget, in bytes, caps the size of the intermediates each stage holds at once. It is passed to a stage as
+memory_budget, eg '2G', or set for every stage with the COKI_DIVERSITY_MEMORY_BUDGET environment variable. Without
+a budget the stages behave as before. With one:
+
+* ingested tables larger than the budget are stored as chunk parts, so every later stage reads them a part at a time
+* normalise coalesces small tables, and splits large ones, into partitions that fit the budget
+* combine_files streams one source and year at a time when the normalised files would not fit
+* make_json spills frames waiting between its pipeline stages to temporary files, see spill_frame
+
+Sizes are estimates from frame_bytes, which samples the rows of object columns rather than measuring every value.
+
+memory_report records the peak resident memory of the process during each stage, sampled in a background thread,
+and write_report saves it as JSON, so a job's stages can be sized against the memory of the worker it runs on. The
+peak of worker processes, eg of export_shards, is only kept by the operating system as the largest of any child
+process that has finished so far, so the report records it once for the run rather than for each stage.
+"""
+
+import functools
+import inspect
+import json
+import logging
+import os
+import re
+import resource
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Union, List, Dict, Iterable, Iterator, Optional, Callable
+
+import numpy as np
+import pandas as pd
+
+from coki_diversity.process.store import TEMP_PREFIX, atomic_path
+
+MEMORY_BUDGET_ENVIRONMENT_VARIABLE = 'COKI_DIVERSITY_MEMORY_BUDGET'
+SAMPLE_ROWS = 1000
+SAMPLE_INTERVAL = 0.05
+
+_UNITS = {'': 1, 'k': 2 ** 10, 'm': 2 ** 20, 'g': 2 ** 30, 't': 2 ** 40}
+
+
+def parse_size(size: Union[str, int, None]) -> Optional[int]:
+    """A size in bytes from an int or a string such as '512M' or '2G', None for no size"""
+
+    if size is None or isinstance(size, int):
+        return size
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*', size.lower())
+    if not match:
+        raise ValueError(f'{size} is not a size, expected eg 2G or 512M')
+    return int(float(match.group(1)) * _UNITS[match.group(2)])
+
+
+def resolve_budget(budget: Union[str, int, None] = None) -> Optional[int]:
+    """The memory budget in bytes, budget if given, otherwise from the environment, or None for no budget"""
+
+    if budget is None:
+        budget = os.environ.get(MEMORY_BUDGET_ENVIRONMENT_VARIABLE)
+    return parse_size(budget)
+
+
+def frame_bytes(df: pd.DataFrame,
+                sample_rows: int = SAMPLE_ROWS) -> int:
+    """Estimated memory of a frame, object columns are measured over a sample of rows and scaled up"""
+
+    if len(df) == 0:
+        return 0
+    shallow = df.memory_usage(index=True, deep=False)
+    objects = [col for col in df.columns if df[col].dtype == object]
+    if not objects:
+        return int(shallow.sum())
+    sample = df[objects].iloc[np.linspace(0, len(df) - 1, min(sample_rows, len(df))).astype(int)]
+    per_row = (sample.memory_usage(index=False, deep=True).sum() -
+               sample.memory_usage(index=False, deep=False).sum()) / len(sample)
+    return int(shallow.sum() + per_row * len(df))
+
+
+def split_frame(df: pd.DataFrame,
+                max_bytes: int) -> List[pd.DataFrame]:
+    """Row slices of a frame each estimated to fit in max_bytes"""
+
+    parts = max(1, int(np.ceil(frame_bytes(df) / max(max_bytes, 1))))
+    if parts == 1:
+        return [df]
+    bounds = np.linspace(0, len(df), parts + 1).astype(int)
+    return [df.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def within_budget(partitions: Iterable[pd.DataFrame],
+                  budget: int) -> Iterator[pd.DataFrame]:
+    """Coalesce partitions into frames that fit in budget, splitting any that are larger than it on their own
+
+    Used where the partitions of a frame can be processed independently and their results combined, as for
+    normalise_partitions, so the result is the same as for the frame as a whole.
+    """
+
+    pending = []
+    pending_bytes = 0
+    for partition in partitions:
+        if partition is None or len(partition) == 0:
+            continue
+        size = frame_bytes(partition)
+        if pending and pending_bytes + size > budget:
+            yield pd.concat(pending, ignore_index=True)
+            pending, pending_bytes = [], 0
+        if size > budget:
+            yield from split_frame(partition, budget)
+            continue
+        pending.append(partition)
+        pending_bytes += size
+    if pending:
+        yield pd.concat(pending, ignore_index=True)
+
+
+def parquet_bytes(paths: Iterable[Union[str, Path]]) -> int:
+    """The uncompressed size of the row groups of Parquet files, from their metadata"""
+
+    import pyarrow.parquet as pq
+    total = 0
+    for path in paths:
+        metadata = pq.ParquetFile(path).metadata
+        total += sum(metadata.row_group(i).total_byte_size for i in range(metadata.num_row_groups))
+    return total
+
+
+class SpilledFrame:
+    """A frame written to a temporary file by spill_frame, load reads it back and removes the file"""
+
+    def __init__(self,
+                 path: Path,
+                 rows: int):
+        self.path = path
+        self.rows = rows
+
+    def __len__(self):
+        return self.rows
+
+    def load(self) -> pd.DataFrame:
+        df = pd.read_hdf(self.path, 'spilled')
+        self.path.unlink()
+        return df
+
+
+def spill_frame(df: pd.DataFrame,
+                directory: Union[str, Path]) -> SpilledFrame:
+    """Write a frame to a temporary file in directory
+
+    Spilled frames use the fixed HDF5 format of the ingest stores, so any frame read from a store, including its
+    columns of category lists, is read back unchanged.
+    """
+
+    path = Path(directory) / f'{TEMP_PREFIX}spill_{uuid.uuid4().hex[:12]}.hd5'
+    df.to_hdf(path, 'spilled', mode='w')
+    return SpilledFrame(path, len(df))
+
+
+def unspill(item: Union[pd.DataFrame, SpilledFrame]) -> pd.DataFrame:
+    return item.load() if isinstance(item, SpilledFrame) else item
+
+
+def current_rss() -> int:
+    """Resident memory of this process in bytes, or its peak where the current value is not available"""
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return _maxrss(resource.RUSAGE_SELF)
+
+
+def _maxrss(who: int) -> int:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class MemoryReport:
+    """Peak resident memory of each stage of a run, see module docstring"""
+
+    def __init__(self,
+                 interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stages: List[Dict] = []
+
+    @contextmanager
+    def stage(self,
+              name: str,
+              budget: Optional[int] = None) -> Iterator[Dict]:
+        """Record the peak resident memory while the body runs, sampled every interval seconds"""
+
+        entry = dict(stage=name, budget=budget, start_rss=current_rss())
+        entry['peak_rss'] = entry['start_rss']
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(self.interval):
+                entry['peak_rss'] = max(entry['peak_rss'], current_rss())
+
+        sampler = threading.Thread(target=sample, name=f'memory-{name}', daemon=True)
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            yield entry
+        finally:
+            done.set()
+            sampler.join()
+            entry['end_rss'] = current_rss()
+            entry['peak_rss'] = max(entry['peak_rss'], entry['end_rss'])
+            entry['wall'] = round(time.perf_counter() - start, 3)
+            self.stages.append(entry)
+            logging.info(f'Memory: {name} peak {entry["peak_rss"] / 2 ** 20:.0f} MiB'
+                         f'{f" of a {budget / 2 ** 20:.0f} MiB budget" if budget else ""}')
+
+    def peaks(self) -> Dict[str, int]:
+        """The highest peak of each stage name"""
+
+        peaks = dict()
+        for entry in self.stages:
+            peaks[entry['stage']] = max(peaks.get(entry['stage'], 0), entry['peak_rss'])
+        return peaks
+
+    def write_report(self,
+                     filepath: Union[str, Path]) -> None:
+        with atomic_path(filepath) as temp_path:
+            with open(temp_path, 'w') as f:
+                json.dump(dict(stages=self.stages, peaks=self.peaks(),
+                               children_peak_rss=_maxrss(resource.RUSAGE_CHILDREN)), f, indent=2)
+
+
+memory_report = MemoryReport()
+
+
+def reported_stage(name: str) -> Callable:
+    """Decorate a stage function so that each call is recorded in memory_report under name
+
+    The budget recorded is the stage's memory_budget argument, or the budget from the environment.
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            budget = resolve_budget(signature.bind(*args, **kwargs).arguments.get('memory_budget'))
+            with memory_report.stage(name, budget):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,43 +1,239 @@
 import logging
+from itertools import chain
 import pandas as pd
 import numpy as np
-from typing import Union, Tuple, List, Dict, NamedTuple
+from pandas.api.types import is_integer_dtype, is_float_dtype
+from typing import Union, Tuple, List, Dict, NamedTuple, Optional, Iterable, FrozenSet
 from coki_diversity.sources.generic import FileFilter, CategoryFilter
+from coki_diversity.process.store import NORMALISED_INDEX
+from coki_diversity.process.backend import get_backend
+
+
+class CategoryDictionary:
+    """Integer codes for (category type, category value) pairs"""
+
+    def __init__(self,
+                 pairs: Iterable[Tuple[str, str]]):
+        pairs = sorted(set(pairs), key=str)
+        self.pairs = pd.MultiIndex.from_arrays([[p[0] for p in pairs], [p[1] for p in pairs]],
+                                               names=['type', 'value'])
+
+    def __len__(self):
+        return len(self.pairs)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> 'CategoryDictionary':
+        row_index, types, values = explode_categories(df)
+        return cls(zip(types, values))
+
+    @classmethod
+    def from_index(cls, index: Dict, sources: Optional[List[str]] = None) -> 'CategoryDictionary':
+        pairs = set()
+        for source, years in index.items():
+            if sources is not None and source not in sources:
+                continue
+            for observed in years.values():
+                pairs.update((typ, value) for typ, values in observed['categories'].items() for value in values)
+        return cls(pairs)
+
+    def encode(self,
+               types: Union[List, np.ndarray],
+               values: Union[List, np.ndarray]) -> np.ndarray:
+        """Codes for parallel arrays of category types and values, -1 where a pair is not in the dictionary"""
+
+        if len(types) == 0:
+            return np.array([], dtype=np.int64)
+        return self.pairs.get_indexer(pd.MultiIndex.from_arrays([types, values]))
+
+    def codes_for(self,
+                  category_type: str,
+                  values: Union[str, List[str]]) -> np.ndarray:
+        """Codes for a FileFilter requirement, values may be a single value or a list of them"""
+
+        values = [values] if isinstance(values, str) else list(values)
+        codes = self.encode([category_type] * len(values), values)
+        return codes[codes >= 0]
+
+
+class CompiledFileFilter(NamedTuple):
+    """A FileFilter with its years as an array and each requirement as the codes of its (type, value) pairs"""
+    source: str
+    years: np.ndarray
+    count_type: Optional[str]
+    reqs: Tuple[Tuple[str, FrozenSet[str]], ...]
+    codes: Tuple[np.ndarray, ...]
+
+
+class CompiledCategoryFilter(NamedTuple):
+    """A CategoryFilter compiled by compile_filter_list, immutable and cheap to pickle
+
+    The index maps each (year, count_type) to the positions of its FileFilters. Requirement codes index the
+    dictionary shared by every filter of the list, which holds only the pairs named in requirements, so data is
+    encoded against it rather than against a dictionary of the data.
+    """
+    name: str
+    source: str
+    filefilters: Tuple[CompiledFileFilter, ...]
+    index: Tuple[Tuple[Tuple[int, Optional[str]], Tuple[int, ...]], ...]
+    dictionary: CategoryDictionary
+
+    def filters_for(self,
+                    year: int,
+                    count_type: Optional[str] = None) -> List[CompiledFileFilter]:
+        keys = [(year, None)] + ([(year, count_type)] if count_type is not None else [])
+        index = dict(self.index)
+        return [self.filefilters[position] for key in keys for position in index.get(key, ())]
+
+
+def _readonly(values: np.ndarray) -> np.ndarray:
+    values.setflags(write=False)
+    return values
+
+
+def compile_filter_list(filter_list: List[CategoryFilter]) -> Tuple[CompiledCategoryFilter, ...]:
+    """Compile the CategoryFilters of a source's filter_list, see CompiledCategoryFilter
+
+    Requirement values, which may be a list or a single string, become frozensets and are encoded once against a
+    dictionary of every pair the filters name. Years become sorted integer arrays.
+    """
+
+    requirements = [[(category_type, frozenset([values] if isinstance(values, str) else values))
+                     for category_type, values in filefilter.reqs.items()]
+                    for filters in filter_list for filefilter in filters.filefilters]
+    dictionary = CategoryDictionary((category_type, value)
+                                    for reqs in requirements for category_type, values in reqs for value in values)
+
+    compiled = []
+    reqs_iter = iter(requirements)
+    for filters in filter_list:
+        filefilters = []
+        for filefilter in filters.filefilters:
+            reqs = tuple(next(reqs_iter))
+            codes = tuple(_readonly(np.sort(dictionary.codes_for(category_type, sorted(values, key=str))))
+                          for category_type, values in reqs)
+            filefilters.append(CompiledFileFilter(source=filefilter.source,
+                                                  years=_readonly(np.array(sorted(filefilter.years), dtype=np.int64)),
+                                                  count_type=filefilter.count_type,
+                                                  reqs=reqs,
+                                                  codes=codes))
+        positions = {id(filefilter): position for position, filefilter in enumerate(filters.filefilters)}
+        index = tuple((key, tuple(positions[id(filefilter)] for filefilter in indexed))
+                      for key, indexed in filters.index.items())
+        compiled.append(CompiledCategoryFilter(name=filters.name,
+                                               source=filters.source,
+                                               filefilters=tuple(filefilters),
+                                               index=index,
+                                               dictionary=dictionary))
+    return tuple(compiled)
+
+
+def is_compiled(filters) -> bool:
+    # Duck typed, as the package may be imported under two names and so hold two copies of the class
+    return getattr(filters, 'dictionary', None) is not None
+
+
+def requirement_codes(filefilter,
+                      dictionary: CategoryDictionary) -> List[np.ndarray]:
+    """The codes of each requirement of a FileFilter, precomputed for a CompiledFileFilter"""
+
+    codes = getattr(filefilter, 'codes', None)
+    if codes is not None:
+        return list(codes)
+    return [dictionary.codes_for(category_type, category_values)
+            for category_type, category_values in filefilter.reqs.items()]
+
+
+def filefilter_years(filefilter) -> Union[np.ndarray, List[int]]:
+    return filefilter.years if isinstance(filefilter.years, np.ndarray) else list(filefilter.years)
+
+
+def explode_categories(df: pd.DataFrame) -> Tuple[np.ndarray, List, List]:
+    """Flatten the category lists of each row into parallel arrays of row position, type and value"""
+
+    lengths = np.fromiter(map(len, df.source_category_type), dtype=np.int64, count=len(df))
+    row_index = np.repeat(np.arange(len(df)), lengths)
+    types = list(chain.from_iterable(df.source_category_type))
+    values = list(chain.from_iterable(df.source_category_value))
+    return row_index, types, values
 
 
 def normalise(df: pd.DataFrame,
               filters: CategoryFilter,
+              dictionary: Optional[CategoryDictionary] = None,
               **kwargs) -> pd.Series:
-    sources = df.source.unique()
-    years = df.year.unique()
+    """Sum the counts of the rows of df selected by a CategoryFilter for each institution and year
+
+    The data is partitioned by source, year and count type and the applicable FileFilters for each partition are
+    looked up in the CategoryFilter's index, so only those filters are evaluated against its rows. A
+    CategoryDictionary covering the data can be passed in, otherwise one is built from the data.
+    """
+
+    if get_backend() == 'polars':
+        from coki_diversity.process import polars_backend
+        return polars_backend.normalise(df, filters, dictionary=dictionary)
+
     if 'source_count_type' in df.columns:
-        count_types = df.source_count_type.unique()
+        count_types = df.source_count_type
     else:
-        count_types = []
-
-    relevant_filefilters = [f for f in filters.filefilters
-                            if (
-                                    (f.source in sources) and
-                                    (bool(set(f.years).intersection(years))) and
-                                    (f.count_type in count_types if f.count_type is not None else True)
-                            )
-                            ]
-
-    if bool(relevant_filefilters):
-        relevant_filters = CategoryFilter(name=filters.name,
-                                          filefilters=relevant_filefilters
-                                          )
-        logging.debug(f'Selected the following relevant filters for {filters.name}')
+        count_types = pd.Series(None, index=df.index, dtype=object)
+
+    filtered = []
+    for (source, year, count_type), partition in df.groupby([df.source, df.year, count_types],
+                                                            sort=False, dropna=False, observed=True):
+        if source != filters.source:
+            continue
+        relevant_filefilters = filters.filters_for(year, count_type if isinstance(count_type, str) else None)
+        if not relevant_filefilters:
+            continue
+
+        if is_compiled(filters):
+            relevant_filters = filters._replace(filefilters=tuple(relevant_filefilters))
+        else:
+            relevant_filters = CategoryFilter(name=filters.name,
+                                              filefilters=relevant_filefilters)
+        logging.debug(f'Selected the following relevant filters for {filters.name} {year} {count_type}')
         logging.debug([f for f in relevant_filters.filefilters])
-        filtered = filter_df(df, relevant_filters)
-        output_series = filtered.groupby(['id', 'year', 'source', 'source_institution_name'])['counts'].agg('sum')
+        filtered.append(filter_df(partition, relevant_filters, dictionary=dictionary))
+
+    if bool(filtered):
+        filtered = pd.concat(filtered)
+        output_series = filtered.groupby(['id', 'year', 'source', 'source_institution_name'],
+                                       observed=True)['counts'].agg('sum').sort_index()
 
     else:
-        output_series = pd.Series()
+        output_series = pd.Series(dtype=float)
 
     return output_series
 
 
+def normalise_partitions(partitions: Iterable[pd.DataFrame],
+                         filter_list: List[CategoryFilter]) -> Dict[str, pd.Series]:
+    """Run every CategoryFilter of a filter_list over a sequence of partitions of ingested data
+
+    The output of normalise is a sum for each institution and year, so each partition is normalised on its own and
+    its partial sums are folded into the running totals before the next partition is read. Only one partition and
+    the totals, one row per institution and year, are held in memory. Passing the whole of the data as a single
+    partition gives the same result as calling normalise directly.
+    """
+
+    totals = {filters.name: pd.Series(dtype=float) for filters in filter_list}
+    for partition in partitions:
+        if partition is None or len(partition) == 0:
+            continue
+        # Compiled filters carry their own dictionary
+        dictionary = None if all(map(is_compiled, filter_list)) else CategoryDictionary.from_frame(partition)
+        for filters in filter_list:
+            partial = normalise(partition, filters=filters, dictionary=dictionary)
+            if len(partial) == 0:
+                continue
+            if len(totals[filters.name]) == 0:
+                totals[filters.name] = partial
+            else:
+                totals[filters.name] = pd.concat([totals[filters.name], partial]).groupby(
+                    level=NORMALISED_INDEX, observed=True).sum().sort_index()
+    return totals
+
+
 def filter_row(row,
                filters,
                **kwargs):
@@ -55,21 +251,64 @@ def filter_row(row,
     ])
 
 
+def filter_mask(df: pd.DataFrame,
+                filters: CategoryFilter,
+                dictionary: Optional[CategoryDictionary] = None) -> np.ndarray:
+    """Vectorised equivalent of applying filter_row to every row of df
+
+    The category lists are exploded into one (type, value) pair per element and encoded as integer codes. Each
+    requirement of a FileFilter becomes a set of codes, a row meets the requirement if any of its pairs has one of
+    those codes, and a row is selected if it meets every requirement of any of the FileFilters.
+    """
+
+    row_index, types, values = explode_categories(df)
+    if is_compiled(filters):
+        dictionary = filters.dictionary
+    elif dictionary is None:
+        dictionary = CategoryDictionary(zip(types, values))
+    pair_codes = dictionary.encode(types, values)
+
+    sources = df.source.to_numpy()
+    years = df.year.to_numpy()
+    if 'source_count_type' in df.columns:
+        count_types = df.source_count_type.to_numpy()
+    else:
+        count_types = None
+
+    mask = np.zeros(len(df), dtype=bool)
+    for filefilter in filters.filefilters:
+        selected = (sources == filefilter.source) & np.isin(years, filefilter_years(filefilter))
+        if filefilter.count_type is not None:
+            if count_types is None:
+                continue
+            selected &= (count_types == filefilter.count_type)
+        for codes in requirement_codes(filefilter, dictionary):
+            matched = np.isin(pair_codes, codes)
+            selected &= np.bincount(row_index[matched], minlength=len(df)) > 0
+        mask |= selected
+
+    return mask
+
+
 def filter_df(df,
               filters,
+              dictionary: Optional[CategoryDictionary] = None,
               **kwargs):
-    bool_series = df.apply(filter_row, args=[filters], kwds=kwargs, axis='columns')
-    return df[bool_series]
+    if get_backend() == 'polars':
+        from coki_diversity.process import polars_backend
+        return polars_backend.filter_df(df, filters, dictionary=dictionary)
+    return df[filter_mask(df, filters, dictionary=dictionary)]
 
 
 def fix_years(df):
-    if df.year.dtype == int:
+    if is_integer_dtype(df.year):
         return df
-    elif df.year.dtype == float:
+    elif is_float_dtype(df.year):
         df.year = df.year.astype(int, errors='ignore')
         return df
-    elif len(df.year[0]) == 7:
-        df.year = df.year.apply(lambda x: int(x[0:2] + x[5:7]))
+    elif len(df.year.iloc[0]) == 7:
+        # Academic years, eg 2015/16, converted once per distinct value
+        df.year = df.year.astype(object).map({year: int(year[0:2] + year[5:7]) for year in df.year.unique()})
         return df
     else:
         return None
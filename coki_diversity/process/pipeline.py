@@ -0,0 +1,141 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+"""
+Staged Pipelines
+
+run_pipeline passes items through a sequence of stages, eg read, transform and upload, each running in its own
+threads and connected by bounded queues. While one item is being uploaded the next is being transformed and the one
+after read, so the wall time approaches that of the slowest stage rather than the sum of the stages. A full queue
+blocks the stage feeding it, so a slow stage holds back the stages before it rather than letting items pile up in
+memory.
+
+Threads suit stages that wait on disk or the network, or that spend their time in numpy and pandas, which release
+the GIL. Each stage function takes an item and returns the item for the next stage, or None to drop it. The first
+exception raised by any stage stops the pipeline and is re-raised by run_pipeline.
+"""
+
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Iterable, List, Dict, NamedTuple, Any
+
+QUEUE_SIZE = 4
+
+_DONE = object()
+
+
+class Stage(NamedTuple):
+    name: str
+    func: Callable[[Any], Any]
+    workers: int = 1
+
+
+class PipelineStats(NamedTuple):
+    wall: float
+    busy: Dict[str, float]
+    items: Dict[str, int]
+
+    def __repr__(self):
+        stages = ', '.join(f'{name} {busy:.2f}s/{self.items[name]} items' for name, busy in self.busy.items())
+        return f'wall {self.wall:.2f}s, {stages}'
+
+
+def run_pipeline(items: Iterable,
+                 stages: List[Stage],
+                 queue_size: int = QUEUE_SIZE) -> PipelineStats:
+    """Pass every item through the stages, returning the wall time and the time each stage spent working
+
+    The busy time of a stage with several workers is summed over its workers.
+    """
+
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    stop = threading.Event()
+    errors = []
+    busy = {stage.name: 0.0 for stage in stages}
+    counts = {stage.name: 0 for stage in stages}
+    lock = threading.Lock()
+
+    def put(q, item):
+        # Blocks while the queue is full, giving up if the pipeline has been stopped
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def feed():
+        try:
+            for item in items:
+                if not put(queues[0], item):
+                    return
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put(queues[0], _DONE)
+
+    remaining = [stage.workers for stage in stages]
+
+    def work(position, stage):
+        inbox = queues[position]
+        outbox = queues[position + 1] if position + 1 < len(stages) else None
+        while not stop.is_set():
+            try:
+                item = inbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                # Passed back for the stage's other workers, the last one signals the next stage
+                with lock:
+                    remaining[position] -= 1
+                    last = remaining[position] == 0
+                if not last:
+                    put(inbox, _DONE)
+                elif outbox is not None:
+                    put(outbox, _DONE)
+                return
+            try:
+                start = time.perf_counter()
+                result = stage.func(item)
+                with lock:
+                    busy[stage.name] += time.perf_counter() - start
+                    counts[stage.name] += 1
+            except BaseException as e:
+                logging.error(f'Pipeline stage {stage.name} failed: {e!r}')
+                errors.append(e)
+                stop.set()
+                return
+            if result is not None and outbox is not None:
+                put(outbox, result)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=feed, name='pipeline-feed', daemon=True)]
+    for position, stage in enumerate(stages):
+        threads.extend(threading.Thread(target=work, args=(position, stage), name=f'pipeline-{stage.name}-{i}',
+                                        daemon=True)
+                       for i in range(stage.workers))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return PipelineStats(time.perf_counter() - start, busy, counts)
@@ -0,0 +1,224 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+"""
+Polars Implementations of the Normalise and Combine Functions
+
+Each function takes and returns the same pandas objects as its pandas counterpart in normalise or combine and is
+selected through the backend switch. The work is expressed as lazy Polars query plans, which are optimised and run
+on Polars' thread pool. Frames are exchanged with pandas through numpy arrays and lists so pyarrow is not needed.
+
+The category lists are exploded and encoded with the shared CategoryDictionary, Polars then matches the integer
+codes. Rounding in calculate_percentage is half to even, as numpy's is, so the results match the pandas path
+exactly. tests/coki_diversity/process/test_backend_parity.py checks this on fixture data and utils/parity.py on
+real data files.
+"""
+
+from pathlib import Path
+from typing import Union, List, Optional
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from coki_diversity.sources.generic import CategoryFilter
+from coki_diversity.process.normalise import CategoryDictionary, explode_categories, is_compiled, requirement_codes, \
+    filefilter_years
+from coki_diversity.process.store import NORMALISED_INDEX
+from coki_diversity.process.combine import AU_INDIGENOUS_COLUMNS, categorical_index_columns
+
+
+def to_polars(df: pd.DataFrame,
+              columns: Optional[List[str]] = None) -> pl.DataFrame:
+    """Convert columns of a pandas frame, string and categorical columns become Polars strings with nulls for NaN"""
+
+    data = dict()
+    for col in columns if columns is not None else df.columns:
+        series = df[col]
+        if series.dtype == object or isinstance(series.dtype, pd.CategoricalDtype):
+            series = series.astype(object)
+            data[col] = pl.Series(col, series.where(series.notna(), None).tolist(), dtype=pl.String)
+        else:
+            data[col] = pl.Series(col, series.to_numpy())
+    return pl.DataFrame(data)
+
+
+def to_pandas(df: pl.DataFrame) -> pd.DataFrame:
+    """Convert a Polars frame, string nulls become NaN as they would be in pandas"""
+
+    data = dict()
+    for col in df.columns:
+        values = df[col].to_numpy()
+        if values.dtype == object:
+            values = pd.Series(values, dtype=object).fillna(np.nan).to_numpy()
+        data[col] = values
+    return pd.DataFrame(data)
+
+
+def _selected_rows(df: pd.DataFrame,
+                   filters: CategoryFilter,
+                   dictionary: Optional[CategoryDictionary] = None) -> (pl.LazyFrame, pl.LazyFrame):
+    """Lazy plans for the rows of df within the scope of any FileFilter and the rows selected by any FileFilter
+
+    A row is within scope of a FileFilter if its source, year and count type match, so it would be passed to
+    filter_df by the pandas normalise. It is selected if it also meets every requirement.
+    """
+
+    row_index, types, values = explode_categories(df)
+    if is_compiled(filters):
+        dictionary = filters.dictionary
+    elif dictionary is None:
+        dictionary = CategoryDictionary(zip(types, values))
+    pairs = pl.DataFrame(dict(row=row_index, code=dictionary.encode(types, values))).lazy()
+
+    rows = pl.DataFrame(dict(row=np.arange(len(df)),
+                             source=to_polars(df, ['source'])['source'],
+                             year=df.year.to_numpy(),
+                             count_type=(to_polars(df, ['source_count_type'])['source_count_type']
+                                         if 'source_count_type' in df.columns
+                                         else pl.Series([None] * len(df), dtype=pl.String)))).lazy()
+
+    in_scope = []
+    selected = []
+    for filefilter in filters.filefilters:
+        scope = (pl.col('source') == filefilter.source) & pl.col('year').is_in(
+            [int(year) for year in filefilter_years(filefilter)])
+        if filefilter.count_type is not None:
+            scope &= pl.col('count_type') == filefilter.count_type
+        plan = rows.filter(scope).select('row')
+        in_scope.append(plan)
+        for codes in requirement_codes(filefilter, dictionary):
+            plan = plan.join(pairs.filter(pl.col('code').is_in(codes.tolist())).select('row').unique(), on='row',
+                             how='semi')
+        selected.append(plan)
+
+    if not selected:
+        empty = pl.DataFrame(dict(row=np.array([], dtype=np.int64))).lazy()
+        return empty, empty
+    return pl.concat(in_scope).unique(), pl.concat(selected).unique()
+
+
+def filter_mask(df: pd.DataFrame,
+                filters: CategoryFilter,
+                dictionary: Optional[CategoryDictionary] = None) -> np.ndarray:
+    _, selected = _selected_rows(df, filters, dictionary=dictionary)
+    mask = np.zeros(len(df), dtype=bool)
+    mask[selected.collect()['row'].to_numpy()] = True
+    return mask
+
+
+def filter_df(df: pd.DataFrame,
+              filters: CategoryFilter,
+              dictionary: Optional[CategoryDictionary] = None,
+              **kwargs) -> pd.DataFrame:
+    return df[filter_mask(df, filters, dictionary=dictionary)]
+
+
+def normalise(df: pd.DataFrame,
+              filters: CategoryFilter,
+              dictionary: Optional[CategoryDictionary] = None,
+              **kwargs) -> pd.Series:
+    """Sum the counts of the rows of df selected by a CategoryFilter for each institution and year
+
+    As in pandas, rows with a missing id, year, source or institution name are not counted and an empty series is
+    returned if no FileFilter applies to any row. The index has the same types and order as the pandas result.
+    """
+
+    in_scope, selected = _selected_rows(df, filters, dictionary=dictionary)
+    in_scope, selected = pl.collect_all([in_scope.select(pl.len()), selected])
+    if in_scope.item() == 0:
+        return pd.Series(dtype=float)
+
+    keys = to_polars(df, NORMALISED_INDEX + ['counts']).with_row_index('row')
+    if keys['counts'].dtype.is_float():
+        # pandas skips NaN counts in the sum, Polars only skips nulls
+        keys = keys.with_columns(pl.col('counts').fill_nan(None))
+    totals = (keys.lazy()
+              .with_columns(pl.col('row').cast(pl.Int64))
+              .join(selected.lazy(), on='row', how='semi')
+              .drop_nulls(NORMALISED_INDEX)
+              .group_by(NORMALISED_INDEX)
+              .agg(pl.col('counts').sum())
+              .sort(NORMALISED_INDEX)
+              .collect())
+
+    # Categorical index columns keep their categories, as in the pandas groupby, the rows are in the order of the
+    # values rather than of the categories in both
+    levels = []
+    for col in NORMALISED_INDEX:
+        values = to_pandas(totals.select(col))[col]
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            values = pd.Categorical(values, categories=df[col].cat.categories, ordered=df[col].cat.ordered)
+        levels.append(values)
+    index = pd.MultiIndex.from_arrays(levels, names=NORMALISED_INDEX)
+    return pd.Series(totals['counts'].to_numpy(), index=index, name='counts')
+
+
+def _scan_normalised(filepath: Union[str, Path],
+                     columns: Optional[List[str]] = None) -> pl.LazyFrame:
+    plan = pl.scan_parquet(filepath)
+    if columns is not None:
+        available = plan.collect_schema().names()
+        plan = plan.select(NORMALISED_INDEX + [col for col in columns if col in available])
+    # Categorical in files with rows and null in empty ones, strings join and concatenate across both
+    return plan.with_columns(pl.col(col).cast(pl.String) for col in NORMALISED_INDEX if col != 'year')
+
+
+def load_files(dir: Union[str, Path],
+               columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Load the normalised Parquet files of every source into a single frame, see combine.iter_normalised"""
+
+    dir = Path(dir)
+
+    audf = _scan_normalised(dir / 'au_det__all_.parquet', columns=columns)
+    indigenous_columns = [c for c in AU_INDIGENOUS_COLUMNS if columns is None or c in columns]
+    au_ind_files = sorted(dir.glob('au_indigenous*.parquet'))
+    if indigenous_columns and au_ind_files:
+        au_ind = pl.concat([_scan_normalised(f, columns=indigenous_columns) for f in au_ind_files],
+                           how='diagonal')
+        available = au_ind.collect_schema().names()
+        # As the pandas outer merge, the au_det rows in order followed by the au_indigenous rows not matched
+        audf = audf.join(au_ind.select(['id', 'year'] + [c for c in indigenous_columns if c in available]),
+                         on=['id', 'year'], how='full', coalesce=True, maintain_order='left_right')
+
+    plans = [_scan_normalised(f, columns=columns) for f in dir.glob('*.parquet') if not f.name.startswith('au')]
+    return categorical_index_columns(to_pandas(pl.concat(plans + [audf], how='diagonal').collect()))
+
+
+def calculate_percentage(df: pd.DataFrame,
+                         numerators: Union[str, List[str]],
+                         denominator: str,
+                         colname_modifier: 'str' = '_pc_totac',
+                         decimals: Optional[int] = 2,
+                         inplace: bool = False) -> Union[pd.DataFrame, None]:
+    plan = (to_polars(df, list(dict.fromkeys(['academic_total_count', denominator] + list(numerators))))
+            .lazy()
+            .with_row_index('row')
+            .filter(pl.col('academic_total_count') != 0)
+            .select([pl.col('row')] +
+                    [(pl.col(col) / pl.col(denominator) * 100).round(decimals, mode='half_to_even')
+                     .alias(col + colname_modifier) for col in numerators]))
+    result = plan.collect()
+
+    idf = df.iloc[result['row'].to_numpy()].copy()
+    for col in numerators:
+        idf[col + colname_modifier] = result[col + colname_modifier].to_numpy()
+
+    if inplace:
+        df = idf
+        return None
+    else:
+        return idf
@@ -0,0 +1,234 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+"""
+Queries over the Combined Output
+
+build_query_store converts the output of combine_files to a directory of columnar files that QueryStore memory maps,
+so queries read only the rows and metrics they need rather than loading the whole table:
+
+* each column is a .npy file, strings are stored as integer codes with their values listed in index.json, and
+  missing strings as -1
+* rows are sorted by id and year, index.json holds the offset of each id's rows, so get_series reads one slice
+* a permutation of the rows sorted by year, with the offset of each year, answers top_n and compare_countries
+  from the rows of one year
+
+Each build is written to a new generation directory and the CURRENT file, naming the live generation, replaced in a
+single rename. An open QueryStore picks up a new build on its next query and earlier generations are removed.
+
+The country of a row is the first two letters of its source, as for the id maps.
+
+Usage: python query.py ../../data/combined/combined.csv ../../data/query
+"""
+
+import argparse
+import json
+import shutil
+import uuid
+from pathlib import Path
+from typing import Union, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from coki_diversity.process.store import NORMALISED_INDEX, atomic_path
+
+CURRENT_FILENAME = 'CURRENT'
+INDEX_FILENAME = 'index.json'
+STRING_COLUMNS = ['id', 'source', 'source_institution_name']
+
+
+def build_query_store(combined: Union[str, Path, pd.DataFrame],
+                      directory: Union[str, Path]) -> Path:
+    """Write a combined frame, or combined csv, as a new generation of the query store in directory"""
+
+    if not isinstance(combined, pd.DataFrame):
+        combined = pd.read_csv(combined, index_col=0)
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    df = combined.dropna(subset=['id', 'year']).sort_values(['id', 'year'], kind='stable').reset_index(drop=True)
+    metrics = [col for col in df.columns
+               if col not in NORMALISED_INDEX and pd.api.types.is_numeric_dtype(df[col])]
+
+    generation = directory / uuid.uuid4().hex[:12]
+    generation.mkdir()
+    index = dict(rows=len(df), metrics=metrics)
+    for col in STRING_COLUMNS:
+        codes, values = pd.factorize(df[col].astype(object).where(df[col].notna(), None), sort=True)
+        np.save(generation / f'{col}.npy', codes.astype(np.int32))
+        index[col] = [str(value) for value in values]
+
+    # ids are sorted, so the rows of the nth id run from id_offsets[n] to id_offsets[n + 1]
+    id_codes = np.load(generation / 'id.npy')
+    np.save(generation / 'id_offsets.npy', np.searchsorted(id_codes, np.arange(len(index['id']) + 1)))
+
+    years = df.year.to_numpy().astype(np.int16)
+    np.save(generation / 'year.npy', years)
+    year_order = np.argsort(years, kind='stable')
+    index['years'] = sorted(int(year) for year in np.unique(years))
+    index['year_offsets'] = np.searchsorted(years[year_order], index['years'] + [np.iinfo(np.int16).max]).tolist()
+    np.save(generation / 'year_order.npy', year_order.astype(np.int64))
+
+    for metric in metrics:
+        np.save(generation / f'metric_{metric}.npy', df[metric].to_numpy(dtype=np.float64))
+    with open(generation / INDEX_FILENAME, 'w') as f:
+        json.dump(index, f)
+
+    with atomic_path(directory / CURRENT_FILENAME) as temp_path:
+        with open(temp_path, 'w') as f:
+            f.write(generation.name)
+    for previous in directory.iterdir():
+        if previous.is_dir() and previous != generation:
+            shutil.rmtree(previous, ignore_errors=True)
+    return generation
+
+
+class QueryStore:
+    """Queries over a query store written by build_query_store, see module docstring"""
+
+    def __init__(self,
+                 directory: Union[str, Path]):
+        self.directory = Path(directory)
+        self.generation = None
+        self._refresh()
+
+    def _refresh(self) -> None:
+        with open(self.directory / CURRENT_FILENAME) as f:
+            generation = f.read().strip()
+        if generation == self.generation:
+            return
+        path = self.directory / generation
+        with open(path / INDEX_FILENAME) as f:
+            self.index = json.load(f)
+        self.generation = generation
+        self._path = path
+        self._columns = dict()
+        self._id_codes = {value: code for code, value in enumerate(self.index['id'])}
+        # Missing values are stored as code -1, which indexes the None appended to each column's values
+        self._values = {col: np.asarray(self.index[col] + [None], dtype=object) for col in STRING_COLUMNS}
+
+    def column(self,
+               name: str) -> np.ndarray:
+        """A column of the store as a read only memory map, name is a string column, year or metric_{metric}"""
+
+        if name not in self._columns:
+            self._columns[name] = np.load(self._path / f'{name}.npy', mmap_mode='r')
+        return self._columns[name]
+
+    @property
+    def metrics(self) -> List[str]:
+        self._refresh()
+        return list(self.index['metrics'])
+
+    @property
+    def years(self) -> List[int]:
+        self._refresh()
+        return list(self.index['years'])
+
+    def _metric(self,
+                metric: str) -> np.ndarray:
+        if metric not in self.index['metrics']:
+            raise KeyError(f'{metric} is not a metric of the query store, expected one of {self.index["metrics"]}')
+        return self.column(f'metric_{metric}')
+
+    def _year_rows(self,
+                   year: int) -> np.ndarray:
+        if year not in self.index['years']:
+            return np.array([], dtype=np.int64)
+        position = self.index['years'].index(year)
+        start, end = self.index['year_offsets'][position], self.index['year_offsets'][position + 1]
+        return np.sort(self.column('year_order')[start:end])
+
+    def _labels(self,
+                rows: np.ndarray) -> pd.DataFrame:
+        return pd.DataFrame({col: self._values[col][self.column(col)[rows]] for col in STRING_COLUMNS})
+
+    def get_series(self,
+                   id: str,
+                   metric: str) -> pd.Series:
+        """The values of a metric for an institution, indexed by year"""
+
+        self._refresh()
+        values = self._metric(metric)
+        code = self._id_codes.get(id)
+        if code is None:
+            return pd.Series(dtype=float, name=metric, index=pd.Index([], name='year', dtype=np.int16))
+        offsets = self.column('id_offsets')
+        start, end = offsets[code], offsets[code + 1]
+        return pd.Series(np.asarray(values[start:end]), name=metric,
+                         index=pd.Index(np.asarray(self.column('year')[start:end]), name='year'))
+
+    def top_n(self,
+              metric: str,
+              year: int,
+              n: int = 10,
+              source: Optional[str] = None,
+              ascending: bool = False) -> pd.DataFrame:
+        """The n institutions with the highest, or lowest, value of a metric in a year, optionally for one source"""
+
+        self._refresh()
+        rows = self._year_rows(year)
+        if source is not None:
+            codes = [code for code, value in enumerate(self.index['source']) if value == source]
+            rows = rows[np.isin(self.column('source')[rows], codes)]
+        values = np.asarray(self._metric(metric)[rows])
+        present = ~np.isnan(values)
+        rows, values = rows[present], values[present]
+
+        keys = values if ascending else -values
+        if n < len(rows):
+            chosen = np.argpartition(keys, n)[:n]
+        else:
+            chosen = np.arange(len(rows))
+        chosen = chosen[np.argsort(keys[chosen], kind='stable')]
+
+        out_df = self._labels(rows[chosen])
+        out_df.insert(1, 'year', year)
+        out_df[metric] = values[chosen]
+        return out_df
+
+    def compare_countries(self,
+                          metric: str,
+                          year: int,
+                          countries: Optional[List[str]] = None) -> pd.DataFrame:
+        """Summary statistics of a metric across the institutions of each country in a year"""
+
+        self._refresh()
+        rows = self._year_rows(year)
+        values = np.asarray(self._metric(metric)[rows])
+        country_of_source = np.asarray([source[:2] for source in self.index['source']] + [None], dtype=object)
+        df = pd.DataFrame(dict(country=country_of_source[self.column('source')[rows]], value=values)).dropna()
+        summary = df.groupby('country')['value'].agg(['count', 'mean', 'median', 'min', 'max'])
+        summary.columns = ['institutions', 'mean', 'median', 'min', 'max']
+        if countries is not None:
+            summary = summary[summary.index.isin(countries)]
+        return summary.sort_index()
+
+    def compare_institutions(self,
+                             ids: List[str],
+                             metric: str) -> pd.DataFrame:
+        """The values of a metric for several institutions, one column per institution and a row per year"""
+
+        return pd.concat({id: self.get_series(id, metric) for id in ids}, axis=1).sort_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a query store from the output of combine_files')
+    parser.add_argument('combined')
+    parser.add_argument('directory')
+    args = parser.parse_args()
+    print(f'Built {build_query_store(args.combined, args.directory)}')
@@ -0,0 +1,345 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+"""
+Export Table Schema and Columnar Records
+
+The BigQuery table the export loads is defined by utils/bq_schema.json, including the repeated source_categories
+record. ColumnarRecords holds export records as one array per field, conformed to the schema's types, with each
+repeated record held as flattened child arrays and row offsets, ie the layout of an Arrow list<struct> array. The
+subfields of a repeated record are taken from the frame's list columns of the same name, so source_categories is
+built from source_category_type and source_category_value without a dict per row.
+
+Conforming a frame collects a SchemaIssue for every field with values that cannot be loaded, eg a missing column,
+nulls in a REQUIRED field, fractional INTEGERs or category lists of different lengths, so a whole table is
+validated at once before anything is written or uploaded.
+
+pyarrow is optional and only imported by arrow_schema and ColumnarRecords.to_arrow.
+"""
+
+import json
+from itertools import chain
+from pathlib import Path
+from typing import Union, List, Dict, NamedTuple, Tuple, Optional
+
+import numpy as np
+import pandas as pd
+
+SCHEMA_PATH = Path(__file__).parent.parent / 'utils' / 'bq_schema.json'
+
+AVRO_TYPES = {'STRING': 'string', 'INTEGER': 'long', 'FLOAT': 'double', 'BOOLEAN': 'boolean'}
+
+
+class SchemaField(NamedTuple):
+    name: str
+    type: str
+    mode: str = 'NULLABLE'
+    fields: Tuple = ()
+
+    @property
+    def repeated(self) -> bool:
+        return self.mode == 'REPEATED'
+
+    @property
+    def required(self) -> bool:
+        return self.mode == 'REQUIRED'
+
+
+class SchemaIssue(NamedTuple):
+    field: str
+    rows: int
+    message: str
+
+    def __repr__(self):
+        return f'{self.field}: {self.message} in {self.rows} rows'
+
+
+class SchemaError(ValueError):
+    def __init__(self, issues: List[SchemaIssue]):
+        self.issues = issues
+        super().__init__('; '.join(repr(issue) for issue in issues))
+
+
+class Column(NamedTuple):
+    values: np.ndarray
+    nulls: np.ndarray
+
+
+def _field(spec: Dict) -> SchemaField:
+    return SchemaField(spec['name'],
+                       spec['type'].upper(),
+                       spec.get('mode', 'NULLABLE').upper(),
+                       tuple(_field(sub) for sub in spec.get('fields', [])))
+
+
+def load_schema(path: Union[str, Path] = SCHEMA_PATH) -> List[SchemaField]:
+    with open(path) as f:
+        return [_field(spec) for spec in json.load(f)]
+
+
+EXPORT_SCHEMA = load_schema()
+
+
+def arrow_schema(schema: List[SchemaField] = EXPORT_SCHEMA):
+    import pyarrow as pa
+
+    def arrow_type(field):
+        if field.type == 'RECORD':
+            return pa.struct([arrow_field(sub) for sub in field.fields])
+        return {'STRING': pa.string(), 'INTEGER': pa.int64(), 'FLOAT': pa.float64(), 'BOOLEAN': pa.bool_()}[field.type]
+
+    def arrow_field(field):
+        if field.repeated:
+            return pa.field(field.name, pa.list_(arrow_type(field)), nullable=False)
+        return pa.field(field.name, arrow_type(field), nullable=not field.required)
+
+    return pa.schema([arrow_field(field) for field in schema])
+
+
+def avro_schema(schema: List[SchemaField] = EXPORT_SCHEMA,
+                name: str = 'demographics') -> Dict:
+    def avro_type(field):
+        if field.type == 'RECORD':
+            avro = dict(type='record', name=field.name, fields=[avro_field(sub) for sub in field.fields])
+        else:
+            avro = AVRO_TYPES[field.type]
+        if field.repeated:
+            return dict(type='array', items=avro)
+        return avro if field.required else ['null', avro]
+
+    def avro_field(field):
+        return dict(name=field.name, type=avro_type(field))
+
+    return dict(type='record', name=name, fields=[avro_field(field) for field in schema])
+
+
+def conform_column(field: SchemaField,
+                   values: np.ndarray,
+                   name: Optional[str] = None) -> Tuple[Column, List[SchemaIssue]]:
+    """Convert the values of a field to its schema type, with a mask of the nulls and any issues found"""
+
+    name = name or field.name
+    series = pd.Series(values, dtype=object if field.type == 'STRING' else None)
+    nulls = series.isna().to_numpy()
+    issues = []
+
+    if field.type == 'STRING':
+        converted = np.where(nulls, None, series.astype(str).to_numpy()).astype(object)
+    elif field.type in ('INTEGER', 'FLOAT'):
+        numbers = pd.to_numeric(series, errors='coerce').astype(np.float64).to_numpy()
+        invalid = np.isnan(numbers) & ~nulls
+        if invalid.any():
+            issues.append(SchemaIssue(name, int(invalid.sum()), 'values that are not numbers'))
+        invalid = np.isinf(numbers)
+        if invalid.any():
+            issues.append(SchemaIssue(name, int(invalid.sum()), 'infinite values'))
+        nulls = np.isnan(numbers)
+        numbers = np.where(nulls | np.isinf(numbers), 0, numbers)
+        if field.type == 'INTEGER':
+            fractional = numbers % 1 != 0
+            if fractional.any():
+                issues.append(SchemaIssue(name, int(fractional.sum()), 'fractional values for an INTEGER'))
+            converted = numbers.astype(np.int64)
+        else:
+            converted = numbers
+    elif field.type == 'BOOLEAN':
+        converted = series.fillna(False).astype(bool).to_numpy()
+    else:
+        raise ValueError(f'Unsupported field type {field.type} for {name}')
+
+    if field.required and nulls.any():
+        issues.append(SchemaIssue(name, int(nulls.sum()), 'nulls in a REQUIRED field'))
+    return Column(converted, nulls), issues
+
+
+def _json_values(field: SchemaField,
+                 column: Column) -> np.ndarray:
+    """Encode each value of a column as JSON, as json.dumps would"""
+
+    if field.type == 'STRING':
+        # Labels and names repeat across rows, so each distinct value is encoded once
+        codes, uniques = pd.factorize(column.values)
+        encoded = np.array([json.dumps(value) for value in uniques] + ['null'], dtype=object)[codes]
+    elif field.type == 'INTEGER':
+        encoded = column.values.astype(str)
+    elif field.type == 'FLOAT':
+        encoded = list(map(repr, column.values.tolist()))
+    else:
+        encoded = np.where(column.values, 'true', 'false')
+    return np.where(column.nulls, 'null', np.asarray(encoded, dtype=object))
+
+
+class ColumnarRecords:
+    """Export records held as a conformed array per field, see module docstring"""
+
+    def __init__(self,
+                 schema: List[SchemaField],
+                 num_rows: int,
+                 columns: Dict[str, Column],
+                 offsets: Dict[str, np.ndarray],
+                 children: Dict[str, Dict[str, Column]],
+                 issues: Optional[List[SchemaIssue]] = None):
+        self.schema = schema
+        self.num_rows = num_rows
+        self.columns = columns
+        self.offsets = offsets
+        self.children = children
+        self.issues = issues or []
+
+    def __len__(self):
+        return self.num_rows
+
+    @classmethod
+    def from_frame(cls,
+                   df: pd.DataFrame,
+                   schema: List[SchemaField] = EXPORT_SCHEMA) -> 'ColumnarRecords':
+        issues = []
+        columns = dict()
+        offsets = dict()
+        children = dict()
+        for field in schema:
+            if not field.repeated:
+                if field.name not in df.columns:
+                    issues.append(SchemaIssue(field.name, len(df), 'missing column'))
+                    values = np.full(len(df), None, dtype=object)
+                else:
+                    values = df[field.name].to_numpy()
+                columns[field.name], field_issues = conform_column(field, values)
+                issues.extend(field_issues)
+                continue
+
+            lengths = None
+            children[field.name] = dict()
+            for sub in field.fields:
+                if sub.name not in df.columns:
+                    issues.append(SchemaIssue(f'{field.name}.{sub.name}', len(df), 'missing column'))
+                    continue
+                sub_lengths = np.fromiter(map(len, df[sub.name]), dtype=np.int64, count=len(df))
+                if lengths is None:
+                    lengths = sub_lengths
+                elif (sub_lengths != lengths).any():
+                    issues.append(SchemaIssue(f'{field.name}.{sub.name}', int((sub_lengths != lengths).sum()),
+                                              'list lengths differ from the other subfields'))
+                    continue
+                values = np.fromiter(chain.from_iterable(df[sub.name]), dtype=object, count=int(lengths.sum()))
+                children[field.name][sub.name], field_issues = conform_column(sub, values,
+                                                                              name=f'{field.name}.{sub.name}')
+                issues.extend(field_issues)
+
+            if lengths is None:
+                lengths = np.zeros(len(df), dtype=np.int64)
+            offsets[field.name] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+            for sub in field.fields:
+                if sub.name not in children[field.name]:
+                    children[field.name][sub.name] = conform_column(
+                        sub, np.full(int(lengths.sum()), None, dtype=object))[0]
+
+        return cls(schema, len(df), columns, offsets, children, issues)
+
+    @classmethod
+    def concat(cls,
+               records: List['ColumnarRecords']) -> 'ColumnarRecords':
+        def join(columns):
+            return Column(np.concatenate([c.values for c in columns]), np.concatenate([c.nulls for c in columns]))
+
+        first = records[0]
+        columns = {name: join([r.columns[name] for r in records]) for name in first.columns}
+        offsets = dict()
+        children = dict()
+        for name in first.offsets:
+            starts = np.cumsum([0] + [r.offsets[name][-1] for r in records[:-1]])
+            offsets[name] = np.concatenate([[0]] + [r.offsets[name][1:] + start
+                                                    for r, start in zip(records, starts)]).astype(np.int64)
+            children[name] = {sub: join([r.children[name][sub] for r in records]) for sub in first.children[name]}
+        return cls(first.schema, sum(len(r) for r in records), columns, offsets, children,
+                   list(chain.from_iterable(r.issues for r in records)))
+
+    def slice(self,
+              start: int,
+              end: int) -> 'ColumnarRecords':
+        end = min(end, self.num_rows)
+        columns = {name: Column(c.values[start:end], c.nulls[start:end]) for name, c in self.columns.items()}
+        offsets = dict()
+        children = dict()
+        for name, field_offsets in self.offsets.items():
+            lo, hi = field_offsets[start], field_offsets[end]
+            offsets[name] = field_offsets[start:end + 1] - lo
+            children[name] = {sub: Column(c.values[lo:hi], c.nulls[lo:hi]) for sub, c in self.children[name].items()}
+        return ColumnarRecords(self.schema, max(end - start, 0), columns, offsets, children, self.issues)
+
+    def json_lines(self) -> List[bytes]:
+        """Each record as a line of JSON, identical to json.dumps of the record's dict"""
+
+        encoded = []
+        for field in self.schema:
+            if not field.repeated:
+                encoded.append(_json_values(field, self.columns[field.name]))
+                continue
+            parts = [_json_values(sub, self.children[field.name][sub.name]) for sub in field.fields]
+            template = '{' + ', '.join(f'"{sub.name}": %s' for sub in field.fields) + '}'
+            items = [template % values for values in zip(*parts)]
+            field_offsets = self.offsets[field.name].tolist()
+            encoded.append(['[' + ', '.join(items[start:end]) + ']'
+                            for start, end in zip(field_offsets[:-1], field_offsets[1:])])
+
+        template = '{' + ', '.join(f'"{field.name}": %s' for field in self.schema) + '}\n'
+        return [(template % values).encode() for values in zip(*encoded)]
+
+    def to_arrow(self):
+        """The records as a pyarrow Table with the schema's types, repeated records as list<struct> arrays"""
+
+        import pyarrow as pa
+
+        target = arrow_schema(self.schema)
+        arrays = []
+        for field in self.schema:
+            arrow_field = target.field(field.name)
+            if not field.repeated:
+                column = self.columns[field.name]
+                arrays.append(pa.array(column.values, type=arrow_field.type, mask=column.nulls))
+                continue
+            struct_type = arrow_field.type.value_type
+            struct = pa.StructArray.from_arrays(
+                [pa.array(c.values, type=struct_type.field(sub).type, mask=c.nulls)
+                 for sub, c in self.children[field.name].items()],
+                fields=list(struct_type))
+            arrays.append(pa.ListArray.from_arrays(pa.array(self.offsets[field.name], type=pa.int32()), struct))
+        return pa.Table.from_arrays(arrays, schema=target)
+
+    def to_dicts(self) -> List[Dict]:
+        """The records as dicts of python values, for writers that take a record at a time"""
+
+        def values(column):
+            return [None if null else value for value, null in zip(column.values.tolist(), column.nulls)]
+
+        fields = []
+        for field in self.schema:
+            if not field.repeated:
+                fields.append(values(self.columns[field.name]))
+                continue
+            subfields = [sub.name for sub in field.fields]
+            items = [dict(zip(subfields, item))
+                     for item in zip(*(values(self.children[field.name][sub]) for sub in subfields))]
+            field_offsets = self.offsets[field.name]
+            fields.append([items[field_offsets[i]:field_offsets[i + 1]] for i in range(self.num_rows)])
+        names = [field.name for field in self.schema]
+        return [dict(zip(names, record)) for record in zip(*fields)]
+
+
+def validate_records(records: ColumnarRecords) -> List[SchemaIssue]:
+    """The issues found conforming records to the schema, empty if every record can be loaded"""
+
+    return list(records.issues)
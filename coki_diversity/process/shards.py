@@ -0,0 +1,154 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+"""
+Export Shard Formats
+
+Writers for the shards of the BigQuery export, from ColumnarRecords conformed to the export schema. JSON-lines
+shards may be gzip or zstd compressed, Parquet and Avro shards carry source_categories as a nested repeated record,
+typed by the schema, and use the format's own compression. Shards are capped by row count and, for JSON-lines, by
+their uncompressed size, so a bulk loader can read them in parallel.
+
+zstandard, pyarrow and fastavro are optional and only imported when their format or compression is used.
+"""
+
+import gzip
+import re
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Union, List, Dict, Iterator, Optional, Tuple, BinaryIO
+
+import numpy as np
+
+from coki_diversity.process.schema import ColumnarRecords, avro_schema
+from coki_diversity.process.store import atomic_path
+
+FORMATS = ['jsonl', 'parquet', 'avro']
+COMPRESSIONS = [None, 'gzip', 'zstd']
+COMPRESSION_EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+AVRO_CODECS = {None: 'null', 'gzip': 'deflate', 'zstd': 'zstandard'}
+MAX_SHARD_BYTES = 256 * 1024 * 1024
+MAX_SHARD_ROWS = 1000000
+
+# Matches every shard name written by export_shards, with or without a shard number
+SHARD_PATTERN = re.compile(r'-[0-9a-f]{16}(-[0-9]{5})?\.(jsonl(\.gz|\.zst)?|parquet|avro)$')
+
+
+def shard_extension(format: str,
+                    compression: Optional[str] = None) -> str:
+    if format not in FORMATS:
+        raise ValueError(f'Unknown export format {format}, expected one of {FORMATS}')
+    if compression not in COMPRESSIONS:
+        raise ValueError(f'Unknown compression {compression}, expected one of {COMPRESSIONS}')
+    if format == 'jsonl':
+        return '.jsonl' + COMPRESSION_EXTENSIONS[compression]
+    return f'.{format}'
+
+
+@contextmanager
+def open_compressed(filepath: Union[str, Path],
+                    compression: Optional[str] = None) -> Iterator[BinaryIO]:
+    if compression == 'gzip':
+        with gzip.open(filepath, 'wb', compresslevel=6) as f:
+            yield f
+    elif compression == 'zstd':
+        import zstandard
+        with open(filepath, 'wb') as raw:
+            with zstandard.ZstdCompressor(level=3).stream_writer(raw) as f:
+                yield f
+    else:
+        with open(filepath, 'wb') as f:
+            yield f
+
+
+def write_jsonl(filepath: Union[str, Path],
+                lines: List[bytes],
+                compression: Optional[str] = None) -> None:
+    with open_compressed(filepath, compression) as f:
+        for line in lines:
+            f.write(line)
+
+
+def write_parquet(filepath: Union[str, Path],
+                  records: ColumnarRecords,
+                  compression: Optional[str] = None) -> None:
+    import pyarrow.parquet as pq
+    pq.write_table(records.to_arrow(), filepath, compression=compression or 'none')
+
+
+def write_avro(filepath: Union[str, Path],
+               records: ColumnarRecords,
+               compression: Optional[str] = None) -> None:
+    import fastavro
+    with open(filepath, 'wb') as f:
+        fastavro.writer(f, fastavro.parse_schema(avro_schema(records.schema)), records.to_dicts(),
+                        codec=AVRO_CODECS[compression])
+
+
+def shard_bounds(num_rows: int,
+                 sizes: Optional[np.ndarray] = None,
+                 max_shard_bytes: int = MAX_SHARD_BYTES,
+                 max_shard_rows: int = MAX_SHARD_ROWS) -> List[Tuple[int, int]]:
+    """The start and end rows of each shard, with at least one row and at most max_shard_rows rows per shard and,
+    given the size of each row, at most max_shard_bytes unless a single row is larger"""
+
+    ends = np.cumsum(sizes) if sizes is not None else None
+    bounds = []
+    start = 0
+    while start < num_rows:
+        end = min(start + max_shard_rows, num_rows)
+        if ends is not None:
+            base = ends[start - 1] if start else 0
+            end = min(end, int(np.searchsorted(ends, base + max_shard_bytes, side='right')))
+        end = max(end, start + 1)
+        bounds.append((start, end))
+        start = end
+    return bounds or [(0, 0)]
+
+
+def write_shards(records: ColumnarRecords,
+                 output_directory: Union[str, Path],
+                 base_name: str,
+                 format: str = 'jsonl',
+                 compression: Optional[str] = None,
+                 max_shard_bytes: int = MAX_SHARD_BYTES,
+                 max_shard_rows: int = MAX_SHARD_ROWS) -> List[Dict]:
+    """Write records to shards {base_name}-nnnnn{extension}, each renamed into place once complete
+
+    A new shard is started once the current one reaches max_shard_rows records or, for JSON-lines, max_shard_bytes
+    uncompressed bytes. Returns the name, row count and size on disk of each shard.
+    """
+
+    output_directory = Path(output_directory)
+    extension = shard_extension(format, compression)
+    if format == 'jsonl':
+        lines = records.json_lines()
+        sizes = np.fromiter(map(len, lines), dtype=np.int64, count=len(lines))
+    else:
+        sizes = None
+
+    shards = []
+    for start, end in shard_bounds(len(records), sizes, max_shard_bytes, max_shard_rows):
+        name = f'{base_name}-{len(shards):05d}{extension}'
+        with atomic_path(output_directory / name) as temp_path:
+            if format == 'jsonl':
+                write_jsonl(temp_path, lines[start:end], compression)
+            elif format == 'parquet':
+                write_parquet(temp_path, records.slice(start, end), compression)
+            else:
+                write_avro(temp_path, records.slice(start, end), compression)
+        shards.append(dict(name=name, rows=end - start, bytes=(output_directory / name).stat().st_size))
+    return shards
@@ -0,0 +1,568 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, ExitStack
+from pathlib import Path
+from typing import Union, List, Iterable, Iterator, Dict, Optional, Callable
+
+import numpy as np
+import pandas as pd
+import tables
+
+
+CATALOG_FILENAME = 'catalog.json'
+MARKER_DIRECTORY = '_complete'
+TEMP_PREFIX = '.tmp_'
+MAX_OPEN_STORES = 32
+CATEGORIES_PREFIX = 'categories_'
+
+
+class StorePool:
+    """Cache of read-only HDFStore handles, at most one per file
+
+    Handles are only ever opened with mode='r', so any number of processes can read the same stores at once. Each
+    process has its own handles, a pool inherited through a fork is emptied on first use in the child rather than
+    sharing the parent's HDF5 file handles. A handle is reopened if its file has been modified since it was opened
+    and the least recently used handle is closed once more than max_open files are open.
+    """
+
+    def __init__(self,
+                 max_open: int = MAX_OPEN_STORES):
+        self.max_open = max_open
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get(self,
+            filepath: Union[str, Path]) -> pd.HDFStore:
+        filepath = Path(filepath).resolve()
+        with self._lock:
+            if self._pid != os.getpid():
+                self._handles = OrderedDict()
+                self._pid = os.getpid()
+
+            mtime = filepath.stat().st_mtime_ns
+            if filepath in self._handles:
+                store, opened_mtime = self._handles[filepath]
+                if opened_mtime == mtime and store.is_open:
+                    self._handles.move_to_end(filepath)
+                    return store
+                store.close()
+                del self._handles[filepath]
+
+            store = pd.HDFStore(filepath, mode='r')
+            self._handles[filepath] = (store, mtime)
+            while len(self._handles) > self.max_open:
+                _, (oldest, _) = self._handles.popitem(last=False)
+                oldest.close()
+            return store
+
+    def close(self,
+              filepath: Union[str, Path]) -> None:
+        filepath = Path(filepath).resolve()
+        with self._lock:
+            if filepath in self._handles and self._pid == os.getpid():
+                store, _ = self._handles.pop(filepath)
+                store.close()
+
+    def close_all(self) -> None:
+        with self._lock:
+            if self._pid == os.getpid():
+                for store, _ in self._handles.values():
+                    store.close()
+            self._handles = OrderedDict()
+
+
+read_pool = StorePool()
+
+
+@contextmanager
+def atomic_path(filepath: Union[str, Path],
+                copy_existing: bool = False) -> Iterator[Path]:
+    """A temporary path in the same directory as filepath that is renamed over it when the block completes
+
+    If the block raises, or the process dies, filepath is left as it was and the temporary file is removed or left
+    behind under a name that does not match any output pattern. With copy_existing the temporary file starts as a
+    copy of filepath, with its permissions, for writers that add to an existing file.
+    """
+
+    filepath = Path(filepath)
+    fd, temp_path = tempfile.mkstemp(dir=filepath.parent, prefix=TEMP_PREFIX)
+    os.close(fd)
+    temp_path = Path(temp_path)
+    try:
+        if copy_existing and filepath.is_file():
+            shutil.copyfile(filepath, temp_path)
+            # mkstemp creates the file readable only by its owner, the copy keeps the permissions of the original
+            shutil.copymode(filepath, temp_path)
+        else:
+            temp_path.unlink()
+        yield temp_path
+        os.replace(temp_path, filepath)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+
+
+@contextmanager
+def open_for_write(filepath: Union[str, Path]) -> Iterator[pd.HDFStore]:
+    """Open a copy of a store for appending, which replaces the store only once the block completes
+
+    Any pooled read-only handle on the store is closed first.
+    """
+
+    read_pool.close(filepath)
+    with atomic_path(filepath, copy_existing=True) as temp_path:
+        with pd.HDFStore(temp_path, mode='a') as store:
+            yield store
+
+
+class StoreWriter:
+    """Working copies of the stores written by a run, each renamed over its store once, when it is committed
+
+    The first table written to a store in a run copies the store, later tables are added to the same copy, so a store
+    of n tables is copied once rather than once per table. Each store is committed, and on_commit called with its
+    path and the items added for it, by commit once its last table is written, and otherwise when more than max_open
+    stores are open and when the writer is closed. Use through store_writer, which removes the uncommitted copies,
+    leaving their stores as they were, if the run fails.
+    """
+
+    def __init__(self,
+                 on_commit: Optional[Callable[[Path, List], None]] = None,
+                 max_open: int = MAX_OPEN_STORES):
+        self.on_commit = on_commit
+        self.max_open = max_open
+        self._stores = OrderedDict()
+
+    def open(self,
+             filepath: Union[str, Path]) -> pd.HDFStore:
+        """The working copy of a store, opened for appending"""
+
+        filepath = Path(filepath)
+        if filepath in self._stores:
+            self._stores.move_to_end(filepath)
+            return self._stores[filepath][1]
+        while len(self._stores) >= self.max_open:
+            self.commit(next(iter(self._stores)))
+
+        read_pool.close(filepath)
+        stack = ExitStack()
+        temp_path = stack.enter_context(atomic_path(filepath, copy_existing=True))
+        store = stack.enter_context(pd.HDFStore(temp_path, mode='a'))
+        self._stores[filepath] = (stack, store, [])
+        return store
+
+    def add(self,
+            filepath: Union[str, Path],
+            item) -> None:
+        """Add an item, eg the catalog entries of a table written to the store, to pass to on_commit"""
+
+        self._stores[Path(filepath)][2].append(item)
+
+    def commit(self,
+               filepath: Union[str, Path]) -> None:
+        """Replace a store with its working copy and call on_commit, nothing is done if the store is not open"""
+
+        filepath = Path(filepath)
+        if filepath not in self._stores:
+            return
+        stack, _, items = self._stores.pop(filepath)
+        read_pool.close(filepath)
+        stack.close()
+        if self.on_commit is not None:
+            self.on_commit(filepath, items)
+
+    def close(self) -> None:
+        for filepath in list(self._stores):
+            self.commit(filepath)
+
+    def abort(self, *exc_info) -> None:
+        while self._stores:
+            _, (stack, _, _) = self._stores.popitem()
+            stack.__exit__(*exc_info)
+
+
+@contextmanager
+def store_writer(on_commit: Optional[Callable[[Path, List], None]] = None,
+                 max_open: int = MAX_OPEN_STORES) -> Iterator[StoreWriter]:
+    """A StoreWriter whose stores are committed when the block completes and left unchanged if it raises"""
+
+    writer = StoreWriter(on_commit, max_open=max_open)
+    try:
+        yield writer
+    except BaseException as e:
+        writer.abort(type(e), e, e.__traceback__)
+        raise
+    writer.close()
+
+
+def marker_path(directory: Union[str, Path],
+                name: str) -> Path:
+    return Path(directory) / MARKER_DIRECTORY / f'{name}.json'
+
+
+def mark_complete(directory: Union[str, Path],
+                  name: str,
+                  **info) -> None:
+    """Record that the output partition name in directory has been committed"""
+
+    filepath = marker_path(directory, name)
+    filepath.parent.mkdir(exist_ok=True)
+    with atomic_path(filepath) as temp_path:
+        with open(temp_path, 'w') as f:
+            json.dump(dict(name=name, completed=time.time(), **info), f)
+
+
+def is_complete(directory: Union[str, Path],
+                name: str) -> bool:
+    return marker_path(directory, name).is_file()
+
+
+def clear_markers(directory: Union[str, Path]) -> None:
+    """Remove the completion markers of a directory at the start of a run that is not resuming"""
+
+    marker_directory = Path(directory) / MARKER_DIRECTORY
+    if marker_directory.is_dir():
+        shutil.rmtree(marker_directory)
+
+
+def stored_keys(store: pd.HDFStore,
+                table: str) -> List[str]:
+    """Keys holding an ingested table, either the table itself or the parts of a chunked ingest"""
+
+    return [key for key in store.keys() if (key == f'/{table}') or key.startswith(f'/{table}/')]
+
+
+def catalog_entry(table: str,
+                  df: pd.DataFrame) -> Dict:
+    """Metadata on a stored frame, the table it belongs to, its row count, column dtypes and years"""
+
+    return dict(table=table,
+                rows=len(df),
+                columns={col: str(dtype) for col, dtype in df.dtypes.items()},
+                years=sorted(df.year.dropna().unique().tolist(), key=str) if 'year' in df.columns else [])
+
+
+def encode_frame(df: pd.DataFrame) -> (pd.DataFrame, Dict[str, str], Dict[str, List]):
+    """Replace the categorical and category list columns of a frame with integer codes
+
+    The fixed format of the ingest stores cannot hold categoricals and pickles every list of a list column. Each such
+    column is stored as the codes of its values instead, with the distinct values held alongside, see put_frame.
+    Returns the encoded frame, the kind of each encoded column and its distinct values.
+    """
+
+    encoded = df.copy(deep=False)
+    kinds = dict()
+    values = dict()
+    for col in df.columns:
+        column = df[col]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            kinds[col] = 'ordered' if column.cat.ordered else 'category'
+            values[col] = column.cat.categories.tolist()
+            encoded[col] = column.cat.codes
+        elif column.dtype == object and len(column) > 0 and all(isinstance(v, list) for v in column):
+            codes, uniques = pd.factorize(pd.Series([tuple(v) for v in column], dtype=object))
+            kinds[col] = 'list'
+            values[col] = [list(v) for v in uniques]
+            encoded[col] = pd.to_numeric(codes, downcast='integer')
+    return encoded, kinds, values
+
+
+def put_frame(store: pd.HDFStore,
+              key: str,
+              df: pd.DataFrame) -> None:
+    """Write a frame to a store with its categorical and list columns encoded, see encode_frame
+
+    The distinct values of each encoded column are held in an array within the frame's group, as they can be larger
+    than an HDF5 attribute allows, and the kinds of the encoded columns in the storer attributes. The array is not
+    a pandas object, so it is not listed among the store's keys.
+    """
+
+    encoded, kinds, values = encode_frame(df)
+    store[key] = encoded
+    if not kinds:
+        return
+    storer = store.get_storer(key)
+    for col, distinct in values.items():
+        # One row per array, the default chunk would reserve a megabyte for each
+        array = store._handle.create_vlarray(storer.group, f'{CATEGORIES_PREFIX}{col}', tables.ObjectAtom(),
+                                             chunkshape=(1,))
+        array.append(distinct)
+    storer.attrs.encoded_columns = kinds
+
+
+def read_key(store: pd.HDFStore,
+             key: str) -> pd.DataFrame:
+    """Read a frame from a store, decoding any columns encoded by put_frame
+
+    Categorical columns are returned as categoricals. Every row of a list column refers to one list per distinct
+    value, so the lists must not be modified in place.
+    """
+
+    df = store[key]
+    storer = store.get_storer(key)
+    kinds = getattr(storer.attrs, 'encoded_columns', None)
+    for col, kind in (kinds or dict()).items():
+        distinct = getattr(storer.group, f'{CATEGORIES_PREFIX}{col}')[0]
+        codes = df[col].to_numpy()
+        if kind in ('category', 'ordered'):
+            df[col] = pd.Categorical.from_codes(codes, categories=distinct, ordered=kind == 'ordered')
+        else:
+            lists = np.empty(len(distinct), dtype=object)
+            for i, value in enumerate(distinct):
+                lists[i] = value
+            df[col] = lists[codes]
+    return df
+
+
+def store_ingested(store: pd.HDFStore,
+                   table: str,
+                   ingested: Union[pd.DataFrame, Iterable[pd.DataFrame]]) -> Dict[str, Dict]:
+    """Write an ingested table to a store, replacing any earlier version of it
+
+    Ingestors that stream large files return an iterable of chunks rather than a DataFrame. Each chunk is written
+    to the store as it arrives under a {table}/part_nnnnn key. Later stages read every key in a store so the parts
+    are handled like any other table. Frames are written by put_frame and must be read with read_key.
+
+    Returns a catalog_entry for each key written.
+    """
+
+    for key in stored_keys(store, table):
+        store.remove(key)
+
+    if isinstance(ingested, pd.DataFrame):
+        put_frame(store, f'/{table}', ingested)
+        return {f'/{table}': catalog_entry(table, ingested)}
+
+    entries = dict()
+    for i, chunk in enumerate(ingested):
+        key = f'/{table}/part_{i:05d}'
+        put_frame(store, key, chunk)
+        entries[key] = catalog_entry(table, chunk)
+        logging.info(f'...stored chunk {i} of {table} ({len(chunk)} rows)')
+    return entries
+
+
+def file_stat(filepath: Union[str, Path]) -> Optional[Dict]:
+    """Size and modification time of a file, to tell whether it has changed since they were recorded"""
+
+    try:
+        stat = Path(filepath).stat()
+    except FileNotFoundError:
+        return None
+    return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+class StoreCatalog:
+    """Catalog of the keys of the ingested stores in a directory
+
+    Records for every key its table, row count, column dtypes and years, so later stages can see what has been
+    ingested without opening a store. The catalog is kept as JSON alongside the stores and updated by the ingest
+    stage as each table is written. build_catalog recreates it from the stores themselves.
+
+    The size and modification time of each store are recorded with its keys. The catalog is only trusted for a store
+    that is unchanged since then, is_processed checks the keys of any other store, eg one ingested before there was
+    a catalog or replaced by hand, in the store itself.
+    """
+
+    def __init__(self,
+                 directory: Union[str, Path]):
+        self.directory = Path(directory)
+        self.filepath = self.directory / CATALOG_FILENAME
+        self.stores = dict()
+        self.files = dict()
+        if self.filepath.is_file():
+            with open(self.filepath) as f:
+                catalog = json.load(f)
+            if set(catalog) == {'stores', 'files'}:
+                self.stores, self.files = catalog['stores'], catalog['files']
+            else:
+                # Catalogs written before the stores' file details were recorded hold only the stores' keys
+                self.stores = catalog
+
+    def keys_for(self,
+                 filename: Union[str, Path],
+                 table: Optional[str] = None) -> Dict[str, Dict]:
+        keys = self.stores.get(Path(filename).name, dict())
+        return {key: entry for key, entry in keys.items() if table is None or entry['table'] == table}
+
+    def is_current(self,
+                   filename: Union[str, Path]) -> bool:
+        """Whether the catalog entries of a store were recorded from the store as it is now"""
+
+        name = Path(filename).name
+        recorded = self.files.get(name)
+        return name in self.stores and recorded is not None and recorded == file_stat(self.directory / name)
+
+    def is_processed(self,
+                     filename: Union[str, Path],
+                     table: str) -> bool:
+        filepath = self.directory / Path(filename).name
+        if not filepath.is_file():
+            return False
+        if self.is_current(filepath):
+            return len(self.keys_for(filepath, table)) > 0
+        logging.info(f'...{filepath.name} has changed since it was cataloged, checking the store for {table}')
+        return len(stored_keys(read_pool.get(filepath), table)) > 0
+
+    def rows(self,
+             filename: Union[str, Path],
+             table: Optional[str] = None) -> int:
+        return sum(entry['rows'] for entry in self.keys_for(filename, table).values())
+
+    def years(self,
+              filename: Union[str, Path],
+              table: Optional[str] = None) -> List:
+        return sorted({year for entry in self.keys_for(filename, table).values() for year in entry['years']}, key=str)
+
+    def record(self,
+               filename: Union[str, Path],
+               table: str,
+               entries: Dict[str, Dict]) -> None:
+        """Replace the entries for a table of a store and save the catalog, see record_tables"""
+
+        self.record_tables(filename, {table: entries})
+
+    def record_tables(self,
+                      filename: Union[str, Path],
+                      tables: Dict[str, Dict[str, Dict]]) -> None:
+        """Replace the entries for each table of a store and save the catalog
+
+        The entries of the store's other tables are reconciled with its keys, so keys of a store that were never
+        cataloged are added and keys no longer in it dropped.
+        """
+
+        name = Path(filename).name
+        keys = {key: entry for key, entry in self.keys_for(name).items() if entry['table'] not in tables}
+        for entries in tables.values():
+            keys.update(entries)
+        filepath = self.directory / name
+        if filepath.is_file():
+            store = read_pool.get(filepath)
+            stored = store.keys()
+            keys = {key: entry for key, entry in keys.items() if key in stored}
+            for key in stored:
+                if key not in keys:
+                    keys[key] = catalog_entry(key.split('/')[1], read_key(store, key))
+        self.stores[name] = keys
+        self.files[name] = file_stat(filepath)
+        self.save()
+
+    def save(self) -> None:
+        with atomic_path(self.filepath) as temp_path:
+            with open(temp_path, 'w') as f:
+                json.dump(dict(stores=self.stores, files=self.files), f, indent=1)
+
+
+def build_catalog(directory: Union[str, Path],
+                  suffix: str = '.hd5') -> StoreCatalog:
+    """Recreate the catalog of a directory by reading every key of every store in it"""
+
+    catalog = StoreCatalog(directory)
+    catalog.stores = dict()
+    catalog.files = dict()
+    for filepath in sorted(Path(directory).glob(f'*{suffix}')):
+        store = read_pool.get(filepath)
+        entries = dict()
+        for key in store.keys():
+            table = key.split('/')[1]
+            entries[key] = catalog_entry(table, read_key(store, key))
+        catalog.stores[filepath.name] = entries
+        catalog.files[filepath.name] = file_stat(filepath)
+    catalog.save()
+    return catalog
+
+
+def read_partitions(filepath: Union[str, Path]) -> Iterator[pd.DataFrame]:
+    """Read the tables, and the parts of chunked tables, of an ingested store one key at a time"""
+
+    store = read_pool.get(filepath)
+    for key in store.keys():
+        yield read_key(store, key)
+
+
+NORMALISED_INDEX = ['id', 'year', 'source', 'source_institution_name']
+
+
+def join_normalised(series: Dict[str, pd.Series]) -> pd.DataFrame:
+    """Outer join the series produced by normalise for each CategoryFilter into a single frame
+
+    Filters that matched no rows return an empty series, these are kept as all missing columns.
+    """
+
+    non_empty = {name: s for name, s in series.items() if len(s) > 0}
+    if non_empty:
+        out_df = pd.concat(non_empty, axis=1, join='outer')
+    else:
+        out_df = pd.DataFrame(index=pd.MultiIndex.from_tuples([], names=NORMALISED_INDEX))
+    out_df.index.names = NORMALISED_INDEX
+    return out_df.reindex(columns=list(series.keys()))
+
+
+def write_normalised(out_df: pd.DataFrame,
+                     filepath: Union[str, Path]) -> None:
+    """Write a normalised frame to Parquet with its index as typed columns
+
+    The string index columns are written as categoricals, so Parquet stores them dictionary encoded, the year as an
+    integer and the metric columns as floats, missing where a filter has no count for an institution and year.
+
+    Normalised outputs were CSV files before they were Parquet, see iter_normalised for the handling of old outputs.
+    Unlike the optional Parquet and Avro shard formats pyarrow is required here, the pipeline cannot normalise or
+    combine without it.
+    """
+
+    out_df = out_df.reset_index()
+    for col in ['id', 'source', 'source_institution_name']:
+        out_df[col] = out_df[col].astype('category')
+    out_df['year'] = out_df['year'].astype(int)
+    metrics = [col for col in out_df.columns if col not in NORMALISED_INDEX]
+    out_df[metrics] = out_df[metrics].astype(float)
+    with atomic_path(filepath) as temp_path:
+        out_df.to_parquet(temp_path, index=False)
+
+
+def read_normalised(filepath: Union[str, Path],
+                    columns: Optional[List[str]] = None,
+                    index: bool = False) -> pd.DataFrame:
+    """Read a normalised Parquet file, optionally only the given metric columns
+
+    The index columns are always read. They are returned as columns, as the CSV files were, unless index is True.
+    The string index columns are returned as categoricals rather than the object columns read from CSV. Requires
+    pyarrow.
+    """
+
+    if columns is not None:
+        available = metric_columns(filepath)
+        columns = NORMALISED_INDEX + [col for col in columns if col in available]
+    df = pd.read_parquet(filepath, columns=columns)
+    if index:
+        df = df.set_index(NORMALISED_INDEX)
+    return df
+
+
+def metric_columns(filepath: Union[str, Path]) -> List[str]:
+    """The metric columns of a normalised Parquet file, read from its schema without loading any data"""
+
+    import pyarrow.parquet as pq
+    return [name for name in pq.read_schema(filepath).names if name not in NORMALISED_INDEX]
@@ -15,17 +15,170 @@
 # Author: Cameron Neylon
 import json
 import os
+import queue
 import re
 import logging
+import threading
+from collections.abc import MutableMapping, Mapping
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from importlib import import_module
-from typing import Union, Optional, Dict
+from typing import Union, Optional, Dict, Iterator, List, Tuple
 
 import sources as sources
+from sources import load_source
 from sources.generic import DataFile
+from coki_diversity.process.id_index import IdIndex
+from coki_diversity.process.store import MARKER_DIRECTORY
+
+# Raw files and ingested stores, other files are skipped before they are matched against any source's regex
+DATA_EXTENSIONS = ('.xls', '.xlsx', '.csv', '.hd5')
+SKIPPED_DIRECTORIES = {MARKER_DIRECTORY}
+SCAN_WORKERS_ENVIRONMENT_VARIABLE = 'COKI_DIVERSITY_SCAN_WORKERS'
+
+
+def load_id_map(source: str,
+                id_map_path: Union[str, Path] = '../data/id_mappings') -> Mapping:
+    """The ID map of a source, from its binary index where build_id_maps has written one that is up to date"""
+
+    id_map_path = Path(id_map_path)
+    map_path = sorted(id_map_path.glob(f'**/{source[0:2]}_id_map.json'))[0]
+    index_path = map_path.with_suffix('.idx')
+    if index_path.is_file() and index_path.stat().st_mtime >= map_path.stat().st_mtime:
+        return IdIndex(index_path)
+    with open(map_path) as f:
+        return json.load(f)
+
+
+def is_data_file(filename: str) -> bool:
+    return filename.lower().endswith(DATA_EXTENSIONS)
+
+
+def list_directory(path: str) -> (List[str], List[str]):
+    """The subdirectories to scan and the data files of a directory, from a single os.scandir
+
+    As with os.walk, symbolic links to directories are not followed and directories that cannot be listed are
+    skipped.
+    """
+
+    subdirectories, filenames = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    if entry.name not in SKIPPED_DIRECTORIES and not entry.is_symlink():
+                        subdirectories.append(entry.path)
+                elif is_data_file(entry.name):
+                    filenames.append(entry.name)
+    except OSError as e:
+        logging.warning(f'Could not list {path}: {e}')
+    return subdirectories, filenames
+
+
+def scan_tree(directory: Union[str, Path],
+              workers: int) -> Iterator[Tuple[str, str]]:
+    """The directory and filename of each data file below directory, listed concurrently by a pool of threads
+
+    Each directory is listed in its own task, which submits a task for each of its subdirectories, so on a network
+    filesystem many listings are in flight at once and the scan carries on while the files already found are being
+    processed. Files are yielded as soon as their directory has been listed, in no particular order.
+    """
+
+    results = queue.Queue()
+    stopped = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='walker-scan')
+    # Tasks submitted whose result has not been taken, counted before each submit so that a child posting its result
+    # ahead of its parent cannot bring the count to zero while tasks are still running
+    lock = threading.Lock()
+    outstanding = 1
+
+    def scan(path):
+        nonlocal outstanding
+        try:
+            subdirectories, filenames = list_directory(path)
+            for subdirectory in subdirectories:
+                if stopped.is_set():
+                    break
+                with lock:
+                    outstanding += 1
+                try:
+                    executor.submit(scan, subdirectory)
+                except BaseException:
+                    with lock:
+                        outstanding -= 1
+                    raise
+            results.put((path, filenames, None))
+        except BaseException as e:
+            results.put((path, [], e))
+
+    executor.submit(scan, str(directory))
+    try:
+        while True:
+            path, filenames, error = results.get()
+            if error is not None:
+                raise error
+            for filename in filenames:
+                yield path, filename
+            with lock:
+                outstanding -= 1
+                if outstanding == 0:
+                    break
+    finally:
+        stopped.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+class SourceEntry(MutableMapping):
+    """Mapping of the components of a source that are only imported or loaded when first accessed
+
+    Provides the same keys as the plain dicts previously built by Walker.map_sources: 'ingestor', 'id_map', 'regex'
+    and 'filter_list'. Matching raw filenames only needs the regex so walking a directory does not import the
+    ingestor, filters or pandas, and the ID map is only parsed when a stage actually maps ids.
+    """
+    loaders = {'ingestor': lambda entry: load_source(entry.name).ingestor,
+               'id_map': lambda entry: load_id_map(entry.name, entry.id_map_path),
+               'regex': lambda entry: load_source(entry.name).file_regex,
+               'filter_list': lambda entry: load_source(entry.name).filter_list}
+
+    def __init__(self,
+                 name: str,
+                 id_map_path: Union[str, Path] = '../data/id_mappings'):
+        self.name = name
+        self.id_map_path = Path(id_map_path)
+        self._loaded = dict()
+
+    def __getitem__(self, key):
+        if key not in self._loaded:
+            if key not in self.loaders:
+                raise KeyError(key)
+            self._loaded[key] = self.loaders[key](self)
+        return self._loaded[key]
+
+    def __setitem__(self, key, value):
+        self._loaded[key] = value
+
+    def __delitem__(self, key):
+        del self._loaded[key]
+
+    def __iter__(self):
+        return iter(list(self.loaders) + [k for k in self._loaded if k not in self.loaders])
+
+    def __len__(self):
+        return len(set(self.loaders).union(self._loaded))
 
 
 class Walker:
+    """Finds the data files of a set of sources in a directory tree
+
+    Only files with one of the DATA_EXTENSIONS are matched against the sources' regexes, and completion marker
+    directories are not entered. With scan_workers, or the COKI_DIVERSITY_SCAN_WORKERS environment variable, greater
+    than one the tree is listed by that many threads, see scan_tree, which is much faster where listing a directory
+    is slow, as on a network filesystem. Otherwise it is listed with os.walk. Either way walk yields each DataFile as
+    soon as it is found.
+    """
     data_folder = Path('data')
 
     def __init__(self,
@@ -33,9 +186,13 @@ class Walker:
                  source_modules,
                  source_package=sources,
                  verbose=False,
-                 id_map_path='../data/id_mappings'):
+                 id_map_path='../data/id_mappings',
+                 scan_workers: Optional[int] = None):
         self.directory = Path(directory)
         self.ingestor = None
+        if scan_workers is None:
+            scan_workers = int(os.environ.get(SCAN_WORKERS_ENVIRONMENT_VARIABLE, 1))
+        self.scan_workers = scan_workers
 
         self.mapping = self.map_sources(source_modules,
                                         source_package,
@@ -50,41 +207,52 @@ class Walker:
             table = '_all_'
             mapping = self.mapping
             for source in mapping.keys():
-                mapping[source].update(dict(regex=re.compile(source + '_(?P<year>(20[0-9]{2})|(_all_)).hd5')))
+                mapping[source].update(dict(regex=re.compile('^' + source + r'_(?P<year>20[0-9]{2}|_all_)\.hd5$')))
 
         if not mapping:
             mapping = self.mapping
 
+        for dir, filename in self.scan():
+            year = None
+            source = None
+            if stage != 'ingested':
+                table = None
+
+            filepath = Path(dir) / Path(filename)
+            if verbose:
+                print(f'Matching {filepath}')
+            for source_name in mapping.keys():
+                regex = mapping[source_name].get('regex')
+                match = regex.search(str(filename))
+                if match:
+                    source = source_name
+                    year = match.group('year')
+                    if not table:
+                        table = match.group('table')
+                    if verbose:
+                        print(f'Matched to: {source, year, table}')
+                    break
+
+            if year and table and source:
+                logging.info(f'Filepath: {filepath} matched')
+                logging.info(f'source: {source} year: {year} table: {table}')
+                yield DataFile(year, table, filepath, dir, filename, source)
+                continue
+
+            else:
+                logging.info(f'Filepath: {filepath}...did not match any known source')
+
+    def scan(self) -> Iterator[Tuple[str, str]]:
+        """The directory and filename of each data file in the tree, see the class docstring"""
+
+        if self.scan_workers > 1:
+            yield from scan_tree(self.directory, self.scan_workers)
+            return
         for dir, directories, filenames in os.walk(self.directory):
+            directories[:] = [d for d in directories if d not in SKIPPED_DIRECTORIES]
             for filename in filenames:
-                year = None
-                source = None
-                if stage != 'ingested':
-                    table = None
-
-                filepath = Path(dir) / Path(filename)
-                if verbose:
-                    print(f'Matching {filepath}')
-                for source_name in mapping.keys():
-                    regex = mapping[source_name].get('regex')
-                    match = regex.search(str(filename))
-                    if match:
-                        source = source_name
-                        year = match.group('year')
-                        if not table:
-                            table = match.group('table')
-                        if verbose:
-                            print(f'Matched to: {source, year, table}')
-                        break
-
-                if year and table and source:
-                    logging.info(f'Filepath: {filepath} matched')
-                    logging.info(f'source: {source} year: {year} table: {table}')
-                    yield DataFile(year, table, filepath, dir, filename, source)
-                    continue
-
-                else:
-                    logging.info(f'Filepath: {filepath}...did not match any known source')
+                if is_data_file(filename):
+                    yield dir, filename
 
     def map_sources(self,
                     source_modules,
@@ -92,21 +260,8 @@ class Walker:
                     id_map_path='../data/id_mappings'):
 
         mapping = dict()
-        id_map_path = Path(id_map_path)
 
         for module in source_modules:
-            fullname = f'sources.{module}'
-            source_module = import_module(fullname)
-            map_path = sorted(id_map_path.glob(f'**/{module[0:2]}_id_map.json'))[0]
-            with open(map_path) as f:
-                id_map = json.load(f)
-            mapping.update({module:
-                {
-                    'ingestor': source_module.ingestor,
-                    'id_map': id_map,
-                    'regex': source_module.file_regex,
-                    'filter_list': source_module.filter_list}
-            }
-            )
+            mapping.update({module: SourceEntry(module, id_map_path=id_map_path)})
 
         return mapping
@@ -0,0 +1,81 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+"""Registry of Diversity Data Sources
+
+Source packages are discovered without being imported, either as sub-packages of this package or through the
+'coki_diversity.sources' entry point group, where the entry point value is the importable module path of an external
+source package. A source is only imported the first time it is requested with load_source.
+
+Source packages only import their file_regex eagerly. The ingestor and filters (and with them pandas) are imported
+when first accessed, see lazy_source_attributes.
+"""
+
+import pkgutil
+from importlib import import_module
+from importlib.metadata import entry_points
+from types import ModuleType
+from typing import Callable, Dict
+
+ENTRY_POINT_GROUP = 'coki_diversity.sources'
+NON_SOURCE_PACKAGES = ['generic', 'template']
+
+_loaded_sources: Dict[str, ModuleType] = dict()
+
+
+def _source_entry_points():
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return eps.select(group=ENTRY_POINT_GROUP)
+    return eps.get(ENTRY_POINT_GROUP, [])
+
+
+def available_sources() -> Dict[str, str]:
+    """Map the name of each known source to its module path without importing it"""
+
+    sources = {name: f'{__name__}.{name}' for _, name, ispkg in pkgutil.iter_modules(__path__)
+               if ispkg and name not in NON_SOURCE_PACKAGES}
+    sources.update({ep.name: ep.value for ep in _source_entry_points()})
+    return sources
+
+
+def load_source(name: str) -> ModuleType:
+    """Import a source package on first use and return the cached module thereafter"""
+
+    if name not in _loaded_sources:
+        module_path = available_sources().get(name)
+        if module_path is None:
+            raise KeyError(f'No source package is registered with the name {name}')
+        _loaded_sources[name] = import_module(module_path)
+    return _loaded_sources[name]
+
+
+def lazy_source_attributes(package_name: str) -> Callable:
+    """Build a module level __getattr__ that imports a source's ingestor and filters on first access"""
+
+    attributes = {'ingestor': ('.ingestor', None),
+                  'ingest': ('.ingestor', 'ingest'),
+                  'filters': ('.filters', None),
+                  'filter_list': ('.filters', 'filter_list')}
+
+    def __getattr__(name):
+        if name not in attributes:
+            raise AttributeError(f'module {package_name} has no attribute {name}')
+        module_name, attribute = attributes[name]
+        module = import_module(module_name, package_name)
+        return module if attribute is None else getattr(module, attribute)
+
+    return __getattr__
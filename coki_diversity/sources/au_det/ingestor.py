@@ -39,10 +39,9 @@ directly available from the file itself it should be set to None for cleanup lat
 * source_count_type - One of 'fte', 'headcount', 'unknown
 """
 
-import numpy as np
 import pandas as pd
-from pandas.api.types import is_numeric_dtype
-from ..generic import DataFile
+from ..generic import DataFile, IngestSpec, Layout
+from ..generic.engine import ingest_spec, map_categories
 
 
 def small_numbers(cell):
@@ -60,41 +59,45 @@ def small_numbers(cell):
     else:
         return cell
 
+
+def header_from_rows(source_data: pd.DataFrame, file: DataFile) -> pd.DataFrame:
+    """The gender and year of each column are held in the first two rows below the header"""
+
+    source_data[source_data.columns[0]] = source_data[source_data.columns[0]].ffill()
+    gender = source_data.iloc[0, 2:].ffill()
+    year = source_data.iloc[1, 2:]
+    data = source_data.iloc[2:].copy()
+    data.columns = pd.MultiIndex.from_arrays([['current_duties_classification', 'source_name'] + list(gender),
+                                              ['', ''] + list(year)])
+    return data
+
+
+def clean_names(long_df: pd.DataFrame, file: DataFile) -> pd.DataFrame:
+    long_df['lower_name'] = map_categories(long_df.source_name,
+                                           lambda x: x.lower().replace('the ', '').replace(',', ''))
+    long_df['source_count_type'] = file.table.split('_')[0]
+    return long_df
+
+
+spec = IngestSpec(source='au_det',
+                  layouts=[
+                      Layout(years=['_all_'],
+                             read_options=dict(header=2,
+                                               skipfooter=5,
+                                               converters={col: small_numbers for col in range(3, 48)}),
+                             prepare=header_from_rows,
+                             id_vars=[0, 1],
+                             id_names=['current_duties_classification', 'source_name'],
+                             var_name=['gender', 'year'],
+                             preserve_case=['source_name'],
+                             finish=clean_names,
+                             category_types=['current_duties_classification', 'gender'],
+                             year_column='year',
+                             institution_id='lower_name',
+                             institution_name='source_name',
+                             count_type_column='source_count_type')
+                  ])
+
+
 def ingest(file: DataFile):
-    source_data = pd.read_excel(file.filepath, header=2, skipfooter=5, engine='openpyxl',
-                                converters={col: small_numbers for col in range(3,48)})
-    source_data[source_data.columns[0]].ffill(inplace=True)
-    source_data[0:1] = source_data[0:1].ffill(axis='columns')
-
-    num_lines = len(source_data[2:])
-    long_df = pd.DataFrame()
-    for column in source_data.columns[2:]:
-        year = [source_data[column].values[1]] * num_lines
-        gender = [source_data[column].values[0]] * num_lines
-        current_duties_classification = source_data[source_data.columns[0]][2:]
-        source_name = source_data[source_data.columns[1]][2:]
-        counts = source_data[column][2:]
-        long_df = long_df.append(pd.DataFrame(dict(year=year,
-                                                   gender=gender,
-                                                   current_duties_classification=current_duties_classification,
-                                                   source_name=source_name,
-                                                   counts=counts)))
-
-    long_df['lower_name'] = long_df.source_name.str.lower()
-    long_df.lower_name = long_df.lower_name.str.replace('the ', '')
-    long_df.lower_name = long_df.lower_name.str.replace(',', '')
-    long_df.current_duties_classification = long_df.current_duties_classification.str.lower()
-    long_df.gender = long_df.gender.str.lower()
-    category_types = ['current_duties_classification', 'gender']
-    category_values = long_df[category_types].apply(list, axis='columns')
-    source_count_type = file.table.split('_')[0]
-    out_df = pd.DataFrame(dict(year=long_df.year.astype(int, errors='ignore'),
-                               source_institution_id=long_df.lower_name,
-                               source_institution_name=long_df.source_name,
-                               source=[file.source] * len(long_df),
-                               source_category_type=[category_types] * len(long_df),
-                               source_category_value=category_values,
-                               counts=long_df['counts'].astype(int, errors='ignore'),
-                               source_count_type=[source_count_type] * len(long_df)))
-
-    return out_df
+    return ingest_spec(file, spec)
@@ -39,9 +39,12 @@ directly available from the file itself it should be set to None for cleanup lat
 * source_count_type - One of 'fte', 'headcount', 'unknown
 """
 
-import numpy as np
 import pandas as pd
-from ..generic import DataFile
+from ..generic import DataFile, IngestSpec, Layout
+from ..generic.engine import ingest_spec, map_categories
+
+SHEET_COUNT_TYPES = {'1': 'fte',
+                     '2': 'headcount'}
 
 
 def small_numbers(cell):
@@ -59,86 +62,60 @@ def small_numbers(cell):
     else:
         return cell
 
-def to_list(element):
-    return [element]
 
-def ingest(file: DataFile):
-    if file.year < 2008:
-        return
+def read_options(columns: int) -> dict:
+    """Both sheets are read from a single open of the workbook, columns is the width of the era's tables"""
 
-    header = [2, 3]
-    skiprows = 0
-    skipfooter = 2
-    sheet_map = {'1': 'fte',
-                 '2': 'headcount'}
+    return dict(header=[2, 3],
+                skipfooter=2,
+                sheet_name=list(SHEET_COUNT_TYPES),
+                converters={col: small_numbers for col in range(1, columns)})
 
-    if file.year > 2019:
-        columns = 12
-        institution_col = 1
 
-    elif file.year > 2013:
-        columns = 11
-        institution_col = 0
+def drop_empty(sheet_df: pd.DataFrame, file: DataFile) -> pd.DataFrame:
+    """Drop the spacer columns and then the note rows of a sheet"""
 
-    elif file.year > 2007:
-        columns = 17
-        institution_col = 0
+    return sheet_df.dropna(axis='columns', thresh=3).dropna(axis='index', thresh=2)
 
-    else:
-        return
 
-    if file.filepath.suffix == '.xlsx':
-        engine = 'openpyxl'
-    else:
-        engine = None
-
-    converters = {col: small_numbers for col in range(1, columns)}
-    source_sheets = pd.read_excel(file.filepath,
-                                  header=header,
-                                  skiprows=skiprows,
-                                  skipfooter=skipfooter,
-                                  sheet_name=['1', '2'],
-                                  converters=converters,
-                                  engine=engine)
-
-    long_df = pd.DataFrame()
-    for sheet_name in source_sheets.keys():
-        if sheet_name in ['1', '2']:
-            sheet_df = source_sheets.get(sheet_name)
-            sheet_df.dropna(axis='columns', thresh=3, inplace=True)
-            sheet_df.dropna(axis='index', thresh=2, inplace=True)
-            if file.year == 2020:
-                sheet_df.drop(columns=[sheet_df.columns[0]], inplace=True)
-
-            level_0_list = [col.lower() for col in sheet_df.columns.levels[0]]
-            level_1_list = [col.lower() for col in sheet_df.columns.levels[1]]
-            sheet_df.columns.set_levels(level_0_list, level=0, inplace=True)
-            sheet_df.columns.set_levels(level_1_list, level=1, inplace=True)
-
-            melted = sheet_df.melt(id_vars=[sheet_df.columns[0]],
-                                 value_vars=[c for c in sheet_df.columns[1:]],
-                                 var_name=['source_category_types', 'source_category_values'],
-                                 value_name='counts')
-
-            melted.rename(columns={sheet_df.columns[0]: 'source_name'}, inplace=True)
-            melted['source_count_type'] = [sheet_map[sheet_name]] * len(melted)
-            melted.source_category_types = melted.source_category_types.apply(to_list)
-            melted.source_category_values = melted.source_category_values.apply(to_list)
-
-            long_df = long_df.append(melted)
-
-    long_df['lower_name'] = long_df.source_name.str.lower()
-    long_df.lower_name = long_df.lower_name.str.replace('the ', '')
-    long_df.lower_name = long_df.lower_name.str.replace(',', '')
-    out_df = pd.DataFrame(dict(year=[file.year] * len(long_df),
-                               source_institution_id=long_df.lower_name,
-                               source_institution_name=long_df.lower_name,
-                               source=[file.source] * len(long_df),
-                               source_category_type=long_df.source_category_types,
-                               source_category_value=long_df.source_category_values,
-                               counts=long_df['counts'].astype(int, errors='ignore'),
-                               source_count_type=long_df.source_count_type
-                               )
-                          )
-    
-    return out_df
\ No newline at end of file
+def drop_state(sheet_df: pd.DataFrame, file: DataFile) -> pd.DataFrame:
+    """From 2020 the institution name is preceded by a state column"""
+
+    sheet_df = drop_empty(sheet_df, file)
+    return sheet_df.drop(columns=[sheet_df.columns[0]])
+
+
+def clean_names(long_df: pd.DataFrame, file: DataFile) -> pd.DataFrame:
+    long_df['lower_name'] = map_categories(long_df.source_name, lambda x: x.replace('the ', '').replace(',', ''))
+    return long_df
+
+
+def era_layout(years: range,
+               columns: int,
+               prepare=drop_empty) -> Layout:
+    return Layout(years=years,
+                  read_options=read_options(columns),
+                  prepare=prepare,
+                  id_vars=[0],
+                  id_names=['source_name'],
+                  var_name=['source_category_types', 'source_category_values'],
+                  sheet_column='source_count_type',
+                  value_maps=dict(source_count_type=SHEET_COUNT_TYPES),
+                  finish=clean_names,
+                  category_types=['source_category_values'],
+                  type_columns=dict(source_category_values='source_category_types'),
+                  institution_id='lower_name',
+                  institution_name='lower_name',
+                  count_type_column='source_count_type')
+
+
+spec = IngestSpec(source='au_indigenous',
+                  layouts=[
+                      era_layout(range(2008, 2014), columns=17),
+                      era_layout(range(2014, 2020), columns=11),
+                      era_layout(range(2020, 2100), columns=12, prepare=drop_state)
+                  ])
+
+
+def ingest(file: DataFile):
+    return ingest_spec(file, spec)
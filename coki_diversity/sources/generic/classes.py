@@ -14,7 +14,7 @@
 
 # Author: Cameron Neylon
 
-from typing import Union, Optional, NamedTuple, Tuple, List, Dict
+from typing import Union, Optional, NamedTuple, Tuple, List, Dict, Callable
 from pathlib import Path
 
 
@@ -51,11 +51,11 @@ class FileFilter(NamedTuple):
     count_type: Optional[Union[str, None]] = None
 
     def expand_years(self):
-        if type(self.years) == list:
-            pass
-        elif type(self.years) == tuple:
-            yrs = range(*self.years)
-            self._replace(years=yrs)
+        """Return the filter with a (start, end) tuple of years expanded to the non-inclusive range it describes"""
+
+        if type(self.years) == tuple:
+            return self._replace(years=range(*self.years))
+        return self
 
     def __repr__(self):
         return f"""
@@ -68,11 +68,95 @@ class CategoryFilter:
     def __init__(self,
                  name: str,
                  filefilters: List[FileFilter]):
-        self.filefilters = filefilters
+        self.filefilters = [f.expand_years() for f in filefilters]
         self.source = filefilters[0].source
         for i, _ in enumerate(filefilters):
             assert (self.source == filefilters[i].source)
         self.name = name
+        self.index = self.index_years(self.filefilters)
+
+    def index_years(self, filefilters: List[FileFilter]) -> Dict[Tuple[int, Optional[str]], List[FileFilter]]:
+        """Index the FileFilters by (year, count_type), checking that no two of them apply to the same data
+
+        A FileFilter with a count_type of None applies to every count type, so overlaps with any other FileFilter
+        covering the same year. Overlapping filters would double count, so are rejected when the filters are loaded.
+        """
+
+        index = dict()
+        for filefilter in filefilters:
+            for year in filefilter.years:
+                if filefilter.count_type is None:
+                    overlapping = [k for k in index.keys() if k[0] == year]
+                else:
+                    overlapping = [k for k in [(year, filefilter.count_type), (year, None)] if k in index]
+                if overlapping:
+                    raise ValueError(f'CategoryFilter {self.name} has overlapping FileFilters for {year} '
+                                     f'and count type {filefilter.count_type}: {index[overlapping[0]]} and '
+                                     f'{filefilter}')
+                index[(year, filefilter.count_type)] = [filefilter]
+        return index
+
+    def filters_for(self,
+                    year: int,
+                    count_type: Optional[str] = None) -> List[FileFilter]:
+        """The FileFilters that apply to data for a year and count type"""
+
+        filefilters = self.index.get((year, None), [])
+        if count_type is not None:
+            filefilters = filefilters + self.index.get((year, count_type), [])
+        return filefilters
+
+
+class Layout(NamedTuple):
+    """Declares how one era of a source's files is read and reshaped into long form
+
+    A layout is applied by coki_diversity.sources.generic.engine.ingest_spec. Columns are read with the read_options
+    (passed to pandas read_excel or read_csv, or to a custom reader), optionally cleaned by prepare, melted on the
+    id_vars, and the category_types columns become the source_category_value lists. By default the names of the
+    category_types columns are also the source_category_type entries, type_columns maps a value column to a column
+    that holds its category type instead. Header labels and string columns are lowercased (and lstripped if strip is
+    set) apart from the year column and any listed in preserve_case. Counts are cast to integers unless
+    integer_counts is False, eg for fractional FTE counts.
+    """
+    years: Union[range, List[int]]
+    category_types: List[str]
+    institution_id: str
+    institution_name: Optional[str] = None
+    read_options: Optional[Dict] = None
+    reader: Optional[Callable] = None
+    id_vars: Optional[List[Union[int, str]]] = None
+    id_names: Optional[List[str]] = None
+    var_name: Optional[Union[str, List[str]]] = None
+    type_columns: Optional[Dict[str, str]] = None
+    value_maps: Optional[Dict[str, Dict]] = None
+    sheet_column: Optional[str] = None
+    year_column: Optional[str] = None
+    count_type: Optional[str] = None
+    count_type_column: Optional[str] = None
+    dropna_rows: Optional[int] = None
+    dropna_columns: Optional[int] = None
+    strip: bool = False
+    integer_counts: bool = True
+    preserve_case: Optional[List[str]] = None
+    prepare: Optional[Callable] = None
+    finish: Optional[Callable] = None
+
+
+class IngestSpec:
+
+    def __init__(self,
+                 source: str,
+                 layouts: List[Layout]):
+        self.source = source
+        self.layouts = layouts
+
+    def layout_for(self, year: int) -> Union[Layout, None]:
+        """Return the layout covering a year, or None where the source does not ingest that year"""
+
+        for layout in self.layouts:
+            if year in layout.years:
+                return layout
+        return None
 
 
 class Walker:
@@ -0,0 +1,311 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+"""
+Shared Ingest Engine
+
+Runs the read -> clean -> melt -> category lists -> out_df sequence that every ingestor needs from a declarative
+IngestSpec. The helpers are also usable directly by ingestors with layouts that do not fit a spec.
+
+String handling is done at the level of the unique values. Columns are converted to categoricals and only their
+categories are lowercased, so the cost scales with the number of distinct labels rather than the number of cells.
+Category lists are built by zipping column arrays rather than applying list along the rows.
+
+Every ingestor's output is conformed to the same dtypes by conform_output: categorical string columns, the smallest
+integer or float dtype that holds the counts and int16 years. Columns that cannot be coerced are left as they are
+and reported.
+
+This module imports pandas so it is deliberately not re-exported from the generic package.
+"""
+
+import logging
+from itertools import repeat
+from typing import Union, Optional, List, Dict, Callable, NamedTuple
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_numeric_dtype
+
+from .classes import DataFile, Layout, IngestSpec
+
+CATEGORICAL_COLUMNS = ['source', 'source_institution_id', 'source_institution_name', 'source_count_type',
+                       'source_year_type']
+ACADEMIC_YEAR = r'\d{4}[/-]\d{2}'
+
+
+def _lower(value, strip=False):
+    if isinstance(value, str):
+        value = value.lower()
+        if strip:
+            value = value.lstrip()
+    return value
+
+
+def map_categories(series: pd.Series,
+                   func: Callable) -> pd.Series:
+    """Apply a function to each distinct value of a series, returning a categorical
+
+    Only the categories are transformed. Where several categories map to the same value, eg 'All' and 'all' when
+    lowercasing, the codes are remapped onto the merged categories.
+    """
+
+    categorical = series.astype('category')
+    mapped = pd.Index([func(c) for c in categorical.cat.categories])
+    new_categories = mapped.unique()
+    recode = new_categories.get_indexer(mapped)
+    codes = categorical.cat.codes.to_numpy()
+    new_codes = np.where(codes >= 0, recode[codes], -1)
+    return pd.Series(pd.Categorical.from_codes(new_codes, categories=new_categories),
+                     index=series.index,
+                     name=series.name)
+
+
+def lower_values(series: pd.Series,
+                 strip: bool = False) -> pd.Series:
+    """Lowercase (and optionally lstrip) the string values of a series, returning a categorical"""
+
+    return map_categories(series, lambda c: _lower(c, strip=strip))
+
+
+def lower_columns(columns: pd.Index,
+                  strip: bool = False) -> pd.Index:
+    """Lowercase the labels of a (Multi)Index once per level"""
+
+    if isinstance(columns, pd.MultiIndex):
+        levels = [[_lower(c, strip=strip) for c in level] for level in columns.levels]
+        return pd.MultiIndex(levels=levels, codes=columns.codes, names=columns.names)
+    return pd.Index([_lower(c, strip=strip) for c in columns], name=columns.name)
+
+
+class CoercionFailure(NamedTuple):
+    column: str
+    dtype: str
+    failed: int
+    examples: List
+
+
+def smallest_counts(counts: pd.Series,
+                    integer_counts: bool = True) -> pd.Series:
+    """Numeric counts in the smallest integer dtype that holds them, or float32 where that holds them exactly
+
+    Counts are only made integers where integer_counts is set and every count is a whole number. Missing counts
+    leave a float dtype.
+    """
+
+    values = counts.to_numpy(dtype=np.float64)
+    present = ~np.isnan(values)
+    if integer_counts and present.all() and np.array_equal(values, np.round(values)):
+        return pd.to_numeric(counts, downcast='integer')
+    if np.array_equal(values[present].astype(np.float32).astype(np.float64), values[present]):
+        return counts.astype(np.float32)
+    return counts.astype(np.float64)
+
+
+def _coerce_numeric(series: pd.Series) -> (pd.Series, Optional[CoercionFailure]):
+    if is_numeric_dtype(series) and not isinstance(series.dtype, pd.CategoricalDtype):
+        return series, None
+    coerced = pd.to_numeric(series, errors='coerce')
+    failed = coerced.isna() & series.notna()
+    if failed.any():
+        return series, CoercionFailure(series.name, str(series.dtype), int(failed.sum()),
+                                       series[failed].unique()[:5].tolist())
+    return coerced, None
+
+
+def conform_output(out_df: pd.DataFrame,
+                   integer_counts: bool = True) -> pd.DataFrame:
+    """Conform an ingestor's output to the ingest dtypes
+
+    * the string columns of CATEGORICAL_COLUMNS become categoricals
+    * counts take the smallest dtype that holds them, see smallest_counts
+    * years become int16 where every year is present and a whole number, academic years such as 2015/16, which
+      normalise.fix_years converts, become categoricals
+
+    A column that cannot be coerced, eg counts holding text, is left as it is and reported in a warning. The failures
+    are also listed in out_df.attrs['coercion_failures'].
+    """
+
+    failures = []
+    for col in CATEGORICAL_COLUMNS:
+        if col in out_df.columns and not is_numeric_dtype(out_df[col]):
+            out_df[col] = out_df[col].astype('category')
+
+    if 'counts' in out_df.columns:
+        counts, failure = _coerce_numeric(out_df['counts'])
+        if failure is None:
+            out_df['counts'] = smallest_counts(counts, integer_counts=integer_counts)
+        else:
+            failures.append(failure)
+
+    if 'year' in out_df.columns:
+        years, failure = _coerce_numeric(out_df['year'])
+        if failure is None:
+            if years.notna().all() and (years == years.round()).all():
+                out_df['year'] = years.astype(np.int16)
+        elif pd.Series(out_df['year'].dropna().unique()).astype(str).str.fullmatch(ACADEMIC_YEAR).all():
+            out_df['year'] = out_df['year'].astype('category')
+        else:
+            failures.append(failure)
+
+    for failure in failures:
+        logging.warning(f'Could not coerce {failure.column} ({failure.dtype}) for {failure.failed} rows, '
+                        f'eg {failure.examples}')
+    out_df.attrs['coercion_failures'] = failures
+    return out_df
+
+
+def category_lists(df: pd.DataFrame,
+                   columns: List[str],
+                   type_columns: Optional[Dict[str, str]] = None) -> (List, List):
+    """Build the source_category_type and source_category_value lists for every row
+
+    Returns a tuple of (type lists, value lists). Without type_columns every row shares the same list of column
+    names as its category types.
+    """
+
+    value_lists = list(map(list, zip(*[df[c].tolist() for c in columns])))
+    if not type_columns:
+        return [list(columns)] * len(df), value_lists
+
+    types = [df[type_columns[c]].tolist() if c in type_columns else repeat(c) for c in columns]
+    type_lists = list(map(list, zip(*types)))
+    return type_lists, value_lists
+
+
+def build_output(long_df: pd.DataFrame,
+                 file: DataFile,
+                 category_types: List,
+                 category_values: List,
+                 institution_id: str,
+                 institution_name: Optional[str] = None,
+                 year: Optional[Union[str, int]] = None,
+                 count_type: Optional[str] = None,
+                 count_type_column: Optional[str] = None,
+                 integer_counts: bool = True) -> pd.DataFrame:
+    """Assemble the standard ingestor output from a long form frame
+
+    year, if given, names a column of long_df, otherwise the year of the file is used. The count type is taken from
+    count_type_column if given, otherwise the literal count_type if given, otherwise it is omitted. The output is
+    conformed by conform_output, counts are only made integers if integer_counts is set.
+    """
+
+    long_df = long_df.reset_index(drop=True)
+    if institution_name is None:
+        source_institution_name = 'not_captured'
+    else:
+        source_institution_name = long_df[institution_name]
+    out_df = pd.DataFrame(dict(year=long_df[year] if year is not None else file.year,
+                               source_institution_id=long_df[institution_id],
+                               source_institution_name=source_institution_name,
+                               source=file.source,
+                               source_category_type=category_types,
+                               source_category_value=category_values,
+                               counts=long_df['counts']),
+                          index=long_df.index)
+
+    if count_type_column is not None:
+        out_df['source_count_type'] = long_df[count_type_column]
+    elif count_type is not None:
+        out_df['source_count_type'] = count_type
+
+    return conform_output(out_df, integer_counts=integer_counts)
+
+
+def read_file(file: DataFile,
+              layout: Layout) -> Union[pd.DataFrame, Dict[str, pd.DataFrame]]:
+    if layout.reader is not None:
+        return layout.reader(file, layout)
+
+    read_options = dict(layout.read_options or {})
+    if file.filepath.suffix == '.csv':
+        return pd.read_csv(file.filepath, **read_options)
+
+    if file.filepath.suffix == '.xlsx':
+        engine = 'openpyxl'
+    else:
+        engine = None
+    return pd.read_excel(file.filepath, engine=engine, **read_options)
+
+
+def melt_frame(df: pd.DataFrame,
+               file: DataFile,
+               layout: Layout,
+               sheet_name: Optional[str] = None) -> pd.DataFrame:
+    """Clean and melt a single frame (or sheet) according to a layout"""
+
+    if layout.dropna_rows is not None:
+        df = df.dropna(axis='index', thresh=layout.dropna_rows)
+    if layout.dropna_columns is not None:
+        df = df.dropna(axis='columns', thresh=layout.dropna_columns)
+    if layout.prepare is not None:
+        df = layout.prepare(df, file)
+
+    df.columns = lower_columns(df.columns, strip=layout.strip)
+    id_vars = [df.columns[c] if isinstance(c, int) else c for c in (layout.id_vars or [])]
+    melted = df.melt(id_vars=id_vars,
+                     var_name=layout.var_name,
+                     value_name='counts')
+
+    if layout.id_names:
+        melted.rename(columns=dict(zip(id_vars, layout.id_names)), inplace=True)
+    if layout.sheet_column is not None:
+        melted[layout.sheet_column] = sheet_name
+
+    return melted
+
+
+def ingest_spec(file: DataFile,
+                spec: IngestSpec) -> Union[pd.DataFrame, None]:
+    """Ingest a file according to the layout a spec declares for the file's year
+
+    Returns None where the spec has no layout for the year, in line with ingestors that skip unsupported files.
+    """
+
+    layout = spec.layout_for(file.year)
+    if layout is None:
+        return None
+
+    source_data = read_file(file, layout)
+    if isinstance(source_data, dict):
+        long_df = pd.concat([melt_frame(sheet_df, file, layout, sheet_name=sheet_name)
+                             for sheet_name, sheet_df in source_data.items()],
+                            ignore_index=True)
+    else:
+        long_df = melt_frame(source_data, file, layout)
+
+    keep_case = ['counts', layout.year_column] + list(layout.preserve_case or [])
+    for col in long_df.columns:
+        if col not in keep_case and not is_numeric_dtype(long_df[col]):
+            long_df[col] = lower_values(long_df[col], strip=layout.strip)
+    for col, value_map in (layout.value_maps or {}).items():
+        long_df[col] = long_df[col].map(value_map)
+
+    if layout.finish is not None:
+        long_df = layout.finish(long_df, file)
+
+    category_types, category_values = category_lists(long_df,
+                                                      layout.category_types,
+                                                      type_columns=layout.type_columns)
+    return build_output(long_df,
+                        file,
+                        category_types=category_types,
+                        category_values=category_values,
+                        institution_id=layout.institution_id,
+                        institution_name=layout.institution_name,
+                        year=layout.year_column,
+                        count_type=layout.count_type,
+                        count_type_column=layout.count_type_column,
+                        integer_counts=layout.integer_counts)
@@ -39,58 +39,37 @@ directly available from the file itself it should be set to None for cleanup lat
 * source_count_type - One of 'fte', 'headcount', 'unknown
 """
 
-import numpy as np
 import pandas as pd
-from ..generic import DataFile
+from ..generic import DataFile, IngestSpec, Layout
+from ..generic.engine import ingest_spec
+
+
+def fill_merged_cells(source_data: pd.DataFrame, file: DataFile) -> pd.DataFrame:
+    return source_data.ffill()
+
+
+spec = IngestSpec(source='nz_moe',
+                  layouts=[
+                      # The single 2000-2017 workbook, DataFile reads its year as 20 + '20'
+                      Layout(years=[2020],
+                             read_options=dict(header=[3, 4, 5],
+                                               skiprows=0,
+                                               sheet_name='Staff type x Ethnic x Gender'),
+                             dropna_columns=5,
+                             prepare=fill_merged_cells,
+                             id_vars=[0, 1, 2],
+                             id_names=['provider', 'staff type/group', 'ethnic group'],
+                             var_name=['source_count_type', 'year', 'gender'],
+                             value_maps={'source_count_type': {'fte': 'fte',
+                                                               'number of staff': 'headcount'}},
+                             category_types=['staff type/group', 'ethnic group', 'gender'],
+                             year_column='year',
+                             institution_id='provider',
+                             institution_name='provider',
+                             count_type_column='source_count_type',
+                             integer_counts=False)
+                  ])
 
 
 def ingest(file: DataFile):
-    if file.filepath.suffix == '.xlsx':
-        engine = 'openpyxl'
-    else:
-        engine = None
-
-    sheet_name = 'Staff type x Ethnic x Gender'
-    skiprows = 0
-    header = [3,4,5]
-
-    source_data = pd.read_excel(file.filepath,
-                                  header=header,
-                                  skiprows=skiprows,
-                                  sheet_name=sheet_name,
-                                  engine=engine)
-
-    long_df = pd.DataFrame()
-
-    source_data.dropna(axis='columns', thresh=5, inplace=True)
-    source_data.ffill(inplace=True)
-
-    id_vars = source_data.columns[0:3]
-    melted = source_data.melt(id_vars=list(id_vars),
-                              var_name=['source_count_type', 'year', 'gender'],
-                              value_name='counts')
-    melted = melted.applymap(lambda s: s.lower() if type(s) == str else s)
-
-    cleaned_column_names = {melted.columns[0]: 'provider',
-                            melted.columns[1]: 'staff type/group',
-                            melted.columns[2]: 'ethnic group'}
-    melted.rename(columns=cleaned_column_names, inplace=True)
-
-    category_types = ['staff type/group', 'ethnic group', 'gender']
-    melted['category_types'] = [category_types] * len(melted)
-    melted['category_values'] = melted[category_types].apply(list, axis='columns')
-    melted['source_count_type'] = melted.source_count_type.map({'fte': 'fte',
-                                                                'number of staff': 'headcount'
-                                                                })
-
-    long_df = long_df.append(melted)
-
-    out_df = pd.DataFrame(dict(year=long_df.year.astype(int, errors='ignore'),
-                               source_institution_id=long_df.provider,
-                               source_institution_name=long_df.provider,
-                               source=[file.source] * len(long_df),
-                               source_category_type=long_df.category_types,
-                               source_category_value=long_df.category_values,
-                               counts=long_df.counts,
-                               source_count_type=long_df.source_count_type))
-    return out_df
+    return ingest_spec(file, spec)
@@ -39,10 +39,47 @@ directly available from the file itself it should be set to None for cleanup lat
 * source_count_type - One of 'fte', 'headcount', 'unknown
 """
 
-import numpy as np
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+from typing import Optional, Type
+
 import pandas as pd
-from pandas.api.types import is_numeric_dtype
 from ..generic import DataFile
+from ..generic.engine import build_output, category_lists, lower_columns, lower_values, map_categories
+
+# Sheets are transformed concurrently. A ProcessPoolExecutor may be substituted, process_sheet is picklable.
+EXECUTOR: Type[Executor] = ThreadPoolExecutor
+MAX_WORKERS: Optional[int] = None
+
+
+def process_sheet(sheet_name: str,
+                  org_df: pd.DataFrame,
+                  table_number: str,
+                  year: int) -> pd.DataFrame:
+    """Clean and melt the sheet for a single institution"""
+
+    org_df = org_df.dropna(axis='index', thresh=3)
+    org_df = org_df.dropna(axis='columns', thresh=5)
+    org_df.columns = lower_columns(org_df.columns)
+
+    if table_number == '3.3':
+        var_name = ['category_type', 'category_value']
+        first_column_label = 'personnel_category'
+        if year < 2010:
+            org_df['gender', 'male'] = org_df['race', 'male']
+            org_df = org_df.drop(columns=('race', 'male'))
+    elif table_number == '3.5':
+        var_name = ['rank', 'gender']
+        first_column_label = 'age'
+
+    melted = org_df.melt(id_vars=[org_df.columns[0]],
+                         value_vars=[c for c in org_df.columns[1:]],
+                         var_name=var_name,
+                         value_name='counts')
+
+    melted.rename(columns={org_df.columns[0]: first_column_label}, inplace=True)
+    melted['source_institution_id'] = sheet_name.lower()
+    return melted
 
 
 def ingest(file: DataFile):
@@ -72,61 +109,28 @@ def ingest(file: DataFile):
                                   sheet_name=None,
                                   engine=engine)
 
-    long_df = pd.DataFrame()
-    for sheet_name in source_sheets.keys():
-        org_df = source_sheets.get(sheet_name)
-        org_df.dropna(axis='index', thresh=3, inplace=True)
-        org_df.dropna(axis='columns', thresh=5, inplace=True)
-
-        for col in org_df.columns:
-            if not is_numeric_dtype(org_df[col]):
-                org_df[col] = org_df[col].str.lower()
-                org_df[col] = org_df[col].str.lstrip()
-        level_0_list = [col.lower() for col in org_df.columns.levels[0]]
-        level_1_list = [col.lower() for col in org_df.columns.levels[1]]
-        org_df.columns.set_levels(level_0_list, level=0, inplace=True)
-        org_df.columns.set_levels(level_1_list, level=1, inplace=True)
-
-        if table_number == '3.3':
-            var_name = ['category_type', 'category_value']
-            first_column_label = 'personnel_category'
-            if file.year < 2010:
-                org_df['gender', 'male'] = org_df['race', 'male']
-                org_df.drop(columns=('race', 'male'), inplace=True)
-        elif table_number == '3.5':
-            var_name = ['rank', 'gender']
-            first_column_label = 'age'
-
-        melted = org_df.melt(id_vars=[org_df.columns[0]],
-                             value_vars=[c for c in org_df.columns[1:]],
-                             var_name=var_name,
-                             value_name='counts')
-
-        melted.rename(columns={org_df.columns[0]: first_column_label}, inplace=True)
-        melted['source_institution_id'] = [sheet_name.lower()] * len(melted)
-        long_df = long_df.append(melted)
+    with EXECUTOR(max_workers=MAX_WORKERS) as executor:
+        melted_sheets = list(executor.map(partial(process_sheet, table_number=table_number, year=file.year),
+                                          source_sheets.keys(),
+                                          source_sheets.values()))
+    long_df = pd.concat(melted_sheets, ignore_index=True)
 
     if table_number == '3.3':
-        long_df.replace({'category_type': {'unnamed: 1_level_0': 'race',
-                                           'unnamed: 2_level_0': 'race'}}, inplace=True)
-        long_df.category_type = long_df.category_type.str.lower()
-        source_category_types = long_df.category_type.apply(lambda x: ['personnel_category', x])
-        source_category_values = long_df[['personnel_category', 'category_value']].apply(list, axis='columns')
+        long_df['personnel_category'] = lower_values(long_df.personnel_category, strip=True)
+        unnamed_race = {'unnamed: 1_level_0': 'race',
+                        'unnamed: 2_level_0': 'race'}
+        long_df['category_type'] = map_categories(long_df.category_type, lambda x: unnamed_race.get(x, x))
+        category_types, category_values = category_lists(long_df,
+                                                         ['personnel_category', 'category_value'],
+                                                         type_columns={'category_value': 'category_type'})
 
     elif table_number == '3.5':
-        source_category_types = ['age', 'rank', 'gender']
-        for typ in source_category_types:
-            long_df[typ] = long_df[typ].str.lower()
-            long_df[typ] = long_df[typ].str.lstrip()
-        source_category_values = long_df[source_category_types].apply(list, axis='columns')
-        source_category_types = [source_category_types] * len(long_df)
-
-    out_df = pd.DataFrame(dict(year=[file.year] * len(long_df),
-                               source_institution_id=long_df.source_institution_id,
-                               source_institution_name=['not_captured'] * len(long_df),
-                               source=[file.source] * len(long_df),
-                               source_category_type=source_category_types,
-                               source_category_value=source_category_values,
-                               counts=long_df['counts'].astype(int, errors='ignore'))
-                          )
-    return out_df
\ No newline at end of file
+        for typ in ['age', 'rank', 'gender']:
+            long_df[typ] = lower_values(long_df[typ], strip=True)
+        category_types, category_values = category_lists(long_df, ['age', 'rank', 'gender'])
+
+    return build_output(long_df,
+                        file,
+                        category_types=category_types,
+                        category_values=category_values,
+                        institution_id='source_institution_id')
@@ -1,4 +1,5 @@
 from .file_regex import file_regex
-from .ingestor import ingest
+from .. import lazy_source_attributes
 
-from .filters import filter_list
+# ingest and filter_list are imported on first access
+__getattr__ = lazy_source_attributes(__name__)
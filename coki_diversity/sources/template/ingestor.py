@@ -37,16 +37,35 @@ directly available from the file itself it should be set to None for cleanup lat
 * counts - the counts provided in the original data
 * source_year_type - One of 'calendar', 'nh_academic', 'unknown'
 * source_count_type - One of 'fte', 'headcount', 'unknown
-"""
 
-import numpy as np
-import pandas as pd
-from ..generic import DataFile
+Where a source's files can be described declaratively, define an IngestSpec with one Layout per era of the file
+format and let the shared engine perform the reshape. Source specific clean up that cannot be declared can be done in
+the prepare (raw frame) and finish (long form frame) hooks of a layout. A source may still implement ingest by hand
+using the helpers in generic.engine where its files do not fit a spec.
+"""
 
+from ..generic import DataFile, IngestSpec, Layout
+from ..generic.engine import ingest_spec
 
-def ingest(file: DataFile):
-    raise NotImplementedError
+spec = IngestSpec(source='source_name',  # Must correspond to name of source package
+                  layouts=[
+                      Layout(years=range(2010, 2020),  # Files from 2010-2019 share this layout
+                             read_options=dict(header=[2, 3],  # Passed to pd.read_excel or pd.read_csv
+                                               sheet_name=None),  # Read every sheet, one per institution
+                             dropna_rows=3,  # Drop mostly empty rows and columns before the melt
+                             dropna_columns=5,
+                             id_vars=[0],  # Columns (by position or lowercased name) not melted
+                             id_names=['category_name'],  # Names for the id_vars after the melt
+                             var_name=['another_category', 'category_value'],  # Names of the melted header levels
+                             sheet_column='institution',  # Column to receive the sheet name
+                             category_types=['category_name', 'category_value'],
+                             type_columns={'category_value': 'another_category'},  # Type read from a column
+                             institution_id='institution',
+                             institution_name='institution',
+                             count_type='headcount')
+                  ])
 
-    ## Build data ingest process here ##
 
-    return out_df
\ No newline at end of file
+def ingest(file: DataFile):
+    # The example spec above describes the layouts of the source files, replace it with those of the new source
+    return ingest_spec(file, spec)
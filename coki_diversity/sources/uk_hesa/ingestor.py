@@ -14,10 +14,86 @@
 
 # Author: Cameron Neylon
 
+import csv
+from pathlib import Path
+from typing import Iterator, List, Tuple, Union
+
 import numpy as np
 import pandas as pd
 from pandas.api.types import is_numeric_dtype
 from ..generic import DataFile
+from ..generic.engine import build_output, category_lists, lower_values, map_categories, conform_output
+
+HEADER_SEARCH_BYTES = 1024 * 1024
+CHUNK_ROWS = 250000
+CATEGORY_TYPES = ['terms_of_employment', 'contract_levels', 'atypical_marker', 'contract_marker', 'category']
+CATEGORICAL_COLUMNS = CATEGORY_TYPES + ['category_marker', 'he_provider', 'academic_year']
+
+
+def find_header(filepath: Union[str, Path],
+                marker: str = 'UKPRN',
+                search_bytes: int = HEADER_SEARCH_BYTES) -> Tuple[int, List[str]]:
+    """Locate the header row of a HESA csv extract within a bounded read from the start of the file
+
+    Returns the number of rows preceding the header and the column names it contains.
+    """
+
+    with open(filepath) as f:
+        buffer = f.read(search_bytes)
+    for skiprows, line in enumerate(buffer.split('\n')):
+        line = line.lstrip('\ufeff')
+        if line.lstrip('"').startswith(marker):
+            return skiprows, next(csv.reader([line]))
+    raise ValueError(f'No {marker} header row found in the first {search_bytes} bytes of {filepath}')
+
+
+def transform_chunk(source_data: pd.DataFrame,
+                    file: DataFile,
+                    cleaned_column_names: dict) -> pd.DataFrame:
+    source_data = source_data.rename(columns=cleaned_column_names)
+    source_data = source_data.rename(columns={'number': 'counts'})
+
+    for typ in CATEGORY_TYPES + ['category_marker']:
+        source_data[typ] = lower_values(source_data[typ])
+    source_data['terms_of_employment'] = map_categories(source_data['terms_of_employment'],
+                                                        lambda x: x.replace('/', '-') if isinstance(x, str) else x)
+
+    category_types, category_values = category_lists(source_data,
+                                                     CATEGORY_TYPES,
+                                                     type_columns={'category': 'category_marker'})
+    return build_output(source_data,
+                        file,
+                        category_types=category_types,
+                        category_values=category_values,
+                        institution_id='ukprn',
+                        institution_name='he_provider',
+                        year='academic_year')
+
+
+def ingest_csv_chunks(file: DataFile,
+                      chunk_rows: int = CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """Stream a post-2014 HESA staff extract as a sequence of ingested chunks
+
+    Category columns are read as categoricals. Duplicate rows are dropped across the whole file by keeping the hashes
+    of the rows already seen, so only those hashes and a single chunk are held in memory at any time.
+    """
+
+    skiprows, header = find_header(file.filepath)
+    cleaned_column_names = {k: k.lower().replace(' ', '_') for k in header}
+    dtype = {k: 'category' for k, v in cleaned_column_names.items() if v in CATEGORICAL_COLUMNS}
+    dtype.update({'UKPRN': str})
+
+    seen = np.array([], dtype=np.uint64)
+    with pd.read_csv(file.filepath, skiprows=skiprows, dtype=dtype, chunksize=chunk_rows) as reader:
+        for source_data in reader:
+            source_data.drop(columns=['Country of HE provider', 'Region of HE provider'],
+                             inplace=True,
+                             errors='ignore')
+            hashes = pd.util.hash_pandas_object(source_data, index=False).to_numpy()
+            keep = ~(pd.Series(hashes).duplicated().to_numpy() | np.isin(hashes, seen))
+            seen = np.union1d(seen, hashes[keep])
+            if keep.any():
+                yield transform_chunk(source_data[keep], file, cleaned_column_names)
 
 
 def ingest(file: DataFile):
@@ -26,40 +102,7 @@ def ingest(file: DataFile):
     else:
         engine = None
     if file.year > 2014:
-        with open(file.filepath) as f:
-            skiprows = 0
-            row = f.readline()
-            while not row.startswith('UKPRN'):
-                row = f.readline()
-                skiprows = skiprows + 1
-
-        source_data = pd.read_csv(file.filepath, skiprows=skiprows,
-                                  dtype={'UKPRN': str})
-        source_data.drop(columns=['Country of HE provider', 'Region of HE provider'],
-                         inplace=True,
-                         errors='ignore')
-        source_data.drop_duplicates(inplace=True)
-        cleaned_column_names = {k: k.lower().replace(' ', '_') for k in source_data.columns}
-        source_data.rename(columns=cleaned_column_names, inplace=True)
-
-        category_types = ['terms_of_employment', 'contract_levels', 'atypical_marker', 'contract_marker', 'category']
-        for typ in category_types:
-            source_data[typ] = source_data[typ].str.lower()
-        source_data['terms_of_employment'] = source_data['terms_of_employment'].str.replace('/', '-')
-        category_values = np.column_stack((source_data[c] for c in category_types)).tolist()
-        category_types.remove('category')
-        temp_category_types = [category_types[:]] * len(source_data)
-        source_category_types = [category_markers + [category_type.lower()] for
-                                 category_markers, category_type in
-                                 zip(temp_category_types, source_data.category_marker)]
-
-        out_df = pd.DataFrame(dict(year=source_data.academic_year,
-                                   source_institution_id=source_data.ukprn,
-                                   source_institution_name=source_data.he_provider,
-                                   source=[file.source] * len(source_data),
-                                   source_category_type=source_category_types,
-                                   source_category_value=category_values,
-                                   counts=source_data.number.astype(int, errors='ignore')))
+        return ingest_csv_chunks(file)
 
     elif file.year > 2009:
         skiprows = None
@@ -93,12 +136,13 @@ def ingest(file: DataFile):
         source_category_types = melted.category_type.apply(lambda x: ['atypical_marker', x.lower()])
         source_category_values = melted.category_value.apply(lambda x: [atypical_marker, x.lower()])
 
-        out_df = pd.DataFrame(dict(year=[file.year] * len(melted),
+        out_df = pd.DataFrame(dict(year=file.year,
                                    source_institution_id=melted.iloc[:, 0].astype(int).astype(str),
                                    source_institution_name=melted.iloc[:, 1],
-                                   source=[file.source] * len(melted),
+                                   source=file.source,
                                    source_category_type=source_category_types,
                                    source_category_value=source_category_values,
-                                   counts=melted['counts'].astype(int, errors='ignore')))
+                                   counts=melted['counts']))
+        out_df = conform_output(out_df)
 
     return out_df
@@ -39,69 +39,63 @@ directly available from the file itself it should be set to None for cleanup lat
 * source_count_type - One of 'fte', 'headcount', 'unknown
 """
 
-import numpy as np
 import pandas as pd
-from pandas.api.types import is_numeric_dtype
-from ..generic import DataFile
+from ..generic import DataFile, IngestSpec, Layout
+from ..generic.engine import ingest_spec, map_categories
+
+
+def clean_columns_2015(source_data: pd.DataFrame, file: DataFile) -> pd.DataFrame:
+    cleaned_column_names = {k: k.lower().replace(' ', '_') for k in source_data.columns}
+    cleaned_column_names.update(dict(unitid='unit_id'))
+    source_data = source_data.rename(columns=cleaned_column_names)
+    source_data['occupation_filled'] = source_data.occupation.ffill()
+    return source_data
+
+
+def clean_columns_pre_2015(source_data: pd.DataFrame, file: DataFile) -> pd.DataFrame:
+    """Split the column names to remove the column prefix, eg S2013_OC.Grand total -> grand_total"""
+
+    source_data = source_data.drop(columns=['IDX_HR', 'IDX_S'], errors='ignore')
+    occupation_column_name = source_data.columns[3]
+    split_names = source_data.columns[3:].str.split('.').str[1].str.lower().str.replace(' ', '_')
+    cleaned_column_names = dict(zip(source_data.columns[3:], split_names))
+    cleaned_column_names.update({'unitid': 'unit_id',
+                                 'institution name': 'institution_name',
+                                 occupation_column_name: 'occupation_and_status'})
+    return source_data.rename(columns=cleaned_column_names)
+
+
+def unit_id_to_str(long_df: pd.DataFrame, file: DataFile) -> pd.DataFrame:
+    long_df['unit_id'] = map_categories(long_df.unit_id, str)
+    return long_df
+
+
+spec = IngestSpec(source='us_ipeds',
+                  layouts=[
+                      # Post 2015 files
+                      Layout(years=range(2015, 2100),
+                             read_options=dict(header=4, na_values='-'),
+                             prepare=clean_columns_2015,
+                             id_vars=['unit_id', 'institution_name', 'occupation', 'occupation_filled', 'gender'],
+                             var_name='ethnicity',
+                             finish=unit_id_to_str,
+                             category_types=['occupation_filled', 'gender', 'ethnicity'],
+                             institution_id='unit_id',
+                             institution_name='institution_name'),
+                      # Pre 2015 files
+                      Layout(years=range(2001, 2015),
+                             prepare=clean_columns_pre_2015,
+                             id_vars=['unit_id', 'institution_name', 'year', 'occupation_and_status'],
+                             var_name='gender_and_ethnicity',
+                             finish=unit_id_to_str,
+                             category_types=['occupation_and_status', 'gender_and_ethnicity'],
+                             year_column='year',
+                             institution_id='unit_id',
+                             institution_name='institution_name')
+                  ])
 
 
 def ingest(file: DataFile):
     """Take a provided filepath and process to generate back a semi-standardised pandas dataframe"""
 
-    # Post 2015 files
-    if file.year >= 2015:
-        engine = 'openpyxl'
-        source_data = pd.read_excel(file.filepath, header=4, na_values='-', engine=engine)
-
-        cleaned_column_names = {k: k.lower().replace(' ', '_') for k in source_data.columns}
-        cleaned_column_names.update(dict(unitid='unit_id'))
-        source_data.rename(columns=cleaned_column_names, inplace=True)
-        source_data['occupation_filled'] = source_data.occupation.ffill()
-        for col in source_data.columns:
-            if not is_numeric_dtype(source_data[col]):
-                source_data[col] = source_data[col].str.lower()
-
-        category_types = ['occupation_filled', 'gender', 'ethnicity']
-        melt_id_vars = ['unit_id', 'institution_name', 'occupation', 'occupation_filled', 'gender']
-        melt_var_name = 'ethnicity'
-
-    elif file.year < 2015:
-        if file.filepath.suffix == '.csv':
-            source_data = pd.read_csv(file.filepath, header=0)
-        elif file.filepath.suffix == '.xlsx':
-            engine = 'openpyxl'
-            source_data = pd.read_excel(file.filepath, engine=engine)
-        source_data.drop(columns=['IDX_HR', 'IDX_S'], errors='ignore', inplace=True)
-        for col in source_data.columns:
-            if not is_numeric_dtype(source_data[col]):
-                source_data[col] = source_data[col].str.lower()
-        category_types = ['occupation_and_status', 'gender_and_ethnicity']
-        # Split the column names to remove column prefix
-        occupation_column_name = source_data.columns[3]
-        cleaned_column_names = {k: k.split('.')[1].lower().replace(' ', '_') for k in source_data.columns[3:]}
-        cleaned_column_names.update({'unitid': 'unit_id',
-                                     'institution name': 'institution_name',
-                                     occupation_column_name: 'occupation_and_status'})
-        source_data.rename(columns=cleaned_column_names, inplace=True)
-        melt_id_vars = ['unit_id', 'institution_name', 'year', 'occupation_and_status']
-        melt_var_name = 'gender_and_ethnicity'
-
-    melted = source_data.melt(id_vars=melt_id_vars,
-                              var_name=melt_var_name,
-                              value_name='counts')
-
-    category_values = melted[category_types].apply(list, axis='columns')
-    out_df = pd.DataFrame(dict(year=[None] * len(melted),
-                               source_institution_id=melted.unit_id.astype(str),
-                               source_institution_name=melted.institution_name,
-                               source=[file.source] * len(melted),
-                               source_category_type=[category_types] * len(melted),
-                               source_category_value=category_values,
-                               counts=melted['counts'].astype(int, errors='ignore'))
-                          )
-    if 'year' in melted.columns:
-        out_df['year'] = melted.year
-    else:
-        out_df['year'] = [file.year] * len(melted)
-
-    return out_df
+    return ingest_spec(file, spec)
@@ -0,0 +1,93 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+"""
+Ingest Benchmarks
+
+Times a source ingestor over a raw data file, eg a full national IPEDS HR file, so that changes to an ingestor can
+be compared on real inputs. The DataFile is built by matching the filename against the source's file_regex in the
+same way as the Walker.
+
+Usage: python benchmark.py us_ipeds '../../data/input/IPEDS HR occupation_gender_race_2019.xlsx' --repeat 3
+
+Several files may be given, eg every year of a source to cover each of its layouts, and a total is then reported:
+
+    python benchmark.py au_indigenous ../../data/input/*_staff_indigenous.xlsx
+"""
+
+import argparse
+import time
+from pathlib import Path
+from typing import Union, Dict
+
+import pandas as pd
+
+from coki_diversity.sources import load_source
+from coki_diversity.sources.generic import DataFile
+
+
+def datafile_for(source: str,
+                 filepath: Union[str, Path]) -> DataFile:
+    filepath = Path(filepath)
+    match = load_source(source).file_regex.search(filepath.name)
+    if not match:
+        raise ValueError(f'{filepath.name} does not match the file_regex of {source}')
+    return DataFile(match.group('year'), match.group('table'), filepath, filepath.parent, filepath.name, source)
+
+
+def time_ingest(source: str,
+                filepath: Union[str, Path],
+                repeat: int = 3) -> Dict:
+    """Run a source's ingestor over a file repeat times, returning the row count and best and mean timings"""
+
+    datafile = datafile_for(source, filepath)
+    ingest = load_source(source).ingest
+    timings = []
+    rows = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ingested = ingest(datafile)
+        if ingested is None:
+            rows = 0
+        elif isinstance(ingested, pd.DataFrame):
+            rows = len(ingested)
+        else:
+            rows = sum(len(chunk) for chunk in ingested)
+        timings.append(time.perf_counter() - start)
+
+    return dict(source=source,
+                file=datafile.filename,
+                rows=rows,
+                best=min(timings),
+                mean=sum(timings) / len(timings))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time a source ingestor over raw data files')
+    parser.add_argument('source')
+    parser.add_argument('filepaths', nargs='+')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    results = []
+    for filepath in args.filepaths:
+        result = time_ingest(args.source, filepath, repeat=args.repeat)
+        results.append(result)
+        print(f"{result['source']} {result['file']}: {result['rows']} rows, "
+              f"best {result['best']:.3f}s, mean {result['mean']:.3f}s")
+    if len(results) > 1:
+        print(f"{args.source} {len(results)} files: {sum(r['rows'] for r in results)} rows, "
+              f"best {sum(r['best'] for r in results):.3f}s, mean {sum(r['mean'] for r in results):.3f}s")
@@ -1,63 +1,157 @@
-import pandas as pd
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+"""
+Build the ID Maps
+
+Builds the {prefix}_id_map.json mapping of each source's institution identifiers to GRID ids from the Wikidata
+exports and curated lists in the id mappings folder, along with the binary index of each map that the pipeline
+memory maps, see process.id_index. A map is only rebuilt when its inputs, or this builder, change, so running the
+builder on every pipeline run is cheap.
+
+Usage: python build_id_maps.py ../../data/id_mappings [--force]
+"""
+
+import argparse
+import hashlib
 import json
+import logging
 from pathlib import Path
+from typing import Union, List, Dict, Optional
+
+import pandas as pd
+
+from coki_diversity.process.id_index import IdIndex, write_id_index
+from coki_diversity.process.store import atomic_path
 
 MAP_FOLDER = Path('../../data/id_mappings')
+BUILDER_VERSION = 1
 
-"""
-UK HESA Mappings
 
-Obtained from Wikidata using the following query
-"""
+def uk_id_map(map_folder: Path) -> Dict:
+    """
+    UK HESA Mappings
 
-with open(MAP_FOLDER / 'UKPRN-GRID.json') as f:
-    ukprn_grid = json.load(f)
+    Obtained from Wikidata using the following query
+    """
 
-id_map = dict()
-for item in ukprn_grid:
-    id_map.update({item.get('ukprn') : item.get('grid')})
+    with open(map_folder / 'UKPRN-GRID.json') as f:
+        ukprn_grid = json.load(f)
+    return dict(zip([item.get('ukprn') for item in ukprn_grid], [item.get('grid') for item in ukprn_grid]))
 
-with open(MAP_FOLDER / 'uk_id_map.json', 'w') as f:
-    json.dump(id_map, f)
 
-"""
-US IPEDS Mappings
+def us_id_map(map_folder: Path) -> Dict:
+    """
+    US IPEDS Mappings
 
-Obtained from Wikidata using the following query...
-"""
+    Obtained from Wikidata using the following query...
+    """
 
-with open(MAP_FOLDER / 'IPEDS-GRID.json') as f:
-    ukprn_grid = json.load(f)
+    with open(map_folder / 'IPEDS-GRID.json') as f:
+        ipeds_grid = json.load(f)
+    return dict(zip([item.get('ipeds') for item in ipeds_grid], [item.get('grid') for item in ipeds_grid]))
 
-id_map = dict()
-for item in ukprn_grid:
-    id_map.update({item.get('ipeds') : item.get('grid')})
 
-with open(MAP_FOLDER / 'us_id_map.json', 'w') as f:
-    json.dump(id_map, f)
+def au_id_map(map_folder: Path) -> Dict:
+    """
+    Australian University Name Mappings
 
-"""
-Australian University Name Mappings
+    Manually curated list
+    """
 
-Manually curated list
-"""
+    au_id_info = pd.read_csv(map_folder / 'au_name_id_mappings.csv')
+    au_id_info['lower_name'] = au_id_info.Institution.str.lower()
+    au_id_info.lower_name = au_id_info.lower_name.str.replace('the ', '')
+    return dict(zip(au_id_info.lower_name, au_id_info.GRID))
 
-au_id_info = pd.read_csv(MAP_FOLDER / 'au_name_id_mappings.csv')
-au_id_info['lower_name'] = au_id_info.Institution.str.lower()
-au_id_info.lower_name = au_id_info.lower_name.str.replace('the ', '')
 
-id_map = {row.lower_name: row.GRID for _, row in au_id_info.iterrows()}
-with open(MAP_FOLDER / 'au_id_map.json', 'w') as f:
-    json.dump(id_map, f)
+def sa_id_map(map_folder: Path) -> Dict:
+    """
+    South African HEMIS ID to GRID mappings
 
-"""
-South African HEMIS ID to GRID mappings
+    Manually curated list
+    """
 
-Manually curated list
-"""
+    sa_id_info = pd.read_csv(map_folder / 'sa_name_id_mappings.csv')
+    sa_id_info['hemis'] = sa_id_info['Local ID'].str.lower()
+    return dict(zip(sa_id_info.hemis, sa_id_info.GRID))
+
+
+# The input files and builder of each map, by the prefix of its {prefix}_id_map.json
+ID_MAPS = {'uk': (['UKPRN-GRID.json'], uk_id_map),
+           'us': (['IPEDS-GRID.json'], us_id_map),
+           'au': (['au_name_id_mappings.csv'], au_id_map),
+           'sa': (['sa_name_id_mappings.csv'], sa_id_map)}
+
+
+def input_fingerprint(map_folder: Path,
+                      inputs: List[str]) -> str:
+    digest = hashlib.sha256(f'{BUILDER_VERSION}'.encode())
+    for name in inputs:
+        digest.update(name.encode())
+        digest.update((map_folder / name).read_bytes())
+    return digest.hexdigest()
+
+
+def is_current(map_folder: Path,
+               prefix: str,
+               fingerprint: str) -> bool:
+    json_path = map_folder / f'{prefix}_id_map.json'
+    index_path = map_folder / f'{prefix}_id_map.idx'
+    if not (json_path.is_file() and index_path.is_file()):
+        return False
+    try:
+        return IdIndex(index_path).input_fingerprint == fingerprint
+    except ValueError:
+        return False
+
+
+def build_id_maps(map_folder: Union[str, Path] = MAP_FOLDER,
+                  prefixes: Optional[List[str]] = None,
+                  force: bool = False) -> List[str]:
+    """Build the JSON and binary index of each ID map whose inputs have changed, returning the prefixes built"""
+
+    map_folder = Path(map_folder)
+    built = []
+    for prefix, (inputs, builder) in ID_MAPS.items():
+        if prefixes is not None and prefix not in prefixes:
+            continue
+        fingerprint = input_fingerprint(map_folder, inputs)
+        if not force and is_current(map_folder, prefix, fingerprint):
+            logging.info(f'{prefix}_id_map is up to date')
+            continue
+
+        logging.info(f'Building {prefix}_id_map from {inputs}')
+        id_map = builder(map_folder)
+        with atomic_path(map_folder / f'{prefix}_id_map.json') as temp_path:
+            with open(temp_path, 'w') as f:
+                json.dump(id_map, f)
+        # The index holds the map as it is read back from JSON, eg with string keys
+        with open(map_folder / f'{prefix}_id_map.json') as f:
+            write_id_index(json.load(f), map_folder / f'{prefix}_id_map.idx', fingerprint)
+        built.append(prefix)
+    return built
 
-sa_id_info = pd.read_csv(MAP_FOLDER / 'sa_name_id_mappings.csv')
-sa_id_info['hemis'] = sa_id_info['Local ID'].str.lower()
-id_map = {row.hemis: row.GRID for _, row in sa_id_info.iterrows()}
-with open(MAP_FOLDER / 'sa_id_map.json', 'w') as f:
-    json.dump(id_map, f)
\ No newline at end of file
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the ID maps whose inputs have changed')
+    parser.add_argument('map_folder', nargs='?', default=str(MAP_FOLDER))
+    parser.add_argument('--prefixes', nargs='+', choices=list(ID_MAPS))
+    parser.add_argument('--force', action='store_true', help='Rebuild every map whether or not its inputs changed')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    print(f'Built {build_id_maps(args.map_folder, args.prefixes, args.force)}')
@@ -0,0 +1,115 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+"""
+Export Benchmarks
+
+Times export_shards over a directory of ingested stores for each export format and compression, reporting the
+number of shards, rows and bytes written, so the formats can be compared on size and speed. Each combination is
+exported to its own sub-directory of a scratch directory, from scratch on every repeat.
+
+With --insert-latency, make_json is also timed writing JSON-nl and inserting every row into a LocalClient that
+waits the given number of seconds per insert request, reporting the time each pipeline stage was busy against the
+wall time.
+
+Usage: python export_benchmark.py ../../data/ingested /tmp/export_benchmark au_det us_ipeds --formats jsonl:gzip
+parquet:zstd
+"""
+
+import argparse
+import shutil
+import time
+from pathlib import Path
+from typing import Union, List, Dict, Optional
+
+from coki_diversity.process.bigquery import export_shards, make_json, LocalClient
+
+DEFAULT_FORMATS = ['jsonl', 'jsonl:gzip', 'jsonl:zstd', 'parquet:zstd', 'avro:zstd']
+
+
+def time_export(ingested_directory: Union[str, Path],
+                scratch_directory: Union[str, Path],
+                source_modules: List[str],
+                format: str = 'jsonl',
+                compression: Optional[str] = None,
+                repeat: int = 3,
+                **kwargs) -> Dict:
+    """Export the ingested stores repeat times in one format, returning the output size and best and mean timings"""
+
+    output_directory = Path(scratch_directory) / f'{format}_{compression or "none"}'
+    timings = []
+    manifest = None
+    for _ in range(repeat):
+        if output_directory.exists():
+            shutil.rmtree(output_directory)
+        start = time.perf_counter()
+        manifest = export_shards(ingested_directory, output_directory, source_modules,
+                                 format=format, compression=compression, **kwargs)
+        timings.append(time.perf_counter() - start)
+
+    return dict(format=format,
+                compression=compression,
+                shards=len(manifest['shards']),
+                rows=sum(shard['rows'] for shard in manifest['shards']),
+                bytes=sum(shard['bytes'] for shard in manifest['shards']),
+                best=min(timings),
+                mean=sum(timings) / len(timings))
+
+
+def time_make_json(ingested_directory: Union[str, Path],
+                   scratch_directory: Union[str, Path],
+                   source_modules: List[str],
+                   insert_latency: float = 0.05,
+                   **kwargs) -> Dict:
+    """Run make_json inserting into a LocalClient, returning the pipeline's wall and per stage busy times"""
+
+    outpath = Path(scratch_directory) / 'make_json.json'
+    outpath.parent.mkdir(parents=True, exist_ok=True)
+    client = LocalClient(latency=insert_latency)
+    stats = make_json(ingested_directory, '.hd5', outpath, source_modules, mode='w', client=client, write_gbq=True,
+                      **kwargs)
+    return dict(wall=stats.wall,
+                busy=stats.busy,
+                rows=sum(len(rows) for rows in client.rows.values()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the export of ingested stores in each format')
+    parser.add_argument('ingested_directory')
+    parser.add_argument('scratch_directory')
+    parser.add_argument('sources', nargs='+')
+    parser.add_argument('--formats', nargs='+', default=DEFAULT_FORMATS,
+                        help='format or format:compression, eg jsonl:gzip')
+    parser.add_argument('--id-map-path', default='../../data/id_mappings')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--insert-latency', type=float, help='Also time make_json with this latency per insert')
+    args = parser.parse_args()
+
+    for option in args.formats:
+        format, _, compression = option.partition(':')
+        result = time_export(args.ingested_directory, args.scratch_directory, args.sources,
+                             format=format, compression=compression or None, repeat=args.repeat,
+                             id_map_path=args.id_map_path)
+        print(f"{result['format']:8} {result['compression'] or 'none':5}: {result['shards']} shards, "
+              f"{result['rows']} rows, {result['bytes'] / 1e6:.2f} MB, "
+              f"best {result['best']:.3f}s, mean {result['mean']:.3f}s")
+
+    if args.insert_latency is not None:
+        result = time_make_json(args.ingested_directory, args.scratch_directory, args.sources,
+                                insert_latency=args.insert_latency, id_map_path=args.id_map_path)
+        stages = ', '.join(f'{name} {busy:.3f}s' for name, busy in result['busy'].items())
+        print(f"make_json: {result['rows']} rows inserted, wall {result['wall']:.3f}s, "
+              f"sum of stages {sum(result['busy'].values()):.3f}s ({stages})")
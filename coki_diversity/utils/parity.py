@@ -0,0 +1,125 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+"""
+Backend Parity Checks
+
+Runs normalise, filter_df and calculate_percentage over a source's raw data files, and optionally load_files over
+a directory of normalised files, with both the pandas and polars backends and reports whether the outputs are
+identical, along with the time each backend took. The same checks run on fixture data in
+tests/coki_diversity/process/test_backend_parity.py.
+
+Usage: python parity.py us_ipeds '../../data/input/IPEDS HR occupation_gender_race_2019.xlsx' --normalised-dir
+'../../data/normalised'
+"""
+
+import argparse
+import time
+from pathlib import Path
+from typing import Union, List, Optional, Callable
+
+import pandas as pd
+
+from coki_diversity.process.backend import get_backend, set_backend
+from coki_diversity.process.combine import load_files, calculate_percentage
+from coki_diversity.process.normalise import normalise, filter_df, fix_years, CategoryDictionary
+from coki_diversity.process.store import join_normalised
+from coki_diversity.sources import load_source
+from coki_diversity.utils.benchmark import datafile_for
+
+NUMERATORS = ['academic_women_count',
+              'academic_indigenous_count',
+              'academic_white_count',
+              'academic_indigenous_women_count']
+DENOMINATOR = 'academic_total_count'
+
+
+def run_backends(func: Callable,
+                 *args,
+                 **kwargs) -> dict:
+    """Call func with each backend, returning the outputs and timings keyed by backend"""
+
+    current = get_backend()
+    results = dict()
+    try:
+        for backend in ['pandas', 'polars']:
+            set_backend(backend)
+            start = time.perf_counter()
+            output = func(*args, **kwargs)
+            results[backend] = (output, time.perf_counter() - start)
+    finally:
+        set_backend(current)
+    return results
+
+
+def report(name: str,
+           results: dict) -> bool:
+    (pandas_output, pandas_time), (polars_output, polars_time) = results['pandas'], results['polars']
+    identical = pandas_output.equals(polars_output)
+    print(f"{name}: {'identical' if identical else 'DIFFERENT'}, "
+          f"pandas {pandas_time:.3f}s, polars {polars_time:.3f}s")
+    return identical
+
+
+def check_source(source: str,
+                 filepaths: List[Union[str, Path]]) -> bool:
+    ingest = load_source(source).ingest
+    ingested = []
+    for filepath in filepaths:
+        output = ingest(datafile_for(source, filepath))
+        if output is None:
+            continue
+        if not isinstance(output, pd.DataFrame):
+            output = pd.concat(list(output), ignore_index=True)
+        ingested.append(fix_years(output))
+    df = pd.concat(ingested, ignore_index=True)
+    df['id'] = df.source_institution_id
+
+    dictionary = CategoryDictionary.from_frame(df)
+    identical = True
+    normalised = dict()
+    for filters in load_source(source).filter_list:
+        identical &= report(f'{source} filter_df {filters.name}',
+                            run_backends(filter_df, df, filters, dictionary=dictionary))
+        results = run_backends(normalise, df, filters, dictionary=dictionary)
+        identical &= report(f'{source} normalise {filters.name}', results)
+        normalised[filters.name] = results['pandas'][0]
+
+    out_df = join_normalised(normalised).reset_index().reindex(columns=['id', 'year', 'source',
+                                                                         'source_institution_name'] +
+                                                                        NUMERATORS + [DENOMINATOR])
+    identical &= report(f'{source} calculate_percentage',
+                        run_backends(calculate_percentage, out_df, numerators=NUMERATORS, denominator=DENOMINATOR))
+    return identical
+
+
+def check_load_files(normalised_directory: Union[str, Path],
+                     columns: Optional[List[str]] = None) -> bool:
+    return report('load_files', run_backends(load_files, normalised_directory, columns=columns))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the pandas and polars backends on raw data files')
+    parser.add_argument('source')
+    parser.add_argument('filepaths', nargs='+')
+    parser.add_argument('--normalised-dir', help='Also compare load_files over this directory of normalised files')
+    args = parser.parse_args()
+
+    all_identical = check_source(args.source, args.filepaths)
+    if args.normalised_dir is not None:
+        all_identical &= check_load_files(args.normalised_dir, columns=NUMERATORS + [DENOMINATOR])
+    if not all_identical:
+        raise SystemExit(1)
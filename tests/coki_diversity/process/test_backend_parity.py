@@ -0,0 +1,121 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from coki_diversity.process.backend import get_backend, set_backend
+from coki_diversity.process.combine import load_files, calculate_percentage
+from coki_diversity.process.normalise import normalise, filter_df, compile_filter_list
+from coki_diversity.process.store import join_normalised, write_normalised
+from coki_diversity.sources.generic.engine import conform_output
+from tests.fixtures.process.frames import ingested_frame, filter_list
+
+pytest.importorskip('polars')
+
+
+def run_backends(func, *args, **kwargs) -> dict:
+    current = get_backend()
+    results = dict()
+    try:
+        for backend in ['pandas', 'polars']:
+            set_backend(backend)
+            results[backend] = func(*args, **kwargs)
+    finally:
+        set_backend(current)
+    return results
+
+
+def typed_frame() -> pd.DataFrame:
+    """The fixture frame with the types ingestors store, ids categorical as map_ids returns them"""
+
+    df = conform_output(ingested_frame(), integer_counts=False)
+    # Categories out of lexical order, so both backends must order the result by category
+    df['id'] = pd.Categorical(df.id, categories=sorted(df.id.unique(), reverse=True))
+    return df
+
+
+@pytest.fixture(params=['raw', 'compiled'])
+def filters(request):
+    if request.param == 'raw':
+        return filter_list()
+    return list(compile_filter_list(filter_list()))
+
+
+@pytest.fixture(params=['plain', 'typed'])
+def frame(request):
+    return ingested_frame() if request.param == 'plain' else typed_frame()
+
+
+def test_normalise_parity(filters, frame):
+    for category_filter in filters:
+        results = run_backends(normalise, frame, filters=category_filter)
+        pd.testing.assert_series_equal(results['polars'], results['pandas'])
+
+
+def test_normalise_parity_with_missing_values(filters, frame):
+    frame.loc[0, 'counts'] = np.nan
+    frame.loc[1, 'source_institution_name'] = np.nan
+    for category_filter in filters:
+        results = run_backends(normalise, frame, filters=category_filter)
+        pd.testing.assert_series_equal(results['polars'], results['pandas'])
+
+
+def test_filter_df_parity(filters, frame):
+    for category_filter in filters:
+        results = run_backends(filter_df, frame, category_filter)
+        pd.testing.assert_frame_equal(results['polars'], results['pandas'])
+
+
+def write_normalised_files(directory, same_categories: bool):
+    normalised = join_normalised({f.name: normalise(ingested_frame(), filters=f) for f in filter_list()})
+    write_normalised(normalised, directory / 'uk_hesa_2016.parquet')
+    if not same_categories:
+        write_normalised(normalised.iloc[:3], directory / 'uk_hesa_2017.parquet')
+
+    au_det = normalised.rename(index={'uk_hesa': 'au_det'}, level='source')
+    write_normalised(au_det[['academic_total_count', 'academic_women_count']], directory / 'au_det__all_.parquet')
+    au_indigenous = au_det[['academic_women_count']].rename(columns={'academic_women_count':
+                                                                     'academic_indigenous_count'})
+    write_normalised(au_indigenous.iloc[1:], directory / 'au_indigenous_2016.parquet')
+    if not same_categories:
+        write_normalised(au_indigenous.iloc[:1].rename(index={2016: 2015}, level='year'),
+                         directory / 'au_indigenous_2015.parquet')
+        # A year without any indigenous counts is written as an empty file
+        write_normalised(au_indigenous.iloc[:0], directory / 'au_indigenous_2014.parquet')
+
+
+@pytest.mark.parametrize('same_categories', [True, False])
+def test_load_files_parity(tmp_path, same_categories):
+    pytest.importorskip('pyarrow', exc_type=ImportError)
+    write_normalised_files(tmp_path, same_categories)
+
+    for columns in [None, ['academic_total_count', 'academic_indigenous_count']]:
+        results = run_backends(load_files, tmp_path, columns=columns)
+        pd.testing.assert_frame_equal(results['polars'], results['pandas'])
+        assert all(isinstance(results['pandas'][col].dtype, pd.CategoricalDtype)
+                   for col in ['id', 'source', 'source_institution_name'])
+
+
+def test_calculate_percentage_parity():
+    df = pd.DataFrame(dict(academic_total_count=[10.0, 0.0, 3.0, 7.0, np.nan],
+                           academic_women_count=[5.0, 0.0, 1.0, np.nan, 2.0],
+                           academic_white_count=[2.5, 1.0, 2.0, 7.0, 1.0]))
+    for decimals in [2, 0]:
+        results = run_backends(calculate_percentage, df, ['academic_women_count', 'academic_white_count'],
+                               'academic_total_count', decimals=decimals)
+        pd.testing.assert_frame_equal(results['polars'], results['pandas'])
@@ -0,0 +1,112 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+import json
+import os
+
+import pytest
+
+from coki_diversity.process.store import StoreCatalog, build_catalog, open_for_write, store_ingested, read_pool, \
+    CATALOG_FILENAME
+from tests.fixtures.process.frames import ingested_frame
+
+
+@pytest.fixture(autouse=True)
+def close_stores():
+    yield
+    read_pool.close_all()
+
+
+def ingest(directory, filename, table, df=None):
+    with open_for_write(directory / filename) as store:
+        entries = store_ingested(store, table, ingested_frame() if df is None else df)
+    return entries
+
+
+def test_recorded_tables_are_processed(tmp_path):
+    catalog = StoreCatalog(tmp_path)
+    catalog.record('uk_hesa_2016.hd5', 'staff', ingest(tmp_path, 'uk_hesa_2016.hd5', 'staff'))
+
+    catalog = StoreCatalog(tmp_path)
+    assert catalog.is_current('uk_hesa_2016.hd5')
+    assert catalog.is_processed('uk_hesa_2016.hd5', 'staff')
+    assert not catalog.is_processed('uk_hesa_2016.hd5', 'other')
+    assert catalog.rows('uk_hesa_2016.hd5') == len(ingested_frame())
+    assert catalog.years('uk_hesa_2016.hd5') == [2016, 2017]
+
+
+def test_stores_without_a_catalog_are_checked(tmp_path):
+    # Ingested before there was a catalog
+    ingest(tmp_path, 'uk_hesa_2016.hd5', 'staff')
+
+    catalog = StoreCatalog(tmp_path)
+    assert not catalog.is_current('uk_hesa_2016.hd5')
+    assert catalog.is_processed('uk_hesa_2016.hd5', 'staff')
+    assert not catalog.is_processed('uk_hesa_2016.hd5', 'other')
+
+    # Recording another table catalogs the tables already in the store
+    catalog.record('uk_hesa_2016.hd5', 'other', ingest(tmp_path, 'uk_hesa_2016.hd5', 'other'))
+    assert catalog.is_current('uk_hesa_2016.hd5')
+    assert {entry['table'] for entry in catalog.keys_for('uk_hesa_2016.hd5').values()} == {'staff', 'other'}
+
+
+def test_deleted_stores_are_not_processed(tmp_path):
+    catalog = StoreCatalog(tmp_path)
+    catalog.record('uk_hesa_2016.hd5', 'staff', ingest(tmp_path, 'uk_hesa_2016.hd5', 'staff'))
+    read_pool.close(tmp_path / 'uk_hesa_2016.hd5')
+    os.remove(tmp_path / 'uk_hesa_2016.hd5')
+
+    assert not StoreCatalog(tmp_path).is_processed('uk_hesa_2016.hd5', 'staff')
+
+
+def test_replaced_stores_are_checked(tmp_path):
+    catalog = StoreCatalog(tmp_path)
+    catalog.record('uk_hesa_2016.hd5', 'staff', ingest(tmp_path, 'uk_hesa_2016.hd5', 'staff'))
+    read_pool.close(tmp_path / 'uk_hesa_2016.hd5')
+
+    # Replaced by hand with a store holding a different table
+    os.remove(tmp_path / 'uk_hesa_2016.hd5')
+    ingest(tmp_path, 'uk_hesa_2016.hd5', 'other', ingested_frame().iloc[:5])
+
+    catalog = StoreCatalog(tmp_path)
+    assert not catalog.is_current('uk_hesa_2016.hd5')
+    assert not catalog.is_processed('uk_hesa_2016.hd5', 'staff')
+    assert catalog.is_processed('uk_hesa_2016.hd5', 'other')
+
+
+def test_old_catalogs_are_read(tmp_path):
+    entries = ingest(tmp_path, 'uk_hesa_2016.hd5', 'staff')
+    with open(tmp_path / CATALOG_FILENAME, 'w') as f:
+        json.dump({'uk_hesa_2016.hd5': entries}, f)
+
+    catalog = StoreCatalog(tmp_path)
+    assert catalog.keys_for('uk_hesa_2016.hd5') == entries
+    assert not catalog.is_current('uk_hesa_2016.hd5')
+    assert catalog.is_processed('uk_hesa_2016.hd5', 'staff')
+
+
+def test_build_catalog(tmp_path):
+    ingest(tmp_path, 'uk_hesa_2016.hd5', 'staff')
+    ingest(tmp_path, 'uk_hesa_2017.hd5', 'staff', [ingested_frame().iloc[:4], ingested_frame().iloc[4:]])
+
+    catalog = build_catalog(tmp_path)
+    assert catalog.is_current('uk_hesa_2016.hd5') and catalog.is_current('uk_hesa_2017.hd5')
+    assert list(catalog.keys_for('uk_hesa_2017.hd5')) == ['/staff/part_00000', '/staff/part_00001']
+    assert catalog.rows('uk_hesa_2017.hd5', 'staff') == len(ingested_frame())
+    with open(tmp_path / CATALOG_FILENAME) as f:
+        saved = json.load(f)
+    assert saved['stores'] == catalog.stores
+    assert set(saved['files']) == {'uk_hesa_2016.hd5', 'uk_hesa_2017.hd5'}
@@ -0,0 +1,62 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+import pandas as pd
+import pytest
+
+from coki_diversity.process.cube import CountCube
+from coki_diversity.process.normalise import normalise_partitions, compile_filter_list
+from tests.fixtures.process.frames import ingested_frame, filter_list
+
+
+@pytest.fixture(params=['raw', 'compiled'])
+def filters(request):
+    if request.param == 'raw':
+        return filter_list()
+    return list(compile_filter_list(filter_list()))
+
+
+def partitions(df: pd.DataFrame):
+    return [df.iloc[:30], df.iloc[30:55], df.iloc[55:]]
+
+
+def assert_results_equal(found, expected):
+    assert list(found) == list(expected)
+    for name, series in expected.items():
+        if len(series) == 0:
+            assert len(found[name]) == 0, name
+            continue
+        pd.testing.assert_series_equal(found[name], series, check_names=False)
+
+
+def test_cube_matches_normalise_partitions(filters):
+    df = ingested_frame()
+    expected = normalise_partitions(partitions(df), filters)
+    assert_results_equal(CountCube.from_frame(df).normalise_list(filters), expected)
+
+
+def test_merged_cube_matches_normalise_partitions(filters):
+    df = ingested_frame()
+    cube = CountCube.merge(CountCube.from_frame(partition) for partition in partitions(df))
+    assert_results_equal(cube.normalise_list(filters), normalise_partitions(partitions(df), filters))
+
+
+def test_saved_cube_matches_normalise_partitions(tmp_path, filters):
+    pytest.importorskip('pyarrow', exc_type=ImportError)
+    df = ingested_frame()
+    CountCube.from_frame(df).save(tmp_path, 'uk_hesa_2016')
+    cube = CountCube.load(tmp_path, 'uk_hesa_2016')
+    assert_results_equal(cube.normalise_list(filters), normalise_partitions(partitions(df), filters))
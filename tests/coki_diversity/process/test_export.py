@@ -0,0 +1,142 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from coki_diversity.process import bigquery
+from coki_diversity.process.bigquery import export_shards, table_fingerprint, make_json, LocalClient, InsertError
+from coki_diversity.process.store import store_writer, store_ingested, read_pool, is_complete
+from tests.fixtures.process.frames import ingested_frame, INSTITUTIONS
+
+
+@pytest.fixture(autouse=True)
+def close_stores():
+    yield
+    read_pool.close_all()
+
+
+@pytest.fixture
+def id_map_path(tmp_path):
+    path = tmp_path / 'id_mappings'
+    path.mkdir()
+    with open(path / 'uk_id_map.json', 'w') as f:
+        json.dump({ukprn: f'grid.{ukprn}' for ukprn, _ in INSTITUTIONS}, f)
+    return path
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    keys = []
+    read_key = bigquery.read_key
+
+    def counted(store, key):
+        keys.append(key)
+        return read_key(store, key)
+    monkeypatch.setattr(bigquery, 'read_key', counted)
+    return keys
+
+
+def ingest(directory, filename, ingested):
+    with store_writer() as writer:
+        store_ingested(writer.open(directory / filename), 'staff', ingested)
+
+
+def export(tmp_path, id_map_path):
+    return export_shards(tmp_path / 'ingested', tmp_path / 'shards', ['uk_hesa'], id_map_path=id_map_path,
+                         executor=ThreadPoolExecutor, max_workers=2)
+
+
+def test_fingerprints_do_not_depend_on_chunking(tmp_path):
+    df = ingested_frame()
+    ingest(tmp_path, 'whole.hd5', df)
+    ingest(tmp_path, 'chunked.hd5', [df.iloc[:5], df.iloc[5:20], df.iloc[20:]])
+    ingest(tmp_path, 'changed.hd5', df.assign(counts=df.counts + 1))
+
+    fingerprints = dict()
+    for name in ['whole', 'chunked', 'changed']:
+        store = read_pool.get(tmp_path / f'{name}.hd5')
+        fingerprints[name] = table_fingerprint(store, [key for key in store.keys()], 'settings')
+    assert fingerprints['whole'] == fingerprints['chunked']
+    assert fingerprints['whole'] != fingerprints['changed']
+
+
+def test_unchanged_stores_are_not_read(tmp_path, id_map_path, reads):
+    (tmp_path / 'ingested').mkdir()
+    ingest(tmp_path / 'ingested', 'uk_hesa_2016.hd5', ingested_frame())
+    first = export(tmp_path, id_map_path)
+    assert first['shards'] and reads
+
+    reads.clear()
+    assert export(tmp_path, id_map_path) == first
+    assert reads == []
+
+    # A store rewritten with the same content is read to fingerprint it, but its shards are kept
+    store_path = tmp_path / 'ingested' / 'uk_hesa_2016.hd5'
+    os.utime(store_path, ns=(0, 0))
+    names = {shard['name'] for shard in first['shards']}
+    touched = export(tmp_path, id_map_path)
+    assert {shard['name'] for shard in touched['shards']} == names
+    assert all(shard['store']['mtime_ns'] == 0 for shard in touched['shards'])
+    assert reads == ['/staff']
+
+    reads.clear()
+    export(tmp_path, id_map_path)
+    assert reads == []
+
+
+class FailingClient(LocalClient):
+    def __init__(self, fail_at: int):
+        super().__init__()
+        self.fail_at = fail_at
+        self.requests = 0
+
+    def insert_rows_json(self, table_id, json_rows, row_ids=None):
+        self.requests += 1
+        if self.requests == self.fail_at:
+            return [dict(index=0, errors=[dict(reason='invalid')])]
+        return super().insert_rows_json(table_id, json_rows, row_ids=row_ids)
+
+
+def test_parts_with_insert_errors_are_not_complete(tmp_path, id_map_path):
+    (tmp_path / 'ingested').mkdir()
+    df = ingested_frame()
+    df = df[df.counts % 1 == 0].reset_index(drop=True)
+    ingest(tmp_path / 'ingested', 'uk_hesa_2016.hd5', [df.iloc[:20], df.iloc[20:]])
+    outpath = tmp_path / 'out.json'
+    parts_directory = tmp_path / 'out.json.parts'
+
+    def run(client):
+        return make_json(tmp_path / 'ingested', '.hd5', outpath, ['uk_hesa'], mode='w', client=client,
+                         write_gbq=True, resume=True, table_id='table', id_map_path=id_map_path)
+
+    client = FailingClient(fail_at=2)
+    with pytest.raises(InsertError) as raised:
+        run(client)
+    assert raised.value.inserted == 0
+    assert is_complete(parts_directory, 'uk_hesa_2016_staff_part_00000.json')
+    assert not is_complete(parts_directory, 'uk_hesa_2016_staff_part_00001.json')
+    assert not outpath.exists()
+
+    # Only the part that failed is uploaded again
+    client = LocalClient()
+    run(client)
+    assert len(client.rows['table']) == len(df.iloc[20:])
+    assert len(outpath.read_text().splitlines()) == len(df)
+    assert not parts_directory.exists()
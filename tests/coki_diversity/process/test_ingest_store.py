@@ -0,0 +1,107 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from coki_diversity.process.store import encode_frame, put_frame, read_key
+from tests.fixtures.process.frames import ingested_frame
+
+
+def round_trip(tmp_path, df: pd.DataFrame, key: str = '/staff') -> pd.DataFrame:
+    with pd.HDFStore(tmp_path / 'uk_hesa_2016.hd5', mode='a') as store:
+        put_frame(store, key, df)
+    with pd.HDFStore(tmp_path / 'uk_hesa_2016.hd5', mode='r') as store:
+        assert store.keys() == [key]
+        return read_key(store, key)
+
+
+def categorical_frame() -> pd.DataFrame:
+    df = ingested_frame()
+    for col in ['source', 'source_institution_id', 'source_institution_name', 'source_count_type']:
+        df[col] = df[col].astype('category')
+    return df
+
+
+def test_encoded_frames_hold_no_objects():
+    encoded, kinds, values = encode_frame(categorical_frame())
+    assert kinds == dict(source='category', source_institution_id='category', source_institution_name='category',
+                         source_category_type='list', source_category_value='list', source_count_type='category')
+    assert all(encoded[col].dtype.kind == 'i' for col in kinds)
+    assert values['source_category_type'] == [['gender', 'level'], ['gender']]
+
+
+def test_round_trip(tmp_path):
+    df = categorical_frame()
+    pd.testing.assert_frame_equal(round_trip(tmp_path, df), df)
+
+
+def test_categorical_missing_values(tmp_path):
+    df = categorical_frame()
+    df['source_institution_name'] = df.source_institution_name.cat.add_categories(['Unused'])
+    df.loc[[0, 5], 'source_institution_name'] = np.nan
+    df['source_count_type'] = pd.Categorical([None] * len(df), categories=[])
+    df['ordered'] = pd.Categorical(['b', 'a', None] * (len(df) // 3) + ['a'] * (len(df) % 3),
+                                   categories=['b', 'a'], ordered=True)
+
+    found = round_trip(tmp_path, df)
+    assert found.source_institution_name.isna().tolist() == df.source_institution_name.isna().tolist()
+    assert found.source_institution_name.cat.categories.tolist() == df.source_institution_name.cat.categories.tolist()
+    pd.testing.assert_frame_equal(found, df)
+
+
+def test_list_columns(tmp_path):
+    df = ingested_frame()
+    df.at[0, 'source_category_type'] = []
+    df.at[0, 'source_category_value'] = []
+    df.at[1, 'source_category_value'] = ['female', None]
+
+    found = round_trip(tmp_path, df)
+    assert found.source_category_type[0] == [] and found.source_category_value[0] == []
+    assert found.source_category_value[1] == ['female', None]
+    pd.testing.assert_frame_equal(found, df)
+
+
+def test_all_empty_lists(tmp_path):
+    df = ingested_frame().iloc[:3]
+    df['source_category_type'] = [[], [], []]
+    pd.testing.assert_frame_equal(round_trip(tmp_path, df), df)
+
+
+@pytest.mark.parametrize('frame', [categorical_frame, ingested_frame])
+def test_empty_frames(tmp_path, frame):
+    df = frame().iloc[:0]
+    found = round_trip(tmp_path, df)
+    assert len(found) == 0
+    assert found.columns.tolist() == df.columns.tolist()
+    assert found.dtypes.astype(str).tolist() == df.dtypes.astype(str).tolist()
+
+
+@pytest.mark.filterwarnings('ignore::pandas.errors.PerformanceWarning')
+def test_stores_written_before_encoding_are_read(tmp_path):
+    df = ingested_frame()
+    with pd.HDFStore(tmp_path / 'uk_hesa_2016.hd5', mode='w') as store:
+        store['/staff'] = df
+    with pd.HDFStore(tmp_path / 'uk_hesa_2016.hd5', mode='r') as store:
+        pd.testing.assert_frame_equal(read_key(store, '/staff'), df)
+
+
+def test_keys_are_replaced(tmp_path):
+    round_trip(tmp_path, categorical_frame())
+    df = categorical_frame().iloc[:4]
+    df['source'] = df.source.cat.rename_categories({'uk_hesa': 'au_det'})
+    pd.testing.assert_frame_equal(round_trip(tmp_path, df), df)
@@ -0,0 +1,37 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+import json
+import subprocess
+import sys
+
+from coki_diversity.process.memory import MemoryReport
+
+
+def test_children_peak_is_reported_once_for_the_run(tmp_path):
+    report = MemoryReport(interval=0.01)
+    with report.stage('ingest'):
+        subprocess.run([sys.executable, '-c', 'x = bytearray(64 * 2 ** 20)'], check=True)
+    with report.stage('normalise'):
+        pass
+    report.write_report(tmp_path / 'memory.json')
+
+    with open(tmp_path / 'memory.json') as f:
+        saved = json.load(f)
+    assert [entry['stage'] for entry in saved['stages']] == ['ingest', 'normalise']
+    assert all('children_peak_rss' not in entry for entry in saved['stages'])
+    assert saved['children_peak_rss'] >= 64 * 2 ** 20
+    assert saved['peaks'] == report.peaks()
@@ -0,0 +1,53 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from coki_diversity.process.query import build_query_store, QueryStore
+
+
+@pytest.fixture
+def query_store(tmp_path):
+    combined = pd.DataFrame(dict(id=['grid.1', 'grid.2', 'grid.3', 'grid.4', 'grid.1'],
+                                 year=[2016, 2016, 2016, 2016, 2017],
+                                 source=['uk_hesa', 'au_det', 'uk_hesa', np.nan, 'uk_hesa'],
+                                 source_institution_name=['Aberdeen', 'Zed', np.nan, 'Nowhere', 'Aberdeen'],
+                                 academic_women_count=[10.0, 20.0, 30.0, 40.0, 11.0]))
+    build_query_store(combined, tmp_path)
+    return QueryStore(tmp_path)
+
+
+def test_missing_labels_are_none(query_store):
+    top = query_store.top_n('academic_women_count', 2016, n=4)
+    assert top.id.tolist() == ['grid.4', 'grid.3', 'grid.2', 'grid.1']
+    assert top.source.tolist() == [None, 'uk_hesa', 'au_det', 'uk_hesa']
+    assert top.source_institution_name.tolist() == ['Nowhere', None, 'Zed', 'Aberdeen']
+
+
+def test_rows_without_a_source_have_no_country(query_store):
+    summary = query_store.compare_countries('academic_women_count', 2016)
+    assert summary.index.tolist() == ['au', 'uk']
+    assert summary.institutions.tolist() == [1, 2]
+    assert summary.loc['uk', 'max'] == 30.0
+
+
+def test_countries_are_filtered(query_store):
+    summary = query_store.compare_countries('academic_women_count', 2016, countries=['uk'])
+    assert summary.index.tolist() == ['uk']
+    assert summary.institutions.tolist() == [2]
+    assert query_store.compare_countries('academic_women_count', 2016, countries=[]).empty
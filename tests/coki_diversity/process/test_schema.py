@@ -0,0 +1,61 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+import json
+
+import pytest
+
+from coki_diversity.process.bigquery import export_records
+from coki_diversity.process.schema import ColumnarRecords, EXPORT_SCHEMA, validate_records
+from tests.fixtures.process.frames import ingested_frame, INSTITUTIONS
+
+ID_MAP = {ukprn: f'grid.{ukprn}' for ukprn, _ in INSTITUTIONS}
+
+
+def test_counts_are_integers():
+    assert {field.name: field.type for field in EXPORT_SCHEMA}['counts'] == 'INTEGER'
+
+    df = ingested_frame()
+    df['counts'] = df.counts.astype(float)
+    records = export_records(df, ID_MAP)
+    assert validate_records(records) == []
+
+    integral = df[df.counts % 1 == 0]
+    assert len(records) == len(integral)
+    dicts = records.to_dicts()
+    assert all(type(record['counts']) is int for record in dicts)
+    assert [record['counts'] for record in dicts] == integral.counts.astype(int).tolist()
+    assert [json.loads(line) for line in records.json_lines()] == dicts
+    assert b'"counts": 16}' in records.json_lines()[0]
+
+
+def test_fractional_counts_are_dropped_from_the_export(caplog):
+    df = ingested_frame()
+    fractional = int((df.counts % 1 != 0).sum())
+    assert fractional
+
+    export_records(df, ID_MAP)
+    assert f'dropping {fractional} rows with fractional counts' in caplog.text
+
+    # Conformed directly they are reported rather than truncated
+    issues = validate_records(ColumnarRecords.from_frame(df.assign(id=df.source_institution_id)))
+    assert [(issue.field, issue.rows) for issue in issues] == [('counts', fractional)]
+
+
+def test_arrow_counts_are_integers():
+    pa = pytest.importorskip('pyarrow', exc_type=ImportError)
+    table = export_records(ingested_frame(), ID_MAP).to_arrow()
+    assert table.schema.field('counts').type == pa.int64()
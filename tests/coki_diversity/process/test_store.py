@@ -0,0 +1,92 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+import logging
+
+import pandas as pd
+import pytest
+
+from coki_diversity.process.combine import load_files
+from coki_diversity.process.normalise import normalise_partitions
+from coki_diversity.process.store import join_normalised, write_normalised, read_normalised, metric_columns, \
+    NORMALISED_INDEX
+from tests.fixtures.process.frames import ingested_frame, filter_list
+
+pytest.importorskip('pyarrow', exc_type=ImportError)
+
+
+def normalised_frame() -> pd.DataFrame:
+    return join_normalised(normalise_partitions([ingested_frame()], filter_list()))
+
+
+def as_strings(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.reset_index() if df.index.names == NORMALISED_INDEX else df.copy()
+    for col in ['id', 'source', 'source_institution_name']:
+        df[col] = df[col].astype(object)
+    return df
+
+
+def test_normalised_round_trip(tmp_path):
+    out_df = normalised_frame()
+    write_normalised(out_df, tmp_path / 'uk_hesa_2016.parquet')
+
+    df = read_normalised(tmp_path / 'uk_hesa_2016.parquet', index=True)
+    pd.testing.assert_frame_equal(as_strings(df), as_strings(out_df))
+    assert metric_columns(tmp_path / 'uk_hesa_2016.parquet') == list(out_df.columns)
+
+
+def test_normalised_types(tmp_path):
+    write_normalised(normalised_frame(), tmp_path / 'uk_hesa_2016.parquet')
+
+    df = read_normalised(tmp_path / 'uk_hesa_2016.parquet')
+    assert list(df.columns[:4]) == NORMALISED_INDEX
+    for col in ['id', 'source', 'source_institution_name']:
+        assert isinstance(df[col].dtype, pd.CategoricalDtype)
+    assert df.year.dtype == 'int64'
+    assert (df.dtypes[4:] == 'float64').all()
+    # The filter that matched no rows is kept as an all missing column
+    assert df.academic_unmatched_count.isna().all()
+
+
+def test_read_selected_columns(tmp_path):
+    write_normalised(normalised_frame(), tmp_path / 'uk_hesa_2016.parquet')
+
+    df = read_normalised(tmp_path / 'uk_hesa_2016.parquet', columns=['academic_women_count', 'not_a_column'])
+    assert list(df.columns) == NORMALISED_INDEX + ['academic_women_count']
+
+
+def test_empty_filters_round_trip(tmp_path):
+    out_df = join_normalised({'a': pd.Series(dtype=float)})
+    assert len(out_df) == 0
+    assert list(out_df.columns) == ['a']
+    assert out_df.index.names == NORMALISED_INDEX
+
+    write_normalised(out_df, tmp_path / 'uk_hesa_2016.parquet')
+    df = read_normalised(tmp_path / 'uk_hesa_2016.parquet')
+    assert len(df) == 0
+    assert list(df.columns) == NORMALISED_INDEX + ['a']
+
+
+def test_load_files_reads_parquet(tmp_path, caplog):
+    out_df = normalised_frame()
+    write_normalised(out_df, tmp_path / 'uk_hesa_2016.parquet')
+    write_normalised(out_df.iloc[:0], tmp_path / 'au_det__all_.parquet')
+    (tmp_path / 'us_ipeds_2016.csv').write_text('id,year\n')
+
+    with caplog.at_level(logging.WARNING):
+        df = load_files(tmp_path)
+    assert len(df) == len(out_df)
+    assert 'us_ipeds_2016.csv' in caplog.text
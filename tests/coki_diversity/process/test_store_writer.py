@@ -0,0 +1,148 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+import os
+import shutil
+import stat
+
+import pandas as pd
+import pytest
+
+from coki_diversity.process import store as store_module
+from coki_diversity.process.store import store_writer, store_ingested, read_pool, read_key, atomic_path, \
+    TEMP_PREFIX
+from tests.fixtures.process.frames import ingested_frame
+
+
+@pytest.fixture(autouse=True)
+def close_stores():
+    yield
+    read_pool.close_all()
+
+
+@pytest.fixture
+def copies(monkeypatch):
+    copied = []
+    original = shutil.copyfile
+
+    def copyfile(src, dst):
+        copied.append(src)
+        return original(src, dst)
+    monkeypatch.setattr(store_module.shutil, 'copyfile', copyfile)
+    return copied
+
+
+def write_tables(writer, filepath, tables):
+    for table in tables:
+        entries = store_ingested(writer.open(filepath), table, ingested_frame())
+        writer.add(filepath, (table, entries))
+
+
+def test_stores_are_copied_once_per_run(tmp_path, copies):
+    filepath = tmp_path / 'uk_hesa_2016.hd5'
+    with store_writer() as writer:
+        write_tables(writer, filepath, ['a'])
+    with store_writer() as writer:
+        write_tables(writer, filepath, ['b', 'c', 'd'])
+
+    assert copies == [filepath]
+    with pd.HDFStore(filepath, mode='r') as store:
+        assert sorted(store.keys()) == ['/a', '/b', '/c', '/d']
+    assert not list(tmp_path.glob(f'{TEMP_PREFIX}*'))
+
+
+def test_on_commit_follows_the_rename(tmp_path):
+    committed = []
+
+    def on_commit(filepath, items):
+        with pd.HDFStore(filepath, mode='r') as store:
+            committed.append((filepath.name, [table for table, _ in items], sorted(store.keys())))
+
+    with store_writer(on_commit) as writer:
+        write_tables(writer, tmp_path / 'uk_hesa_2016.hd5', ['a', 'b'])
+        write_tables(writer, tmp_path / 'uk_hesa_2017.hd5', ['a'])
+        assert not (tmp_path / 'uk_hesa_2016.hd5').exists()
+        assert committed == []
+
+    assert committed == [('uk_hesa_2016.hd5', ['a', 'b'], ['/a', '/b']),
+                         ('uk_hesa_2017.hd5', ['a'], ['/a'])]
+
+
+def test_committed_stores_survive_a_failed_run(tmp_path):
+    committed = []
+    with pytest.raises(ValueError):
+        with store_writer(lambda path, items: committed.append(path.name)) as writer:
+            write_tables(writer, tmp_path / 'uk_hesa_2016.hd5', ['a', 'b'])
+            writer.commit(tmp_path / 'uk_hesa_2016.hd5')
+            # Committing a store that is not open does nothing
+            writer.commit(tmp_path / 'uk_hesa_2018.hd5')
+            write_tables(writer, tmp_path / 'uk_hesa_2017.hd5', ['a'])
+            raise ValueError('ingest failed')
+
+    assert committed == ['uk_hesa_2016.hd5']
+    with pd.HDFStore(tmp_path / 'uk_hesa_2016.hd5', mode='r') as store:
+        assert sorted(store.keys()) == ['/a', '/b']
+    assert not (tmp_path / 'uk_hesa_2017.hd5').exists()
+    assert not (tmp_path / 'uk_hesa_2018.hd5').exists()
+
+
+def test_failed_runs_leave_stores_unchanged(tmp_path):
+    filepath = tmp_path / 'uk_hesa_2016.hd5'
+    with store_writer() as writer:
+        write_tables(writer, filepath, ['a'])
+
+    committed = []
+    with pytest.raises(ValueError):
+        with store_writer(lambda path, items: committed.append(path)) as writer:
+            write_tables(writer, filepath, ['b'])
+            raise ValueError('ingest failed')
+
+    assert committed == []
+    with pd.HDFStore(filepath, mode='r') as store:
+        assert store.keys() == ['/a']
+        pd.testing.assert_frame_equal(read_key(store, '/a'), ingested_frame())
+    assert not list(tmp_path.glob(f'{TEMP_PREFIX}*'))
+
+
+def test_least_recently_used_stores_are_committed(tmp_path):
+    committed = []
+    with store_writer(lambda path, items: committed.append(path.name), max_open=2) as writer:
+        for year in [2016, 2017, 2018]:
+            write_tables(writer, tmp_path / f'uk_hesa_{year}.hd5', ['a'])
+        assert committed == ['uk_hesa_2016.hd5']
+        # Reopening a committed store starts a new working copy of it
+        write_tables(writer, tmp_path / 'uk_hesa_2016.hd5', ['b'])
+        assert committed == ['uk_hesa_2016.hd5', 'uk_hesa_2017.hd5']
+
+    assert committed == ['uk_hesa_2016.hd5', 'uk_hesa_2017.hd5', 'uk_hesa_2018.hd5', 'uk_hesa_2016.hd5']
+    with pd.HDFStore(tmp_path / 'uk_hesa_2016.hd5', mode='r') as store:
+        assert sorted(store.keys()) == ['/a', '/b']
+
+
+@pytest.mark.parametrize('mode', [0o644, 0o640])
+def test_rewritten_files_keep_their_permissions(tmp_path, mode):
+    filepath = tmp_path / 'uk_hesa_2016.hd5'
+    with store_writer() as writer:
+        write_tables(writer, filepath, ['a'])
+    os.chmod(filepath, mode)
+
+    with store_writer() as writer:
+        write_tables(writer, filepath, ['b'])
+    assert stat.S_IMODE(filepath.stat().st_mode) == mode
+
+    with atomic_path(filepath, copy_existing=True):
+        pass
+    assert stat.S_IMODE(filepath.stat().st_mode) == mode
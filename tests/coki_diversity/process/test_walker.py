@@ -0,0 +1,71 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+import os
+
+import pytest
+
+from coki_diversity.process.store import mark_complete, TEMP_PREFIX
+from coki_diversity.process.walker import Walker, scan_tree
+
+SOURCES = ['uk_hesa', 'au_det']
+
+
+@pytest.fixture
+def ingested_directory(tmp_path):
+    for name in ['uk_hesa_2016.hd5', 'uk_hesa_2017.hd5', 'au_det__all_.hd5', 'uk_hesa_2016.hd5.bak',
+                 'xuk_hesa_2016.hd5', f'{TEMP_PREFIX}abc123', 'catalog.json']:
+        (tmp_path / name).touch()
+    mark_complete(tmp_path, 'uk_hesa_2016.hd5__staff', source='uk_hesa')
+    mark_complete(tmp_path, 'au_det__all_.hd5__fte_gender_level', source='au_det')
+    return tmp_path
+
+
+@pytest.mark.parametrize('scan_workers', [1, 4])
+def test_ingested_stores_only(ingested_directory, scan_workers):
+    w = Walker(ingested_directory, SOURCES, scan_workers=scan_workers)
+    found = sorted((f.source, f.year, f.filename) for f in w.walk(stage='ingested'))
+    assert found == [('au_det', '_all_', 'au_det__all_.hd5'),
+                     ('uk_hesa', 2016, 'uk_hesa_2016.hd5'),
+                     ('uk_hesa', 2017, 'uk_hesa_2017.hd5')]
+
+
+@pytest.mark.parametrize('scan_workers', [1, 4])
+def test_raw_files(tmp_path, scan_workers):
+    (tmp_path / 'hesa' / 'nested').mkdir(parents=True)
+    for name in ['hesa/UK_Table_staff 2016-17.csv', 'hesa/nested/UK_Table_staff 2017-18.xlsx',
+                 'hesa/UK_Table_staff 2016-17.csv.txt', 'hesa/notes.csv']:
+        (tmp_path / name).touch()
+
+    w = Walker(tmp_path, SOURCES, scan_workers=scan_workers)
+    found = sorted((f.source, f.year, f.table) for f in w.walk())
+    assert found == [('uk_hesa', 2017, 'staff '), ('uk_hesa', 2018, 'staff ')]
+
+
+@pytest.mark.parametrize('workers', [1, 8, 64])
+def test_wide_trees_are_scanned_completely(tmp_path, workers):
+    for i in range(20):
+        for j in range(5):
+            directory = tmp_path / f'dir_{i}' / f'sub_{j}'
+            directory.mkdir(parents=True)
+            (directory / f'table_{i}_{j}.csv').touch()
+            (directory / 'deeper').mkdir()
+            (directory / 'deeper' / f'table_{i}_{j}.xlsx').touch()
+
+    expected = sorted((path, filename) for path, _, filenames in os.walk(tmp_path) for filename in filenames)
+    assert len(expected) == 200
+    for _ in range(5):
+        assert sorted(scan_tree(tmp_path, workers)) == expected
@@ -0,0 +1,86 @@
+# Copyright 2021 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Cameron Neylon
+
+"""
+Small fixture frames for the process tests
+
+ingested_frame is a prepared ingested frame, as normalise receives it after fix_years and the id mapping, and
+filter_list a source filter list over it. The filters cover count types, single string requirement values, (start,
+end) year tuples and a filter that matches no rows.
+"""
+
+from typing import List
+
+import pandas as pd
+
+from coki_diversity.sources.generic import FileFilter, CategoryFilter
+
+SOURCE = 'uk_hesa'
+YEARS = [2016, 2017]
+INSTITUTIONS = [('10007783', 'University of Aberdeen'),
+                ('10007792', 'University of Exeter'),
+                ('10007856', 'Zed University')]
+GENDERS = ['female', 'male']
+LEVELS = ['professor', 'lecturer', 'other']
+COUNT_TYPES = ['headcount', 'fte']
+
+
+def ingested_frame() -> pd.DataFrame:
+    rows = []
+    for year in YEARS:
+        for i, (ukprn, name) in enumerate(INSTITUTIONS):
+            for count_type in COUNT_TYPES:
+                for j, gender in enumerate(GENDERS):
+                    for k, level in enumerate(LEVELS):
+                        counts = (year - 2000) * (i + 1) + 7 * j + 3 * k
+                        rows.append(dict(year=year,
+                                         source=SOURCE,
+                                         source_institution_id=ukprn,
+                                         source_institution_name=name,
+                                         source_category_type=['gender', 'level'],
+                                         source_category_value=[gender, level],
+                                         counts=counts / 2 if count_type == 'fte' else counts,
+                                         source_count_type=count_type,
+                                         id=f'grid.{ukprn}'))
+        # A row with a single category, only selected by filters that do not require a level
+        rows.append(dict(year=year,
+                         source=SOURCE,
+                         source_institution_id=INSTITUTIONS[0][0],
+                         source_institution_name=INSTITUTIONS[0][1],
+                         source_category_type=['gender'],
+                         source_category_value=['female'],
+                         counts=5,
+                         source_count_type='headcount',
+                         id=f'grid.{INSTITUTIONS[0][0]}'))
+    return pd.DataFrame(rows)
+
+
+def filter_list() -> List[CategoryFilter]:
+    academic = ['professor', 'lecturer']
+    return [CategoryFilter(name='academic_total_count',
+                           filefilters=[FileFilter(source=SOURCE, years=YEARS, reqs={'level': academic},
+                                                   count_type='headcount')]),
+            CategoryFilter(name='academic_women_count',
+                           filefilters=[FileFilter(source=SOURCE, years=YEARS,
+                                                   reqs={'level': academic, 'gender': 'female'},
+                                                   count_type='headcount')]),
+            CategoryFilter(name='academic_women_fte',
+                           filefilters=[FileFilter(source=SOURCE, years=(2016, 2018),
+                                                   reqs={'gender': ['female']}, count_type='fte')]),
+            CategoryFilter(name='academic_women_all',
+                           filefilters=[FileFilter(source=SOURCE, years=[2017], reqs={'gender': ['female']})]),
+            CategoryFilter(name='academic_unmatched_count',
+                           filefilters=[FileFilter(source=SOURCE, years=[1999], reqs={'gender': ['female']})])]